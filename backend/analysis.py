@@ -0,0 +1,219 @@
+from helpers import detection_prompt_prefix, format_detection_response, generation_prompt_prefix, routing_plan
+from llm import count_tokens
+from models import *
+
+
+# Return every cycle made only of generation components, each as the list of
+# component ids in the order they are visited. A chat entering one would generate
+# responses forever, so the chat engine rejects it
+def find_generation_cycles(dt: type[DialogueTree]):
+    cycles = []
+    visited = set()
+    for gc in dt.components:
+        walk = {}
+        c = gc
+        while isinstance(c, Generation) and c.id not in visited:
+            visited.add(c.id)
+            walk[c.id] = len(walk)
+            c = None if c.is_leaf() else c.get_next_component()
+        if isinstance(c, Generation) and c.id in walk:
+            cycles.append(list(walk)[walk[c.id]:])
+    return cycles
+
+
+# Return the components a chat can move to from c: the next component of a generation
+# component, and the generation components a detection component routes its classes to
+def followed_components(dt: type[DialogueTree], c: type[Component]):
+    if c.is_leaf():
+        return []
+    elif isinstance(c, Generation):
+        return [c.get_next_component()]
+    plan = routing_plan(dt)
+    routed = [plan.route(c, format_detection_response(det_class)) for det_class in c.get_classes()]
+    return [gc for gc in routed if gc is not None]
+
+
+# Return the strongly connected components of the tree's edge graph, each as a list
+# of components in tree order. Uses Tarjan's algorithm with an explicit stack, so long
+# chains of components do not hit the recursion limit
+def find_strongly_connected_components(dt: type[DialogueTree]):
+    order = {c.id: i for i, c in enumerate(dt.components)}
+    index = {}
+    low = {}
+    stack = []
+    on_stack = set()
+    sccs = []
+    for root in dt.components:
+        if root.id in index:
+            continue
+        work = [(root, 0)]
+        while len(work) > 0:
+            c, i = work.pop()
+            if i == 0:
+                index[c.id] = low[c.id] = len(index)
+                stack.append(c)
+                on_stack.add(c.id)
+            if i < len(c.neighbors):
+                work.append((c, i + 1))
+                neighbor = c.neighbors[i]
+                if neighbor.id not in index:
+                    work.append((neighbor, 0))
+                elif neighbor.id in on_stack:
+                    low[c.id] = min(low[c.id], index[neighbor.id])
+                continue
+            if low[c.id] == index[c.id]:
+                scc = []
+                while True:
+                    member = stack.pop()
+                    on_stack.remove(member.id)
+                    scc.append(member)
+                    if member is c:
+                        break
+                sccs.append(sorted(scc, key=lambda member: order[member.id]))
+            if len(work) > 0:
+                parent = work[-1][0]
+                low[parent.id] = min(low[parent.id], low[c.id])
+    return sorted(sccs, key=lambda scc: order[scc[0].id])
+
+
+# Return the components chats are taken to start at. Chats start at a component the
+# client chooses, so without a start component every group of components that no
+# edge from outside the group leads into is an entry, represented by its first
+# component. A group is a single component without incoming edges unless its
+# components form a cycle
+def find_entry_components(dt: type[DialogueTree], start: type[Component]=None):
+    if start is not None:
+        return [start]
+    entries = []
+    for scc in find_strongly_connected_components(dt):
+        members = {c.id for c in scc}
+        if all(predecessor.id in members for c in scc for predecessor in dt.incoming[c.id]):
+            entries.append(scc[0])
+    return entries
+
+
+# Return the ids of the components no chat can reach from the entry components
+def find_unreachable_components(dt: type[DialogueTree], entries: list):
+    reachable = set()
+    stack = list(entries)
+    while len(stack) > 0:
+        c = stack.pop()
+        if c.id not in reachable:
+            reachable.add(c.id)
+            stack.extend(followed_components(dt, c))
+    return [c.id for c in dt.components if c.id not in reachable]
+
+
+# Return the classes of detection components with outgoing edges that no outgoing
+# generation component has as its class. Detected classes are lowercased before they
+# are matched, so a generation class must be written in lowercase to match
+def find_unmatched_classes(dt: type[DialogueTree]):
+    unmatched = []
+    plan = routing_plan(dt)
+    for dc in dt.components:
+        if isinstance(dc, Detection) and not dc.is_leaf():
+            for cls in dc.classes:
+                if plan.route(dc, format_detection_response(cls.det_class)) is None:
+                    unmatched.append({'detection': dc.id, 'id': cls.id, 'class': cls.det_class})
+    return unmatched
+
+
+# Return the generation components with more than one outgoing edge. Chats only follow
+# the first edge, so the others are never taken
+def find_multiple_outgoing_edges(dt: type[DialogueTree]):
+    return [{'generation': gc.id, 'next': gc.neighbors[0].id, 'ignored': [c.id for c in gc.neighbors[1:]]}
+            for gc in dt.components if isinstance(gc, Generation) and len(gc.neighbors) > 1]
+
+
+# Return the number of prompt tokens of a GPT call for component c, not counting the
+# conversation. Every example is counted, so prompts with EXAMPLE_SELECTION_K set are
+# smaller
+def estimate_prompt_tokens(c: type[Component]):
+    if isinstance(c, Detection):
+        prefix, example_num = detection_prompt_prefix(c)
+        return count_tokens(prefix + f'Input {example_num+1}: \nCategory {example_num+1}: ')
+    prefix, prefix_tokens = generation_prompt_prefix(c)
+    return prefix_tokens + count_tokens('Here is what the student said, fill in the answer:\nContext: \\Response: ')
+
+
+# Return the generation components run one after another starting at gc, the
+# component the chat moves to after them (None to exit), and whether they form a cycle
+def follow_generations(dt: type[DialogueTree], gc: type[Generation]):
+    plan = routing_plan(dt)
+    components = []
+    while True:
+        path, offset = plan.position(gc)
+        components.extend(path.components[offset:])
+        if path.cyclic:
+            return components, None, True
+        elif not isinstance(path.next, Generation):
+            return components, path.next, False
+        gc = path.next
+
+
+# Return a path of one chat turn through components, ending at next_c, with prompt
+# tokens taken from the estimates of each component by id
+def turn_path(start: type[Component], det_class: str, components: list, next_c: type[Component], cyclic: bool,
+              prompt_tokens: dict):
+    path = {'start': start.id,
+            'class': det_class,
+            'components': [c.id for c in components],
+            'next_id': 'exit' if next_c is None else next_c.id}
+    if cyclic:
+        path['next_id'] = None
+        path['error'] = 'generation components form a cycle'
+        path['llm_calls'] = None
+        path['prompt_tokens'] = None
+    else:
+        path['llm_calls'] = len(components)
+        path['prompt_tokens'] = sum(prompt_tokens[c.id] for c in components)
+    gcs = [c for c in components if isinstance(c, Generation)]
+    path['history_bounded'] = all(gc.budget['max_history_messages'] is not None
+                                  or gc.budget['max_prompt_tokens'] is not None for gc in gcs)
+    return path
+
+
+# Return every path a chat turn starting at component c can take, one per class of the
+# detection component that classifies the student message
+def find_turn_paths(dt: type[DialogueTree], c: type[Component], prompt_tokens: dict):
+    plan = routing_plan(dt)
+    start = c
+    components = []
+    if isinstance(c, Generation):
+        components, c, cyclic = follow_generations(dt, c)
+        if cyclic or c is None:
+            return [turn_path(start, None, components, None, cyclic, prompt_tokens)]
+    if c.is_leaf():
+        return [turn_path(start, None, components, None, False, prompt_tokens)]
+
+    paths = []
+    for det_class in dict.fromkeys(format_detection_response(det_class) for det_class in c.get_classes()):
+        gc = plan.route(c, det_class)
+        if gc is not None:
+            gcs, next_c, cyclic = follow_generations(dt, gc)
+            paths.append(turn_path(start, det_class, components + [c] + gcs, next_c, cyclic, prompt_tokens))
+    return paths
+
+
+# Return a static analysis of the dialogue tree: generation-only cycles, unreachable
+# components, detection classes no generation component matches, generation components
+# with ignored edges, and the GPT calls and prompt tokens of every path a chat turn can
+# take. Chats start at the start component if one is given, otherwise at the entry
+# components, and turns start there and at every reachable detection component a turn
+# can stop at. Prompt tokens leave out the conversation, which every prompt includes
+def analyze_dialogue_tree(dt: type[DialogueTree], start: type[Component]=None):
+    entries = find_entry_components(dt, start)
+    unreachable = find_unreachable_components(dt, entries)
+    skipped = {c.id for c in entries} | set(unreachable)
+    starts = entries + [c for c in dt.components if c.id not in skipped
+                        and isinstance(c, Detection) and not c.is_leaf()]
+    prompt_tokens = {c.id: estimate_prompt_tokens(c) for c in dt.components}
+    paths = []
+    for c in starts:
+        paths.extend(find_turn_paths(dt, c, prompt_tokens))
+
+    return {'generation_cycles': find_generation_cycles(dt),
+            'unreachable_components': unreachable,
+            'unmatched_classes': find_unmatched_classes(dt),
+            'multiple_outgoing_edges': find_multiple_outgoing_edges(dt),
+            'paths': paths}
@@ -1,15 +1,53 @@
-from flask import Flask, request
+from flask import Flask, Response, g, request, stream_with_context
 from flask_cors import CORS, cross_origin
+from analysis import analyze_dialogue_tree
 from helpers import *
+from llm import completion_cache, prompt_token_stats
 from models import *
+from sessions import SessionConflict, session_store
 from validation import *
+import json
 
 
 app = Flask(__name__)
-cors = CORS(app)
+cors = CORS(app, expose_headers=['ETag'])
 app.config['CORS_HEADERS'] = 'Content-Type'
 
 
+@app.before_request
+def check_if_match():
+    # reject requests whose If-Match header names an outdated dialogue tree version
+    dt_id = (request.view_args or {}).get('dt_id')
+    if dt_id is None or not request.if_match or not validate_dialogue_exists(dt_id):
+        return None
+    # the tree may be deleted between the existence check and the load
+    try:
+        dt = load_dialogue(dt_id)
+    except FileNotFoundError:
+        return failure_response(404, 'provided dialogue tree does not exist')
+    if not request.if_match.contains(str(dt.version)):
+        return failure_response(409, 'provided dialogue tree version is outdated')
+    return None
+
+
+@app.after_request
+def add_version_etag(response):
+    # tag successful responses with the version of the dialogue tree they used
+    if response.status_code < 300 and g.get('dt') is not None and g.dt.version is not None:
+        response.set_etag(str(g.dt.version))
+    return response
+
+
+@app.errorhandler(VersionConflict)
+def version_conflict(e):
+    return failure_response(409, 'dialogue tree was modified by another request')
+
+
+@app.errorhandler(SessionConflict)
+def session_conflict(e):
+    return failure_response(409, 'session has expired or was modified by another request')
+
+
 @app.route('/dialogue', methods=['POST'])
 def create_dialogue():
     request_data = request.get_json(silent=True)
@@ -22,6 +60,7 @@ def create_dialogue():
     # create new dialogue tree
     dt = DialogueTree(name)
     dt.save()
+    g.dt = dt
     return success_response(201, {'id': dt.id})
 
 
@@ -31,18 +70,37 @@ def get_dialogue(dt_id):
     if error_msg is not None:
         return failure_response(status_code, error_msg)
 
-    # return JSON representation of dialogue tree
-    dt = DialogueTree.load(dt_id)
+    # return JSON representation of dialogue tree, unless the client's copy is current
+    dt = load_dialogue(dt_id)
+    if is_not_modified(dt):
+        return not_modified_response(dt)
     return success_response(200, dt.to_json())
 
 
+@app.route('/dialogue/<dt_id>/analysis', methods=['GET'])
+def get_dialogue_analysis(dt_id):
+    start_id = request.args.get('start')
+    error_msg, status_code = validate_get_dialogue_analysis(dt_id, start_id)
+    if error_msg is not None:
+        return failure_response(status_code, error_msg)
+
+    # return static analysis of dialogue tree for chats starting at the start
+    # component, or at its entry components if none is given, unless the client's
+    # copy is current
+    dt = load_dialogue(dt_id)
+    if is_not_modified(dt):
+        return not_modified_response(dt)
+    start = None if start_id is None else dt.get_component(start_id)
+    return success_response(200, analyze_dialogue_tree(dt, start))
+
+
 @app.route('/dialogue/<dt_id>', methods=['DELETE'])
 def delete_dialogue(dt_id):
     if not validate_dialogue_exists(dt_id):
         return failure_response(404, 'provided dialogue tree does not exist')
     
     # delete dialogue tree
-    DialogueTree.load(dt_id).delete()
+    load_dialogue(dt_id).delete()
     return success_response(200)
 
 
@@ -56,8 +114,8 @@ def edit_dialogue_name(dt_id):
     name = request_data['name']
 
     # edit dialogue tree name
-    dt = DialogueTree.load(dt_id)
-    dt.name = name
+    dt = load_dialogue_for_update(dt_id)
+    dt.edit_name(name)
     dt.save()
     return success_response(200)
 
@@ -73,7 +131,7 @@ def add_dialogue_edge(dt_id):
     end_id = request_data['end']
 
     # add edge to dialogue tree
-    dt = DialogueTree.load(dt_id)
+    dt = load_dialogue_for_update(dt_id)
     dt.add_edge(start_id, end_id)
     dt.save()
     return success_response(201)
@@ -90,7 +148,7 @@ def delete_dialogue_edge(dt_id):
     end_id = request_data['end']
 
     # delete edge from dialogue tree
-    dt = DialogueTree.load(dt_id)
+    dt = load_dialogue_for_update(dt_id)
     dt.delete_edge(start_id, end_id)
     dt.save()
     return success_response(200)
@@ -106,7 +164,7 @@ def add_generation(dt_id):
     name = request_data['name']
 
     # add generation component to dialogue tree
-    dt = DialogueTree.load(dt_id)
+    dt = load_dialogue_for_update(dt_id)
     gc_id = dt.add_component('gc', name)
     dt.save()
     return success_response(201, {'id': gc_id})
@@ -118,9 +176,11 @@ def get_generation(dt_id, gc_id):
     if error_msg is not None:
         return failure_response(status_code, error_msg)
 
-    # return JSON representation of generation component
-    gc = DialogueTree.load(dt_id).get_component(gc_id)
-    return success_response(200, gc.to_json())
+    # return JSON representation of generation component, unless the client's copy is current
+    dt = load_dialogue(dt_id)
+    if is_not_modified(dt):
+        return not_modified_response(dt)
+    return success_response(200, dt.get_component(gc_id).to_json())
 
 
 @app.route('/dialogue/<dt_id>/generation/<gc_id>', methods=['DELETE'])
@@ -130,7 +190,7 @@ def delete_generation(dt_id, gc_id):
         return failure_response(status_code, error_msg)
 
     # delete generation component from dialogue tree
-    dt = DialogueTree.load(dt_id)
+    dt = load_dialogue_for_update(dt_id)
     dt.delete_component(gc_id)
     dt.save()
     return success_response(200)
@@ -146,8 +206,8 @@ def edit_generation_name(dt_id, gc_id):
     name = request_data['name']
 
     # edit generation component name
-    dt = DialogueTree.load(dt_id)
-    dt.get_component(gc_id).name = name
+    dt = load_dialogue_for_update(dt_id)
+    dt.edit_component_name(gc_id, name)
     dt.save()
     return success_response(200)
 
@@ -162,14 +222,27 @@ def edit_generation_class(dt_id, gc_id):
     gen_class = request_data['class']
 
     # edit generation component class
-    dt = DialogueTree.load(dt_id)
-    gc = dt.get_component(gc_id)
-    status_code = 201 if gc.gen_class == '' else 200
-    gc.gen_class = gen_class
+    dt = load_dialogue_for_update(dt_id)
+    status_code = 201 if dt.get_component(gc_id).gen_class == '' else 200
+    dt.edit_generation_class(gc_id, gen_class)
     dt.save()
     return success_response(status_code)
 
 
+@app.route('/dialogue/<dt_id>/generation/<gc_id>/budget', methods=['PUT'])
+def edit_generation_budget(dt_id, gc_id):
+    request_data = request.get_json(silent=True)
+    error_msg, status_code = validate_edit_generation_budget(dt_id, gc_id, request_data)
+    if error_msg is not None:
+        return failure_response(status_code, error_msg)
+
+    # edit generation component prompt budget settings that were provided
+    dt = load_dialogue_for_update(dt_id)
+    dt.edit_generation_budget(gc_id, request_data)
+    dt.save()
+    return success_response(200, {'budget': dt.get_component(gc_id).budget})
+
+
 @app.route('/dialogue/<dt_id>/generation/<gc_id>/example', methods=['POST'])
 def add_generation_example(dt_id, gc_id):
     request_data = request.get_json(silent=True)
@@ -181,8 +254,8 @@ def add_generation_example(dt_id, gc_id):
     response = request_data['response']
 
     # add example to generation component
-    dt = DialogueTree.load(dt_id)
-    ex_id = dt.get_component(gc_id).add_example(context, response)
+    dt = load_dialogue_for_update(dt_id)
+    ex_id = dt.add_generation_example(gc_id, context, response)
     dt.save()
     return success_response(201, {'id': ex_id})
 
@@ -194,8 +267,8 @@ def delete_generation_example(dt_id, gc_id, ex_id):
         return failure_response(status_code, error_msg)
     
     # delete example from generation component
-    dt = DialogueTree.load(dt_id)
-    dt.get_component(gc_id).delete_example(ex_id)
+    dt = load_dialogue_for_update(dt_id)
+    dt.delete_generation_example(gc_id, ex_id)
     dt.save()
     return success_response(200)
 
@@ -211,8 +284,8 @@ def edit_generation_example(dt_id, gc_id, ex_id):
     response = request_data.get('response')
 
     # edit generation component example
-    dt = DialogueTree.load(dt_id)
-    dt.get_component(gc_id).get_example(ex_id).edit_example(context, response)
+    dt = load_dialogue_for_update(dt_id)
+    dt.edit_generation_example(gc_id, ex_id, context, response)
     dt.save()
     return success_response(200)
 
@@ -224,7 +297,7 @@ def copy_generation(dt_id, gc_id):
         return failure_response(status_code, error_msg)
 
     # copy generation component and return copy's id
-    dt = DialogueTree.load(dt_id)
+    dt = load_dialogue_for_update(dt_id)
     gc_copy_id = dt.copy_component('gc', gc_id)
     dt.save()
     return success_response(201, {'id': gc_copy_id})
@@ -240,7 +313,7 @@ def add_detection(dt_id):
     name = request_data['name']
 
     # add detection component to dialogue tree
-    dt = DialogueTree.load(dt_id)
+    dt = load_dialogue_for_update(dt_id)
     dc_id = dt.add_component('dc', name)
     dt.save()
     return success_response(201, {'id': dc_id})
@@ -252,9 +325,11 @@ def get_detection(dt_id, dc_id):
     if error_msg is not None:
         return failure_response(status_code, error_msg)
 
-    # return JSON representation of detection component
-    dc = DialogueTree.load(dt_id).get_component(dc_id)
-    return success_response(200, dc.to_json())
+    # return JSON representation of detection component, unless the client's copy is current
+    dt = load_dialogue(dt_id)
+    if is_not_modified(dt):
+        return not_modified_response(dt)
+    return success_response(200, dt.get_component(dc_id).to_json())
 
 
 @app.route('/dialogue/<dt_id>/detection/<dc_id>', methods=['DELETE'])
@@ -264,7 +339,7 @@ def delete_detection(dt_id, dc_id):
         return failure_response(status_code, error_msg)
 
     # delete detection component from dialogue tree
-    dt = DialogueTree.load(dt_id)
+    dt = load_dialogue_for_update(dt_id)
     dt.delete_component(dc_id)
     dt.save()
     return success_response(200)
@@ -280,8 +355,8 @@ def edit_detection_name(dt_id, dc_id):
     name = request_data['name']
 
     # edit detection component name
-    dt = DialogueTree.load(dt_id)
-    dt.get_component(dc_id).name = name
+    dt = load_dialogue_for_update(dt_id)
+    dt.edit_component_name(dc_id, name)
     dt.save()
     return success_response(200)
 
@@ -296,8 +371,8 @@ def add_detection_class(dt_id, dc_id):
     det_class = request_data['class']
 
     # add class to detection component
-    dt = DialogueTree.load(dt_id)
-    cls_id = dt.get_component(dc_id).add_class(det_class)
+    dt = load_dialogue_for_update(dt_id)
+    cls_id = dt.add_detection_class(dc_id, det_class)
     dt.save()
     return success_response(201, {'id': cls_id})
 
@@ -308,9 +383,11 @@ def get_detection_class(dt_id, dc_id, cls_id):
     if error_msg is not None:
         return failure_response(status_code, error_msg)
 
-    # return JSON representation of detection class
-    cls = DialogueTree.load(dt_id).get_component(dc_id).get_class(cls_id)
-    return success_response(200, cls.to_json())
+    # return JSON representation of detection class, unless the client's copy is current
+    dt = load_dialogue(dt_id)
+    if is_not_modified(dt):
+        return not_modified_response(dt)
+    return success_response(200, dt.get_component(dc_id).get_class(cls_id).to_json())
 
 
 @app.route('/dialogue/<dt_id>/detection/<dc_id>/class/<cls_id>', methods=['DELETE'])
@@ -320,8 +397,8 @@ def delete_detection_class(dt_id, dc_id, cls_id):
         return failure_response(status_code, error_msg)
     
     # delete class from detection component
-    dt = DialogueTree.load(dt_id)
-    dt.get_component(dc_id).delete_class(cls_id)
+    dt = load_dialogue_for_update(dt_id)
+    dt.delete_detection_class(dc_id, cls_id)
     dt.save()
     return success_response(200)
 
@@ -336,8 +413,8 @@ def edit_detection_class_name(dt_id, dc_id, cls_id):
     det_class = request_data['class']
 
     # edit detection class name
-    dt = DialogueTree.load(dt_id)
-    dt.get_component(dc_id).get_class(cls_id).det_class = det_class
+    dt = load_dialogue_for_update(dt_id)
+    dt.edit_detection_class_name(dc_id, cls_id, det_class)
     dt.save()
     return success_response(200)
 
@@ -352,8 +429,8 @@ def add_detection_class_example(dt_id, dc_id, cls_id):
     example = request_data['example']
 
     # add example to detection class
-    dt = DialogueTree.load(dt_id)
-    ex_id = dt.get_component(dc_id).get_class(cls_id).add_example(example)
+    dt = load_dialogue_for_update(dt_id)
+    ex_id = dt.add_detection_example(dc_id, cls_id, example)
     dt.save()
     return success_response(201, {'id': ex_id})
 
@@ -365,8 +442,8 @@ def delete_detection_class_example(dt_id, dc_id, cls_id, ex_id):
         return failure_response(status_code, error_msg)
     
     # delete example from detection class
-    dt = DialogueTree.load(dt_id)
-    dt.get_component(dc_id).get_class(cls_id).delete_example(ex_id)
+    dt = load_dialogue_for_update(dt_id)
+    dt.delete_detection_example(dc_id, cls_id, ex_id)
     dt.save()
     return success_response(200)
 
@@ -381,8 +458,8 @@ def edit_detection_class_example(dt_id, dc_id, cls_id, ex_id):
     example = request_data['example']
 
     # edit detection class example
-    dt = DialogueTree.load(dt_id)
-    dt.get_component(dc_id).get_class(cls_id).get_example(ex_id).example = example
+    dt = load_dialogue_for_update(dt_id)
+    dt.edit_detection_example(dc_id, cls_id, ex_id, example)
     dt.save()
     return success_response(200)
 
@@ -394,7 +471,7 @@ def copy_detection(dt_id, dc_id):
         return failure_response(status_code, error_msg)
 
     # copy detection component and return copy's id
-    dt = DialogueTree.load(dt_id)
+    dt = load_dialogue_for_update(dt_id)
     dc_copy_id = dt.copy_component('dc', dc_id)
     dt.save()
     return success_response(201, {'id': dc_copy_id})
@@ -407,14 +484,73 @@ def prompt_generation_component(dt_id, gc_id):
     if error_msg is not None:
         return failure_response(status_code, error_msg)
     
-    messages = request_data['messages']
+    session = load_session(dt_id, request_data['session']) if 'session' in request_data.keys() else None
+    messages = session_prompt_messages(session, request_data) if session is not None else request_data['messages']
     
-    # generate response to most recent message
-    gc = DialogueTree.load(dt_id).get_component(gc_id)
+    # generate response to most recent message, adding the student message and the
+    # response to the session if one was given
+    gc = load_dialogue(dt_id).get_component(gc_id)
     response = perform_generation(gc, messages)
+    if session is not None:
+        messages.append({'role': 'chatbot', 'message': response})
+        append_session_messages(session, messages, session.component_id)
     return success_response(200, {'response': response})
 
 
+@app.route('/dialogue/<dt_id>/generation/<gc_id>/prompt/stream', methods=['POST'])
+def prompt_generation_component_stream(dt_id, gc_id):
+    request_data = request.get_json(silent=True)
+    error_msg, status_code = validate_prompt_generation_component(dt_id, gc_id, request_data)
+    if error_msg is not None:
+        return failure_response(status_code, error_msg)
+
+    session = load_session(dt_id, request_data['session']) if 'session' in request_data.keys() else None
+    messages = session_prompt_messages(session, request_data) if session is not None else request_data['messages']
+
+    # generate response to most recent message, sending each piece as soon as GPT
+    # produces it and then the full response, which is added to the session along
+    # with the student message if a session was given
+    gc = load_dialogue(dt_id).get_component(gc_id)
+
+    def events():
+        pieces = []
+        try:
+            for piece in perform_generation_stream(gc, messages):
+                pieces.append(piece)
+                yield sse_event('token', {'token': piece})
+            if session is not None:
+                messages.append({'role': 'chatbot', 'message': ''.join(pieces)})
+                append_session_messages(session, messages, session.component_id)
+        except Exception as e:
+            yield sse_event('error', {'error_message': str(e)})
+            return
+        yield sse_event('response', {'response': ''.join(pieces)})
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/dialogue/<dt_id>/generation/<gc_id>/prompt/batch', methods=['POST'])
+def prompt_generation_component_batch(dt_id, gc_id):
+    request_data = request.get_json(silent=True)
+    error_msg, status_code = validate_prompt_generation_component_batch(dt_id, gc_id, request_data)
+    if error_msg is not None:
+        return failure_response(status_code, error_msg)
+
+    conversations = request_data['conversations']
+
+    # generate a response to the most recent message of every conversation, sending
+    # each result as a line of JSON as soon as it completes
+    gc = load_dialogue(dt_id).get_component(gc_id)
+
+    def results():
+        for result in perform_batch_generation(gc, conversations):
+            yield json.dumps(result) + '\n'
+
+    return Response(stream_with_context(results()), mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @app.route('/dialogue/<dt_id>/detection/<dc_id>/prompt', methods=['POST'])
 def prompt_detection_component(dt_id, dc_id):
     request_data = request.get_json(silent=True)
@@ -422,14 +558,33 @@ def prompt_detection_component(dt_id, dc_id):
     if error_msg is not None:
         return failure_response(status_code, error_msg)
 
-    messages = request_data['messages']
+    session = load_session(dt_id, request_data['session']) if 'session' in request_data.keys() else None
+    messages = session_prompt_messages(session, request_data) if session is not None else request_data['messages']
 
-    # classify most recent message, which should be from the student
-    dc = DialogueTree.load(dt_id).get_component(dc_id)
+    # classify most recent message, which should be from the student, adding it to
+    # the session if one was given
+    dc = load_dialogue(dt_id).get_component(dc_id)
     response = perform_detection(dc, messages)
+    if session is not None:
+        append_session_messages(session, messages, session.component_id)
     return success_response(200, {'response': response})
 
 
+@app.route('/dialogue/<dt_id>/detection/<dc_id>/prompt/batch', methods=['POST'])
+def prompt_detection_component_batch(dt_id, dc_id):
+    request_data = request.get_json(silent=True)
+    error_msg, status_code = validate_prompt_detection_component_batch(dt_id, dc_id, request_data)
+    if error_msg is not None:
+        return failure_response(status_code, error_msg)
+
+    messages = request_data['messages']
+
+    # classify every message, which should be from students
+    dc = load_dialogue(dt_id).get_component(dc_id)
+    results = perform_batch_detection(dc, messages)
+    return success_response(200, {'results': results})
+
+
 @app.route('/dialogue/<dt_id>/chat/<c_id>', methods=['POST'])
 def chat(dt_id, c_id):
     request_data = request.get_json(silent=True)
@@ -441,13 +596,140 @@ def chat(dt_id, c_id):
 
     # traverse dialogue tree from component c to the next detection component
     # return next detection component's id and generation component outputs
-    c = DialogueTree.load(dt_id).get_component(c_id)
+    dt = load_dialogue(dt_id)
+    c = dt.get_component(c_id)
     try:
-        responses, next_id = traverse_dialogue_tree(c, messages)
+        responses, next_id = traverse_dialogue_tree(dt, c, messages)
         return success_response(200, {'responses': responses, 'next_id': next_id})
     except Exception as e:
         return failure_response(400, e.args[0])
 
 
+@app.route('/dialogue/<dt_id>/chat/<c_id>/stream', methods=['POST'])
+def chat_stream(dt_id, c_id):
+    request_data = request.get_json(silent=True)
+    error_msg, status_code = validate_chat(dt_id, c_id, request_data)
+    if error_msg is not None:
+        return failure_response(status_code, error_msg)
+
+    messages = request_data['messages']
+
+    # traverse dialogue tree from component c to the next detection component,
+    # sending each generation component output as soon as it is generated and
+    # then the next detection component's id
+    dt = load_dialogue(dt_id)
+    c = dt.get_component(c_id)
+
+    def events():
+        try:
+            for event, data in walk_dialogue_tree(dt, c, messages):
+                yield sse_event(event, {event: data})
+        except Exception as e:
+            yield sse_event('error', {'error_message': str(e)})
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/dialogue/<dt_id>/session', methods=['POST'])
+def create_session(dt_id):
+    request_data = request.get_json(silent=True)
+    error_msg, status_code = validate_create_session(dt_id, request_data)
+    if error_msg is not None:
+        return failure_response(status_code, error_msg)
+
+    start_id = request_data['start']
+    messages = request_data.get('messages', [])
+
+    # create chat session that sends the next student message to the start component
+    session = session_store.create(dt_id, start_id, messages)
+    return success_response(201, session.to_json())
+
+
+@app.route('/dialogue/<dt_id>/session/<s_id>', methods=['GET'])
+def get_session(dt_id, s_id):
+    error_msg, status_code = validate_get_session(dt_id, s_id)
+    if error_msg is not None:
+        return failure_response(status_code, error_msg)
+
+    # return JSON representation of chat session
+    return success_response(200, load_session(dt_id, s_id).to_json())
+
+
+@app.route('/dialogue/<dt_id>/session/<s_id>', methods=['DELETE'])
+def delete_session(dt_id, s_id):
+    error_msg, status_code = validate_get_session(dt_id, s_id)
+    if error_msg is not None:
+        return failure_response(status_code, error_msg)
+
+    # delete chat session
+    session_store.delete(s_id)
+    return success_response(200)
+
+
+@app.route('/dialogue/<dt_id>/session/<s_id>/chat', methods=['POST'])
+def session_chat(dt_id, s_id):
+    request_data = request.get_json(silent=True)
+    error_msg, status_code = validate_session_chat(dt_id, s_id, request_data)
+    if error_msg is not None:
+        return failure_response(status_code, error_msg)
+
+    session = load_session(dt_id, s_id)
+    messages = session_prompt_messages(session, request_data)
+
+    # traverse dialogue tree from the session's component to the next detection
+    # component, then add the student message and generation component outputs to
+    # the session and move it to the next detection component
+    dt = load_dialogue(dt_id)
+    c = dt.get_component(session.component_id)
+    try:
+        responses, next_id = traverse_dialogue_tree(dt, c, messages)
+    except Exception as e:
+        return failure_response(400, e.args[0])
+    append_session_messages(session, messages, next_id)
+    return success_response(200, {'responses': responses, 'next_id': next_id})
+
+
+@app.route('/dialogue/<dt_id>/session/<s_id>/chat/stream', methods=['POST'])
+def session_chat_stream(dt_id, s_id):
+    request_data = request.get_json(silent=True)
+    error_msg, status_code = validate_session_chat(dt_id, s_id, request_data)
+    if error_msg is not None:
+        return failure_response(status_code, error_msg)
+
+    session = load_session(dt_id, s_id)
+    messages = session_prompt_messages(session, request_data)
+
+    # traverse dialogue tree from the session's component to the next detection
+    # component, sending each generation component output as soon as it is
+    # generated, and update the session before sending the next component's id
+    dt = load_dialogue(dt_id)
+    c = dt.get_component(session.component_id)
+
+    def events():
+        try:
+            for event, data in walk_dialogue_tree(dt, c, messages):
+                if event == 'next_id':
+                    append_session_messages(session, messages, data)
+                yield sse_event(event, {event: data})
+        except SessionConflict:
+            yield sse_event('error', {'error_message': 'session has expired or was modified by another request'})
+        except Exception as e:
+            yield sse_event('error', {'error_message': str(e)})
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    # report tree and completion cache hit ratios, local detection hit ratio and
+    # generation prompt token counts
+    return success_response(200, {'tree_cache': tree_cache.stats(),
+                                  'completion_cache': completion_cache.stats(),
+                                  'local_classifier': detection_stats.stats(),
+                                  'prompt_tokens': prompt_token_stats.stats()})
+
+
 if __name__ == '__main__':
     app.run(port=8000)
\ No newline at end of file
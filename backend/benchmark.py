@@ -0,0 +1,33 @@
+import argparse
+import importlib
+
+
+# Each benchmark is a module of the benchmarks package with a run function, which can
+# also be run on its own with python -m benchmarks.{name}
+BENCHMARKS = [
+    'loads',
+    'exists',
+    'polling',
+    'lookups',
+    'prompts',
+    'completions',
+    'llm_client',
+    'chat_stream',
+    'generation_stream',
+    'speculation',
+    'local_detection',
+    'batch_detection',
+    'batch_generation',
+    'example_selection',
+    'prompt_budget',
+    'sessions',
+    'routing',
+    'analysis',
+]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run backend micro-benchmarks')
+    parser.add_argument('benchmark', choices=BENCHMARKS)
+    args = parser.parse_args()
+    importlib.import_module(f'benchmarks.{args.benchmark}').run()
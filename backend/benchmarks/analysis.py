@@ -0,0 +1,36 @@
+import timeit
+from models import *
+
+
+# Time the static analysis of a tree with 100 detection components, each routing five
+# classes to a chain of four generation components that leads to the next one,
+# compiling the routing plan every time
+def run():
+    from analysis import analyze_dialogue_tree
+    dt = DialogueTree('bench', 'dt-bench')
+    dc_ids = [dt.add_component('dc', f'dc {i}') for i in range(100)]
+    for i, dc_id in enumerate(dc_ids):
+        for j in range(5):
+            dt.add_detection_class(dc_id, f'class {j}')
+            dt.add_detection_example(dc_id, f'cls-{j}', f'example of class {j}')
+            previous_id = dc_id
+            for k in range(4):
+                gc_id = dt.add_component('gc', f'gc {i} {j} {k}')
+                dt.add_generation_example(gc_id, 'context', 'response')
+                if k == 0:
+                    dt.edit_generation_class(gc_id, f'class {j}')
+                dt.add_edge(previous_id, gc_id)
+                previous_id = gc_id
+            dt.add_edge(previous_id, dc_ids[(i + 1) % len(dc_ids)])
+
+    def analyze():
+        dt.routing_plan = None
+        return analyze_dialogue_tree(dt)
+    analysis = analyze()
+    number = 10
+    seconds = timeit.timeit(analyze, number=number) / number
+    print(f'{len(dt.components)} components, {len(analysis["paths"])} paths analyzed in {seconds * 1e3:.0f} ms')
+
+
+if __name__ == '__main__':
+    run()
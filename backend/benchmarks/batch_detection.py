@@ -0,0 +1,50 @@
+import time
+from benchmarks.common import use_scratch_data
+import helpers
+
+
+# Compare classifying 1,000 messages with one detection prompt request each against
+# one batch request, with GPT calls taking 100 ms plus 5 ms per classified input
+def run():
+    use_scratch_data()
+    calls = {'gpt': 0}
+
+    def slow_gpt(prompt: str, max_tokens: int):
+        calls['gpt'] += 1
+        inputs = [line.split(': ', 1)[1] for line in prompt.split('\n') if line.startswith('Input ')][2:]
+        first = int(prompt.rsplit('Category ', 1)[1].split(':')[0])
+        time.sleep(0.1 + 0.005 * len(inputs))
+        lines = [f'Category {first + i}: class {"a" if "a" in message else "b"}' for i, message in enumerate(inputs)]
+        return lines[0][len(f'Category {first}:'):] + ''.join('\n' + line for line in lines[1:])
+
+    helpers.prompt_gpt_azure = slow_gpt
+    from app import app
+    client = app.test_client()
+    dt_id = client.post('/dialogue', json={'name': 'bench'}).get_json()['data']['id']
+    dc_id = client.post(f'/dialogue/{dt_id}/detection', json={'name': 'dc'}).get_json()['data']['id']
+    for det_class, example in [('class a', 'a'), ('class b', 'b')]:
+        cls_id = client.post(f'/dialogue/{dt_id}/detection/{dc_id}/class', json={'class': det_class}).get_json()['data']['id']
+        client.post(f'/dialogue/{dt_id}/detection/{dc_id}/class/{cls_id}/example', json={'example': example})
+    messages = [f'message {i} {"a" if i % 3 == 0 else "b"}' for i in range(1000)]
+    expected = [f'class {"a" if "a" in message else "b"}' for message in messages]
+
+    # time a sample of single requests, since all 1,000 would take over 100 s
+    calls['gpt'] = 0
+    start = time.perf_counter()
+    for message in messages[:50]:
+        client.post(f'/dialogue/{dt_id}/detection/{dc_id}/prompt',
+                    json={'messages': [{'role': 'student', 'message': message}]})
+    seconds = (time.perf_counter() - start) / 50 * len(messages)
+    print(f'{"single":<6} {seconds:6.2f} s (extrapolated), {calls["gpt"] // 50 * len(messages)} GPT calls')
+
+    calls['gpt'] = 0
+    start = time.perf_counter()
+    results = client.post(f'/dialogue/{dt_id}/detection/{dc_id}/prompt/batch',
+                          json={'messages': messages}).get_json()['data']['results']
+    seconds = time.perf_counter() - start
+    correct = sum(result.get('response') == label for result, label in zip(results, expected))
+    print(f'{"batch":<6} {seconds:6.2f} s, {calls["gpt"]} GPT calls, {correct}/{len(messages)} in order and correct')
+
+
+if __name__ == '__main__':
+    run()
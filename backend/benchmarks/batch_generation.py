@@ -0,0 +1,50 @@
+import json
+import time
+from benchmarks.common import use_scratch_data
+import helpers
+
+
+# Compare replaying 200 conversations through a generation component with one prompt
+# request each against one batch request, with GPT calls taking 50-150 ms and every
+# 50th call hanging past a 1 s item timeout
+def run():
+    import random
+    use_scratch_data()
+
+    def slow_gpt(prompt: str, max_tokens: int):
+        number = int(prompt.rsplit('Context: message ', 1)[1].split('\\')[0])
+        time.sleep(3 if number % 50 == 49 else random.uniform(0.05, 0.15))
+        return f' reply to {number} '
+
+    helpers.prompt_gpt_azure = slow_gpt
+    helpers.BATCH_ITEM_TIMEOUT = 1
+    from app import app
+    client = app.test_client()
+    dt_id = client.post('/dialogue', json={'name': 'bench'}).get_json()['data']['id']
+    gc_id = client.post(f'/dialogue/{dt_id}/generation', json={'name': 'gc'}).get_json()['data']['id']
+    conversations = [[{'role': 'student', 'message': f'message {i}'}] for i in range(200)]
+
+    # time a sample of single requests, leaving out the hanging ones
+    start = time.perf_counter()
+    for messages in conversations[:40]:
+        client.post(f'/dialogue/{dt_id}/generation/{gc_id}/prompt', json={'messages': messages})
+    seconds = (time.perf_counter() - start) / 40 * len(conversations)
+    print(f'{"single":<6} {seconds:5.2f} s (extrapolated, without hanging calls)')
+
+    start = time.perf_counter()
+    response = client.post(f'/dialogue/{dt_id}/generation/{gc_id}/prompt/batch',
+                           json={'conversations': conversations}, buffered=False)
+    first_result, results = None, []
+    for line in response.response:
+        if first_result is None:
+            first_result = time.perf_counter() - start
+        results.append(json.loads(line))
+    seconds = time.perf_counter() - start
+    timed_out = sum(result.get('error_message') == 'generation timed out' for result in results)
+    correct = sum(result.get('response') == f'reply to {result["index"]}' for result in results)
+    print(f'{"batch":<6} {seconds:5.2f} s, first result {first_result * 1e3:.0f} ms, {len(results)} results, '
+          f'{correct} responses, {timed_out} timed out')
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,42 @@
+import time
+from benchmarks.common import use_scratch_data, stub_gpt
+import helpers
+
+
+# Compare time to first chatbot message for /chat and its streaming variant on a
+# chain of one detection and three generation components, with 100 ms GPT calls
+def run():
+    use_scratch_data()
+    stub_gpt()
+    helpers.prompt_gpt_azure = lambda prompt, max_tokens: (time.sleep(0.1), ' class a ')[1]
+    from app import app
+    client = app.test_client()
+
+    dt_id = client.post('/dialogue', json={'name': 'bench'}).get_json()['data']['id']
+    dc_id = client.post(f'/dialogue/{dt_id}/detection', json={'name': 'dc'}).get_json()['data']['id']
+    client.post(f'/dialogue/{dt_id}/detection/{dc_id}/class', json={'class': 'class a'})
+    previous_id = dc_id
+    for i in range(3):
+        gc_id = client.post(f'/dialogue/{dt_id}/generation', json={'name': f'gc {i}'}).get_json()['data']['id']
+        client.put(f'/dialogue/{dt_id}/generation/{gc_id}/class', json={'class': 'class a'})
+        client.post(f'/dialogue/{dt_id}/edge', json={'start': previous_id, 'end': gc_id})
+        previous_id = gc_id
+    messages = {'messages': [{'role': 'student', 'message': 'hello'}]}
+
+    start = time.perf_counter()
+    client.post(f'/dialogue/{dt_id}/chat/{dc_id}', json=messages)
+    print(f'{"chat":<12} first message {(time.perf_counter() - start) * 1e3:.0f} ms, '
+          f'all messages {(time.perf_counter() - start) * 1e3:.0f} ms')
+
+    start = time.perf_counter()
+    response = client.post(f'/dialogue/{dt_id}/chat/{dc_id}/stream', json=messages, buffered=False)
+    first_message = None
+    for chunk in response.response:
+        if first_message is None and chunk.startswith(b'event: response'):
+            first_message = time.perf_counter() - start
+    print(f'{"chat/stream":<12} first message {first_message * 1e3:.0f} ms, '
+          f'all messages {(time.perf_counter() - start) * 1e3:.0f} ms')
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,51 @@
+import os
+import shutil
+import tempfile
+import helpers
+from models import *
+
+
+# Copy the data directory into a temporary working directory so that benchmarks
+# never modify the real dialogue trees
+def use_scratch_data():
+    scratch = tempfile.mkdtemp()
+    if os.path.exists('data'):
+        shutil.copytree('data', os.path.join(scratch, 'data'))
+    else:
+        os.mkdir(os.path.join(scratch, 'data'))
+    os.chdir(scratch)
+    return scratch
+
+
+
+# Replace GPT calls with a canned response so that prompt endpoints can be
+# benchmarked without network access
+def stub_gpt(response: str=' stub '):
+    helpers.prompt_gpt_azure = lambda prompt, max_tokens: response
+
+
+
+# Build an in-memory dialogue tree with num_components components, half generation
+# and half detection, and num_examples examples spread evenly across them
+def build_large_tree(num_components: int, num_examples: int):
+    dt = DialogueTree('bench', 'dt-bench')
+    gc_ids, dc_ids = [], []
+    for i in range(num_components // 2):
+        gc_ids.append(dt.add_component('gc', f'gc {i}'))
+        dc_ids.append(dt.add_component('dc', f'dc {i}'))
+    for dc_id in dc_ids:
+        dt.add_detection_class(dc_id, 'class a')
+        dt.add_detection_class(dc_id, 'class b')
+
+    examples_per_gc = num_examples // 2 // len(gc_ids)
+    examples_per_cls = num_examples // 2 // (2 * len(dc_ids))
+    for gc_id in gc_ids:
+        for i in range(examples_per_gc):
+            dt.add_generation_example(gc_id, f'context {i}', f'response {i}')
+    for dc_id in dc_ids:
+        for cls_id in ['cls-0', 'cls-1']:
+            for i in range(examples_per_cls):
+                dt.add_detection_example(dc_id, cls_id, f'example {i}')
+    dt.changes = []
+    return dt, gc_ids, dc_ids
+
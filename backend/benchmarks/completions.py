@@ -0,0 +1,69 @@
+import os
+import time
+import timeit
+from benchmarks.common import use_scratch_data, build_large_tree
+import helpers
+
+
+# Replay a detection workload where students often send the same replies and count
+# the completion requests that reach the API with the completion cache in front of it
+def run():
+    import llm
+    import openai
+    import random
+    scratch = use_scratch_data()
+    calls = {'api': 0}
+
+    def stub_create(**kwargs):
+        calls['api'] += 1
+        time.sleep(0.001)
+        return {'choices': [{'text': ' class a'}]}
+
+    openai.Completion.create = stub_create
+    dt, _, dc_ids = build_large_tree(2, 200)
+    dc = dt.get_component(dc_ids[0])
+    replies = [f'reply {i}' for i in range(200)]
+    weights = [1 / (i + 1) for i in range(len(replies))]
+    random.seed(0)
+    workload = random.choices(replies, weights, k=5000)
+
+    for label, path in [('memory', ''), ('memory+disk', os.path.join(scratch, 'completions.db'))]:
+        llm.completion_cache = llm.CompletionCache(llm.COMPLETION_CACHE_MAX_ENTRIES, path,
+                                                       llm.COMPLETION_CACHE_TTL, llm.COMPLETION_CACHE_MAX_BYTES,
+                                                       llm.COMPLETION_CACHE_PRUNE_INTERVAL)
+        calls['api'] = 0
+        start = time.perf_counter()
+        for reply in workload:
+            helpers.perform_detection(dc, [{'role': 'student', 'message': reply}])
+        seconds = time.perf_counter() - start
+        stats = llm.completion_cache.stats()
+        print(f'{label:<12} {len(workload)} prompts: {calls["api"]} API calls, hit ratio {stats["hit_ratio"]:.2f}, '
+              f'{seconds / len(workload) * 1e6:.0f} us per prompt')
+
+    # a restarted process starts with an empty memory tier but keeps the disk tier
+    llm.completion_cache = llm.CompletionCache(llm.COMPLETION_CACHE_MAX_ENTRIES, path,
+                                                   llm.COMPLETION_CACHE_TTL, llm.COMPLETION_CACHE_MAX_BYTES,
+                                                   llm.COMPLETION_CACHE_PRUNE_INTERVAL)
+    calls['api'] = 0
+    for reply in workload:
+        helpers.perform_detection(dc, [{'role': 'student', 'message': reply}])
+    stats = llm.completion_cache.stats()
+    print(f'{"restarted":<12} {len(workload)} prompts: {calls["api"]} API calls, '
+          f'disk hits {stats["disk_hits"]}, memory hits {stats["memory_hits"]}')
+
+    # cost of a miss on a disk tier holding 50000 completions, pruning on every put
+    # versus every prune interval
+    for label, interval in [('prune always', 0), ('prune 60 s', 60)]:
+        path = os.path.join(scratch, f'puts-{interval}.db')
+        cache = llm.CompletionCache(0, path, llm.COMPLETION_CACHE_TTL, llm.COMPLETION_CACHE_MAX_BYTES, interval)
+        with cache.connection() as conn:
+            conn.executemany('INSERT INTO completions (key, completion, size, created, used) VALUES (?, ?, ?, ?, ?)',
+                             [(f'key {i}', 'completion', 20, time.time(), time.time()) for i in range(50000)])
+        cache.put('engine', 'warm up', 16, 'completion')
+        number = 500
+        seconds = timeit.timeit(lambda: cache.put('engine', f'prompt {random.random()}', 16, 'completion'), number=number)
+        print(f'{label:<12} {seconds / number * 1e6:.0f} us per put')
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,74 @@
+import time
+import timeit
+from benchmarks.common import use_scratch_data, stub_gpt
+import helpers
+from models import *
+
+
+# Compare prompt length and construction time with every example against the top 5
+# most similar examples, on a generation component and a detection component with
+# 2,000 examples each, and time incremental index updates against a rebuild
+def run():
+    import classifier
+    import random
+    stub_gpt()
+    random.seed(0)
+    words = ['bully', 'mean', 'kind', 'stop', 'lunch', 'game', 'you', 'are', 'not', 'cool', 'help', 'friend',
+             'post', 'comment', 'ignore', 'report', 'teacher', 'laugh', 'sorry', 'online']
+    sentence = lambda: ' '.join(random.choice(words) for _ in range(8))
+    dt = DialogueTree('bench', 'dt-bench')
+    gc_id = dt.add_component('gc', 'gc')
+    dc_id = dt.add_component('dc', 'dc')
+    cls_ids = [dt.add_detection_class(dc_id, 'class a'), dt.add_detection_class(dc_id, 'class b')]
+    for i in range(2000):
+        dt.add_generation_example(gc_id, sentence(), sentence())
+        dt.add_detection_example(dc_id, cls_ids[i % 2], sentence())
+    gc, dc = dt.get_component(gc_id), dt.get_component(dc_id)
+    messages = [{'role': 'student', 'message': sentence()}]
+
+    for k in [0, 5]:
+        helpers.EXAMPLE_SELECTION_K = k
+        for name, component, build in [('generation', gc, lambda: helpers.generation_prompt(gc, messages)),
+                                       ('detection', dc, lambda: helpers.select_detection_prompt_prefix(dc, messages[0]['message']))]:
+            build()
+            number = 200
+            seconds = timeit.timeit(build, number=number) / number
+            prompt = build()
+            length = len(prompt if isinstance(prompt, str) else prompt[0])
+            print(f'k={k:<2} {name:<10} prompt {length:>7} chars, built in {seconds * 1e3:6.2f} ms')
+
+    number = 200
+    incremental = timeit.timeit(lambda: dt.edit_generation_example(gc_id, 'ex-7', sentence(), None), number=number) / number
+    rebuild = timeit.timeit(lambda: classifier.ExampleIndex([(example.id, example.context) for example in gc.examples]),
+                            number=5) / 5
+    print(f'index update on example edit {incremental * 1e3:.3f} ms, full rebuild {rebuild * 1e3:.0f} ms')
+
+    # edit an example through the API, which saves a copy of the tree, then prompt
+    # the component, counting full index builds
+    use_scratch_data()
+    from app import app
+    client = app.test_client()
+    helpers.EXAMPLE_SELECTION_K = 5
+    dt.save()
+    builds = {'count': 0}
+    build_index = helpers.ExampleIndex
+
+    def counting_index(examples: list=None):
+        builds['count'] += 1
+        return build_index(examples)
+
+    helpers.ExampleIndex = counting_index
+    url = f'/dialogue/{dt.id}/generation/{gc_id}'
+    client.post(f'{url}/prompt', json={'messages': messages})
+    number = 50
+    start = time.perf_counter()
+    for _ in range(number):
+        client.put(f'{url}/example/ex-7', json={'context': sentence()})
+        client.post(f'{url}/prompt', json={'messages': messages})
+    seconds = (time.perf_counter() - start) / number
+    print(f'API example edit and prompt {seconds * 1e3:.1f} ms, {builds["count"]} index builds for {number + 1} prompts')
+    helpers.ExampleIndex = build_index
+
+
+if __name__ == '__main__':
+    run()
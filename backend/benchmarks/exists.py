@@ -0,0 +1,23 @@
+import os
+import timeit
+from benchmarks.common import use_scratch_data
+from models import *
+
+
+# Compare the directory listing existence check with DialogueTree.exists at
+# increasing numbers of stored dialogue trees
+def run():
+    use_scratch_data()
+    for num_trees in [10000, 100000]:
+        for i in range(len(os.listdir('data')), num_trees):
+            open(f'data/dt-{i}.pkl', 'wb').close()
+
+        ids = [f'dt-{num_trees // 2}', f'dt-{num_trees - 1}', 'dt-missing']
+        listdir_time = timeit.timeit(lambda: [f'{id}.pkl' in os.listdir('data') for id in ids], number=20) / (20 * len(ids))
+        exists_time = timeit.timeit(lambda: [DialogueTree.exists(id) for id in ids], number=20000) / (20000 * len(ids))
+        print(f'{num_trees} trees: listdir {listdir_time * 1e6:.1f} us, exists {exists_time * 1e6:.2f} us '
+              f'({listdir_time / exists_time:.0f}x faster)')
+
+
+if __name__ == '__main__':
+    run()
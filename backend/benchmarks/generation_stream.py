@@ -0,0 +1,45 @@
+import json
+import time
+from benchmarks.common import use_scratch_data
+from conftest import start_stub_llm_server
+import helpers
+
+
+# Compare time to first token and to the full response for a generation prompt
+# and its streaming variant, against a local stub server producing 20 tokens
+# 20 ms apart
+def run():
+    import llm
+    use_scratch_data()
+    tokens = [' Good'] + [' point'] * 18 + ['.\n']
+    server, url = start_stub_llm_server(tokens, 0.02)
+    llm.completion_cache = llm.CompletionCache(0, '', 0, 0, 0)
+    helpers.azure_client = llm.LLMClient('gpt3_davinci', 'key', url, 'azure', '2022-12-01')
+    from app import app
+    client = app.test_client()
+
+    dt_id = client.post('/dialogue', json={'name': 'bench'}).get_json()['data']['id']
+    gc_id = client.post(f'/dialogue/{dt_id}/generation', json={'name': 'gc'}).get_json()['data']['id']
+    messages = {'messages': [{'role': 'student', 'message': 'hello'}]}
+
+    start = time.perf_counter()
+    expected = client.post(f'/dialogue/{dt_id}/generation/{gc_id}/prompt', json=messages).get_json()['data']['response']
+    seconds = time.perf_counter() - start
+    print(f'{"prompt":<14} first token {seconds * 1e3:4.0f} ms, full response {seconds * 1e3:4.0f} ms')
+
+    start = time.perf_counter()
+    response = client.post(f'/dialogue/{dt_id}/generation/{gc_id}/prompt/stream', json=messages, buffered=False)
+    first_token, events = None, []
+    for data in response.response:
+        if first_token is None:
+            first_token = time.perf_counter() - start
+        events.append(data.decode('utf-8'))
+    seconds = time.perf_counter() - start
+    streamed = json.loads(events[-1].split('data: ', 1)[1])['response']
+    print(f'{"prompt/stream":<14} first token {first_token * 1e3:4.0f} ms, full response {seconds * 1e3:4.0f} ms, '
+          f'{len(events) - 1} token events, matches prompt: {streamed == expected}')
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    run()
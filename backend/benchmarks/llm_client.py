@@ -0,0 +1,61 @@
+import os
+import time
+from conftest import start_stub_llm_server
+
+
+# Measure per-call overhead of completion requests, excluding model time, against
+# a local stub server: the previous per-call configuration (load_dotenv and openai
+# module globals) versus the shared LLMClient and its connection pool
+def run():
+    from concurrent.futures import ThreadPoolExecutor
+    from dotenv import load_dotenv
+    import llm
+    import openai
+    server, url = start_stub_llm_server()
+    llm.completion_cache = llm.CompletionCache(0, '', 0, 0, 0)
+    pooled_session = openai.requestssession
+
+    def legacy_prompt(prompt: str, max_tokens: int):
+        load_dotenv()
+        openai.api_key = os.getenv('API_KEY_AZURE', 'key')
+        openai.api_base = url
+        openai.api_type = 'azure'
+        openai.api_version = '2022-12-01'
+        response = openai.Completion.create(engine='gpt3_davinci', prompt=prompt, temperature=0, max_tokens=max_tokens)
+        return response['choices'][0]['text']
+
+    client = llm.LLMClient('gpt3_davinci', 'key', url, 'azure', '2022-12-01')
+    for label, session, prompt in [('per-call config', None, legacy_prompt),
+                                   ('LLMClient', pooled_session, client.complete)]:
+        openai.requestssession = session
+        for num_threads in [1, 8]:
+            number = 400
+            server.connections = 0
+            start = time.perf_counter()
+            with ThreadPoolExecutor(num_threads) as pool:
+                list(pool.map(lambda i: prompt(f'prompt {i}', 16), range(number)))
+            seconds = time.perf_counter() - start
+            print(f'{label:<16} {num_threads} threads: {seconds / number * 1e6:6.0f} us per call, '
+                  f'{server.connections} connections opened')
+
+    # openai closes its session once it is MAX_SESSION_LIFETIME_SECS old, so expire it
+    # on every call and compare a plain session with the shared one
+    import openai.api_requestor
+    import requests
+    lifetime = openai.api_requestor.MAX_SESSION_LIFETIME_SECS
+    openai.api_requestor.MAX_SESSION_LIFETIME_SECS = 0
+    plain_session = requests.Session()
+    plain_session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=llm.LLM_POOL_SIZE))
+    for label, session in [('plain session', plain_session), ('SharedSession', pooled_session)]:
+        openai.requestssession = session
+        server.connections = 0
+        for i in range(100):
+            client.complete(f'expired {label} {i}', 16)
+        print(f'{label:<16} session expired every call: {server.connections} connections opened for 100 calls')
+    openai.api_requestor.MAX_SESSION_LIFETIME_SECS = lifetime
+    openai.requestssession = pooled_session
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    run()
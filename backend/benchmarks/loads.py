@@ -0,0 +1,72 @@
+import pickle
+from benchmarks.common import use_scratch_data, stub_gpt
+from models import *
+
+
+# Count DialogueTree.load calls and pickle deserializations made by each endpoint
+def run():
+    use_scratch_data()
+    stub_gpt()
+    from app import app
+    client = app.test_client()
+
+    counts = {'load': 0, 'unpickle': 0}
+    original_load = DialogueTree.load
+    original_unpickle = pickle.load
+
+    def counting_load(id: str):
+        counts['load'] += 1
+        return original_load(id)
+
+    def counting_unpickle(file, *args, **kwargs):
+        counts['unpickle'] += 1
+        return original_unpickle(file, *args, **kwargs)
+
+    DialogueTree.load = staticmethod(counting_load)
+    pickle.load = counting_unpickle
+
+    # build a small tree to exercise every endpoint against
+    dt_id = client.post('/dialogue', json={'name': 'bench'}).get_json()['data']['id']
+    gc_id = client.post(f'/dialogue/{dt_id}/generation', json={'name': 'gc'}).get_json()['data']['id']
+    dc_id = client.post(f'/dialogue/{dt_id}/detection', json={'name': 'dc'}).get_json()['data']['id']
+    client.put(f'/dialogue/{dt_id}/generation/{gc_id}/class', json={'class': 'stub'})
+    gc_ex_id = client.post(f'/dialogue/{dt_id}/generation/{gc_id}/example',
+                           json={'context': 'c', 'response': 'r'}).get_json()['data']['id']
+    cls_id = client.post(f'/dialogue/{dt_id}/detection/{dc_id}/class', json={'class': 'stub'}).get_json()['data']['id']
+    dc_ex_id = client.post(f'/dialogue/{dt_id}/detection/{dc_id}/class/{cls_id}/example',
+                           json={'example': 'e'}).get_json()['data']['id']
+    client.post(f'/dialogue/{dt_id}/edge', json={'start': dc_id, 'end': gc_id})
+    messages = {'messages': [{'role': 'student', 'message': 'hello'}]}
+
+    requests = [
+        ('GET', f'/dialogue/{dt_id}', None),
+        ('PUT', f'/dialogue/{dt_id}/name', {'name': 'bench'}),
+        ('DELETE', f'/dialogue/{dt_id}/edge', {'start': dc_id, 'end': gc_id}),
+        ('POST', f'/dialogue/{dt_id}/edge', {'start': dc_id, 'end': gc_id}),
+        ('GET', f'/dialogue/{dt_id}/generation/{gc_id}', None),
+        ('PUT', f'/dialogue/{dt_id}/generation/{gc_id}/name', {'name': 'gc'}),
+        ('PUT', f'/dialogue/{dt_id}/generation/{gc_id}/example/{gc_ex_id}', {'context': 'c'}),
+        ('POST', f'/dialogue/{dt_id}/generation/{gc_id}/prompt', messages),
+        ('GET', f'/dialogue/{dt_id}/detection/{dc_id}', None),
+        ('GET', f'/dialogue/{dt_id}/detection/{dc_id}/class/{cls_id}', None),
+        ('PUT', f'/dialogue/{dt_id}/detection/{dc_id}/class/{cls_id}/name', {'class': 'stub'}),
+        ('PUT', f'/dialogue/{dt_id}/detection/{dc_id}/class/{cls_id}/example/{dc_ex_id}', {'example': 'e'}),
+        ('POST', f'/dialogue/{dt_id}/detection/{dc_id}/prompt', messages),
+        ('POST', f'/dialogue/{dt_id}/chat/{dc_id}', messages),
+        ('DELETE', f'/dialogue/{dt_id}/detection/{dc_id}/class/{cls_id}/example/{dc_ex_id}', None),
+        ('DELETE', f'/dialogue/{dt_id}/generation/{gc_id}/example/{gc_ex_id}', None),
+        ('DELETE', f'/dialogue/{dt_id}/detection/{dc_id}/class/{cls_id}', None),
+    ]
+
+    print(f'{"endpoint":<80} {"loads":>6} {"unpickles":>10}')
+    for method, url, body in requests:
+        counts['load'], counts['unpickle'] = 0, 0
+        client.open(url, method=method, json=body)
+        print(f'{method + " " + url:<80} {counts["load"]:>6} {counts["unpickle"]:>10}')
+
+    DialogueTree.load = staticmethod(original_load)
+    pickle.load = original_unpickle
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,64 @@
+import time
+import helpers
+from models import *
+
+
+# Compare detection answered by the local classifier, with GPT as fallback, against
+# GPT alone on held out messages for a three class component, with 100 ms GPT calls
+# that always return the intended class
+def run():
+    import classifier
+    import random
+    examples = {
+        'supportive': ['that is not okay, leave them alone', 'stop being mean to people', 'you should apologize to her',
+                       'nobody deserves to be treated like that', 'i stand with the person you are bullying'],
+        'aggressive': ['shut up you idiot', 'you are such a loser', 'go away nobody likes you',
+                       'i will make you regret this', 'you are stupid and ugly'],
+        'off topic': ['what time is lunch', 'did anyone watch the game last night', 'i like pizza',
+                      'where do i find the homework', 'my dog is cute'],
+    }
+    held_out = {
+        'supportive': ['please be kind to each other', 'leave her alone, that was mean', 'you should not say that to him',
+                       'bullying people is not cool', 'i support you, ignore the haters'],
+        'aggressive': ['you are a stupid loser', 'nobody wants you here, go away', 'shut up, idiot',
+                       'you will regret posting this', 'ugly and dumb, as always'],
+        'off topic': ['when is the homework due', 'the game was great last night', 'what is for lunch today',
+                      'my cat is so cute', 'anyone want pizza'],
+    }
+    random.seed(0)
+    workload = []
+    for _ in range(100):
+        det_class = random.choice(list(held_out.keys()))
+        workload.append((det_class, random.choice(held_out[det_class])))
+    oracle = {}
+
+    def slow_gpt(prompt: str, max_tokens: int):
+        time.sleep(0.1)
+        return ' ' + oracle['class']
+
+    helpers.prompt_gpt_azure = slow_gpt
+    dt = DialogueTree('bench', 'dt-bench')
+    dc_id = dt.add_component('dc', 'dc')
+    for det_class, cls_examples in examples.items():
+        cls_id = dt.add_detection_class(dc_id, det_class)
+        for example in cls_examples:
+            dt.add_detection_example(dc_id, cls_id, example)
+    dc = dt.get_component(dc_id)
+
+    for enabled in [False, True]:
+        helpers.LOCAL_CLASSIFIER = enabled
+        classifier.detection_stats.clear()
+        correct = 0
+        start = time.perf_counter()
+        for det_class, message in workload:
+            oracle['class'] = det_class
+            correct += helpers.perform_detection(dc, [{'role': 'student', 'message': message}]) == det_class
+        seconds = (time.perf_counter() - start) / len(workload)
+        stats = classifier.detection_stats.stats()
+        print(f'{"local+GPT" if enabled else "GPT only":<10} {seconds * 1e3:5.1f} ms per detection, '
+              f'local hit ratio {stats["local_hit_ratio"]:.2f}, accuracy {correct / len(workload):.2f}, '
+              f'local {stats["local_mean_ms"]:.2f} ms, GPT {stats["fallback_mean_ms"]:.0f} ms')
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,31 @@
+import time
+import timeit
+from benchmarks.common import build_large_tree
+from models import *
+
+
+# Time component, class and example lookups on a tree with 5,000 components and
+# 50,000 examples
+def run():
+    start = time.perf_counter()
+    dt, gc_ids, dc_ids = build_large_tree(5000, 50000)
+    print(f'built tree in {time.perf_counter() - start:.2f} s')
+
+    gc, dc = dt.get_component(gc_ids[-1]), dt.get_component(dc_ids[-1])
+    last_gc_example = gc.examples[-1].id
+    cls = dc.get_class('cls-1')
+    last_cls_example = cls.examples[-1].id
+    lookups = [
+        ('DialogueTree.get_component', lambda: dt.get_component(gc_ids[-1])),
+        ('Generation.get_example', lambda: gc.get_example(last_gc_example)),
+        ('Detection.get_class', lambda: dc.get_class('cls-1')),
+        ('DetectionClass.get_example', lambda: cls.get_example(last_cls_example)),
+    ]
+    for name, lookup in lookups:
+        number = 2000
+        seconds = timeit.timeit(lookup, number=number) / number
+        print(f'{name:<28} {seconds * 1e6:8.2f} us')
+
+
+if __name__ == '__main__':
+    run()
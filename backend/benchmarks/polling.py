@@ -0,0 +1,35 @@
+import time
+from benchmarks.common import build_large_tree, use_scratch_data
+
+
+# Compare bytes sent and server CPU time for a polling client that ignores ETags
+# with one that sends If-None-Match on every poll, reading a tree with 20 generation
+# and 20 detection components holding 400 examples
+def run():
+    use_scratch_data()
+    from app import app
+    client = app.test_client()
+
+    dt, gc_ids, dc_ids = build_large_tree(40, 400)
+    dt.save()
+    urls = [f'/dialogue/{dt.id}', f'/dialogue/{dt.id}/generation/{gc_ids[-1]}', f'/dialogue/{dt.id}/detection/{dc_ids[0]}',
+            f'/dialogue/{dt.id}/detection/{dc_ids[0]}/class/cls-0']
+    etags = {url: client.get(url).headers['ETag'] for url in urls}
+    polls = 2000
+
+    for conditional in [False, True]:
+        total_bytes = 0
+        start = time.process_time()
+        for _ in range(polls):
+            for url in urls:
+                headers = {'If-None-Match': etags[url]} if conditional else {}
+                response = client.get(url, headers=headers)
+                total_bytes += len(response.get_data())
+        cpu_time = time.process_time() - start
+        label = 'If-None-Match' if conditional else 'unconditional'
+        print(f'{label:<14} {polls * len(urls)} polls: {total_bytes} body bytes, '
+              f'{cpu_time / (polls * len(urls)) * 1e6:.0f} us CPU per poll')
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,54 @@
+import timeit
+from benchmarks.common import stub_gpt
+import helpers
+from models import *
+
+
+# Compare prompt tokens and construction time as a conversation grows, with an
+# unbounded history, a 10 message window and a 4,000 token budget, which counts UTF-8
+# bytes without tiktoken
+def run():
+    from llm import count_tokens
+    import llm
+    import openai
+    prompt_gpt_azure = helpers.prompt_gpt_azure
+    stub_gpt()
+    dt = DialogueTree('bench', 'dt-bench')
+    gc_id = dt.add_component('gc', 'gc')
+    for i in range(20):
+        dt.add_generation_example(gc_id, f'example context {i}', f'example response {i}')
+    gc = dt.get_component(gc_id)
+
+    for name, budget in [('unbounded', {}), ('window 10', {'max_history_messages': 10}),
+                         ('4k tokens', {'max_prompt_tokens': 4000})]:
+        dt.edit_generation_budget(gc_id, dict(DEFAULT_GENERATION_BUDGET, **budget))
+        for length in [10, 100, 1000]:
+            messages = [{'role': 'student' if i % 2 == 0 else 'bot', 'message': f'message number {i} of the chat'}
+                        for i in range(length)]
+            number = 20
+            seconds = timeit.timeit(lambda: helpers.generation_prompt(gc, messages), number=number) / number
+            tokens = count_tokens(helpers.generation_prompt(gc, messages))
+            print(f'{name:<10} {length:>5} messages: prompt {tokens:>6} tokens, built in {seconds * 1e3:7.2f} ms')
+
+    # a 200 turn conversation with a 10 message window and the messages left out of it
+    # summarized, counting the summary calls that miss the completion cache
+    calls = {'api': 0}
+
+    def stub_create(**kwargs):
+        calls['api'] += 1
+        return {'choices': [{'text': ' the student talked about bullies'}]}
+
+    openai.Completion.create = stub_create
+    helpers.prompt_gpt_azure = prompt_gpt_azure
+    llm.completion_cache = llm.CompletionCache(llm.COMPLETION_CACHE_MAX_ENTRIES, '', llm.COMPLETION_CACHE_TTL, 0, 0)
+    dt.edit_generation_budget(gc_id, {'max_history_messages': 10, 'max_prompt_tokens': None, 'summarize_history': True})
+    messages = []
+    for turn in range(200):
+        messages.append({'role': 'student', 'message': f'student message {turn}'})
+        helpers.generation_prompt(gc, messages)
+        messages.append({'role': 'chatbot', 'message': f'chatbot message {turn}'})
+    print(f'summarized  200 turns: {calls["api"]} summary calls sent to the API')
+
+
+if __name__ == '__main__':
+    run()
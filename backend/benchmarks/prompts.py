@@ -0,0 +1,26 @@
+import timeit
+from benchmarks.common import stub_gpt, build_large_tree
+import helpers
+
+
+# Time prompt construction for components with 1,000 examples each, reusing the
+# compiled prompt prefix versus recompiling it on every call
+def run():
+    stub_gpt()
+    dt, gc_ids, dc_ids = build_large_tree(2, 2000)
+    gc, dc = dt.get_component(gc_ids[0]), dt.get_component(dc_ids[0])
+    messages = [{'role': 'student', 'message': 'hello'}, {'role': 'chatbot', 'message': 'hi'},
+                {'role': 'student', 'message': 'bye'}]
+
+    for name, component, perform in [('perform_detection', dc, helpers.perform_detection),
+                                     ('perform_generation', gc, helpers.perform_generation)]:
+        number = 2000
+        uncached = timeit.timeit(lambda: (component.invalidate_compiled(), perform(component, messages)),
+                                 number=number) / number
+        cached = timeit.timeit(lambda: perform(component, messages), number=number) / number
+        print(f'{name:<20} recompiled {uncached * 1e6:8.1f} us, cached {cached * 1e6:6.1f} us '
+              f'({uncached / cached:.0f}x faster)')
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,38 @@
+import timeit
+import helpers
+from models import *
+
+
+# Time chat traversal with instant GPT calls through a detection component with 500
+# outgoing generation components and a chain of 2,000 generation components, with
+# the routing plan cached against compiled for every chat
+def run():
+    helpers.perform_gpt_detection = lambda dc, messages: 'class 499'
+    helpers.perform_generation = lambda gc, messages: ' stub '
+    dt = DialogueTree('bench', 'dt-bench')
+    dc_id = dt.add_component('dc', 'dc')
+    for i in range(500):
+        gc_id = dt.add_component('gc', f'gc {i}')
+        dt.edit_generation_class(gc_id, f'class {i}')
+        dt.add_edge(dc_id, gc_id)
+    previous_id = gc_id
+    for i in range(2000):
+        gc_id = dt.add_component('gc', f'chain {i}')
+        dt.add_edge(previous_id, gc_id)
+        previous_id = gc_id
+    dt.add_edge(previous_id, dt.add_component('dc', 'next dc'))
+    dc = dt.get_component(dc_id)
+
+    for name, compile_every_chat in [('cached plan', False), ('compiled per chat', True)]:
+        def chat():
+            if compile_every_chat:
+                dt.routing_plan = None
+            helpers.traverse_dialogue_tree(dt, dc, [{'role': 'student', 'message': 'hello'}])
+        chat()
+        number = 50
+        seconds = timeit.timeit(chat, number=number) / number
+        print(f'{name:<18} {seconds * 1e3:6.2f} ms per chat through 2,001 generation components')
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,53 @@
+import json
+import time
+from benchmarks.common import use_scratch_data, stub_gpt
+import helpers
+
+
+# Compare request bytes and server time per turn of a 400 turn conversation sent
+# as the full history to /chat and as one message to a chat session, with prompt
+# history windowed so that only the request handling grows with the conversation
+def run():
+    use_scratch_data()
+    stub_gpt()
+    helpers.prompt_gpt_azure = lambda prompt, max_tokens: ' class a ' if max_tokens == 16 else ' stub '
+    from app import app
+    client = app.test_client()
+
+    dt_id = client.post('/dialogue', json={'name': 'bench'}).get_json()['data']['id']
+    dc_id = client.post(f'/dialogue/{dt_id}/detection', json={'name': 'dc'}).get_json()['data']['id']
+    client.post(f'/dialogue/{dt_id}/detection/{dc_id}/class', json={'class': 'class a'})
+    gc_id = client.post(f'/dialogue/{dt_id}/generation', json={'name': 'gc'}).get_json()['data']['id']
+    client.put(f'/dialogue/{dt_id}/generation/{gc_id}/class', json={'class': 'class a'})
+    client.put(f'/dialogue/{dt_id}/generation/{gc_id}/budget', json={'max_history_messages': 10})
+    client.post(f'/dialogue/{dt_id}/edge', json={'start': dc_id, 'end': gc_id})
+    client.post(f'/dialogue/{dt_id}/edge', json={'start': gc_id, 'end': dc_id})
+
+    turns = 400
+    messages = []
+    total_bytes, last_seconds = 0, 0.0
+    for i in range(turns):
+        messages.append({'role': 'student', 'message': f'student message number {i}'})
+        body = json.dumps({'messages': messages})
+        start = time.perf_counter()
+        data = client.post(f'/dialogue/{dt_id}/chat/{dc_id}', data=body, content_type='application/json').get_json()['data']
+        if i >= turns - 50:
+            last_seconds += time.perf_counter() - start
+        total_bytes += len(body)
+        messages.extend({'role': 'chatbot', 'message': response} for response in data['responses'])
+    print(f'{"chat":<8} {total_bytes / 1e6:7.2f} MB sent, last 50 turns {last_seconds / 50 * 1e3:6.2f} ms per turn')
+
+    s_id = client.post(f'/dialogue/{dt_id}/session', json={'start': dc_id}).get_json()['data']['id']
+    total_bytes, last_seconds = 0, 0.0
+    for i in range(turns):
+        body = json.dumps({'message': f'student message number {i}'})
+        start = time.perf_counter()
+        client.post(f'/dialogue/{dt_id}/session/{s_id}/chat', data=body, content_type='application/json')
+        if i >= turns - 50:
+            last_seconds += time.perf_counter() - start
+        total_bytes += len(body)
+    print(f'{"session":<8} {total_bytes / 1e6:7.2f} MB sent, last 50 turns {last_seconds / 50 * 1e3:6.2f} ms per turn')
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,56 @@
+import time
+import helpers
+from models import *
+
+
+# Compare /chat latency and GPT calls with and without speculative generation, on a
+# detection component with three outgoing generation components where students mostly
+# take the first branch, with 100 ms GPT calls
+def run():
+    import random
+    calls = {'gpt': 0}
+
+    def slow_gpt(prompt: str, max_tokens: int):
+        calls['gpt'] += 1
+        time.sleep(0.1)
+        if max_tokens == 16:
+            return ' ' + prompt.rsplit('\n', 2)[-2].rsplit(': ', 1)[1]
+        return ' response '
+
+    helpers.prompt_gpt_azure = slow_gpt
+    dt = DialogueTree('bench', 'dt-bench')
+    dc_id = dt.add_component('dc', 'dc')
+    for det_class in ['class a', 'class b', 'class c']:
+        dt.add_detection_class(dc_id, det_class)
+        gc_id = dt.add_component('gc', det_class)
+        dt.edit_generation_class(gc_id, det_class)
+        dt.add_edge(dc_id, gc_id)
+    random.seed(0)
+    workload = random.choices(['class a', 'class b', 'class c'], [8, 1, 1], k=30)
+
+    for branches in [0, 1, 3]:
+        helpers.SPECULATIVE_BRANCHES = branches
+        helpers.branch_counts.clear()
+        dt_copy = dt.copy()
+        dc = dt_copy.get_component(dc_id)
+        calls['gpt'] = 0
+        start = time.perf_counter()
+        for message in workload:
+            helpers.traverse_dialogue_tree(dt_copy, dc, [{'role': 'student', 'message': message}])
+        seconds = (time.perf_counter() - start) / len(workload)
+        print(f'{branches} speculative branches: {seconds * 1e3:.0f} ms per chat, '
+              f'{calls["gpt"] / len(workload):.1f} GPT calls per chat')
+
+    # while other chats keep every speculation worker busy, the chosen branch is
+    # generated by the chat itself instead of waiting for a worker
+    busy = [helpers.speculation_pool.submit(time.sleep, 1) for _ in range(helpers.SPECULATIVE_POOL_SIZE)]
+    start = time.perf_counter()
+    helpers.traverse_dialogue_tree(dt_copy, dc, [{'role': 'student', 'message': 'class a'}])
+    print(f'3 speculative branches, busy pool: {(time.perf_counter() - start) * 1e3:.0f} ms per chat')
+    for future in busy:
+        future.result()
+    helpers.speculation_pool.shutdown()
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,193 @@
+from dotenv import load_dotenv
+import math
+import os
+import threading
+
+
+load_dotenv()
+
+# Answer detection prompts with a local classifier trained on the component's class
+# examples when its confidence is at least LOCAL_CLASSIFIER_THRESHOLD, and with GPT
+# otherwise. Confidence is the margin between the two most similar classes
+LOCAL_CLASSIFIER = os.getenv('LOCAL_CLASSIFIER', 'off') == 'on'
+LOCAL_CLASSIFIER_THRESHOLD = float(os.getenv('LOCAL_CLASSIFIER_THRESHOLD', 0.25))
+
+# Lengths of the character n-grams used as features
+NGRAM_SIZES = (2, 3, 4)
+
+
+# Return the character n-gram counts of text
+def char_ngrams(text: str):
+    text = f' {" ".join(text.lower().split())} '
+    counts = {}
+    for n in NGRAM_SIZES:
+        for i in range(len(text) - n + 1):
+            gram = text[i:i+n]
+            counts[gram] = counts.get(gram, 0) + 1
+    return counts
+
+
+# Scale sparse vector to unit length in place and return it
+def normalize(vector: dict):
+    norm = math.sqrt(sum(value * value for value in vector.values()))
+    if norm > 0:
+        for key in vector:
+            vector[key] /= norm
+    return vector
+
+
+# Return the dot product of two sparse vectors
+def dot(a: dict, b: dict):
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(value * b.get(key, 0.0) for key, value in a.items())
+
+
+# Nearest centroid classifier over TF-IDF weighted character n-grams. Each class is
+# represented by the normalized mean of its examples' normalized TF-IDF vectors
+class CentroidClassifier:
+    def __init__(self, examples: dict):
+        documents = [(cls, char_ngrams(example)) for cls, cls_examples in examples.items()
+                     for example in cls_examples]
+        df = {}
+        for _, counts in documents:
+            for gram in counts:
+                df[gram] = df.get(gram, 0) + 1
+        self.idf = {gram: math.log((1 + len(documents)) / (1 + count)) + 1 for gram, count in df.items()}
+
+        self.centroids = {}
+        for cls, counts in documents:
+            centroid = self.centroids.setdefault(cls, {})
+            for gram, value in self.vectorize(counts).items():
+                centroid[gram] = centroid.get(gram, 0.0) + value
+        for centroid in self.centroids.values():
+            normalize(centroid)
+
+    # Return the normalized TF-IDF vector of n-gram counts, ignoring unseen n-grams
+    def vectorize(self, counts: dict):
+        return normalize({gram: count * self.idf[gram] for gram, count in counts.items() if gram in self.idf})
+
+    # Return the most similar class to text and the margin of its similarity over
+    # the next most similar class, or None and 0 if there are no examples
+    def predict(self, text: str):
+        vector = self.vectorize(char_ngrams(text))
+        scores = sorted(((dot(vector, centroid), cls) for cls, centroid in self.centroids.items()), reverse=True)
+        if len(scores) == 0:
+            return None, 0.0
+        runner_up = scores[1][0] if len(scores) > 1 else 0.0
+        return scores[0][1], scores[0][0] - runner_up
+
+
+# Counts and total latency of detections answered locally and by GPT
+class DetectionStats:
+    def __init__(self):
+        self.local = 0
+        self.fallback = 0
+        self.local_seconds = 0.0
+        self.fallback_seconds = 0.0
+        self.lock = threading.Lock()
+
+    # Record a detection answered locally, or by GPT if fallback is True
+    def record(self, seconds: float, fallback: bool):
+        with self.lock:
+            if fallback:
+                self.fallback += 1
+                self.fallback_seconds += seconds
+            else:
+                self.local += 1
+                self.local_seconds += seconds
+
+    # Remove every recorded detection
+    def clear(self):
+        with self.lock:
+            self.local = 0
+            self.fallback = 0
+            self.local_seconds = 0.0
+            self.fallback_seconds = 0.0
+
+    # Return local hit ratio and mean latency of local and GPT detections
+    def stats(self):
+        with self.lock:
+            total = self.local + self.fallback
+            return {'enabled': LOCAL_CLASSIFIER,
+                    'threshold': LOCAL_CLASSIFIER_THRESHOLD,
+                    'local': self.local,
+                    'fallback': self.fallback,
+                    'local_hit_ratio': self.local / total if total > 0 else 0.0,
+                    'local_mean_ms': self.local_seconds / self.local * 1e3 if self.local > 0 else 0.0,
+                    'fallback_mean_ms': self.fallback_seconds / self.fallback * 1e3 if self.fallback > 0 else 0.0}
+
+
+detection_stats = DetectionStats()
+
+
+# TF-IDF index of example texts by example id, supporting incremental updates and
+# top-k similarity queries. Document frequencies are kept up to date as examples are
+# added and removed, so IDF weights are exact at query time. Examples are length
+# normalized by their term frequencies, which do not depend on the rest of the index
+class ExampleIndex:
+    def __init__(self, examples: list=None):
+        self.postings = {}
+        self.grams = {}
+        self.norms = {}
+        self.order = {}
+        self.next_order = 0
+        for id, text in examples or []:
+            self.add(id, text)
+
+    # Add example with id and text to the index
+    def add(self, id: str, text: str):
+        counts = char_ngrams(text)
+        for gram, count in counts.items():
+            self.postings.setdefault(gram, {})[id] = count
+        self.grams[id] = list(counts.keys())
+        self.norms[id] = math.sqrt(sum(count * count for count in counts.values())) or 1.0
+        self.order[id] = self.next_order
+        self.next_order += 1
+
+    # Remove example with id from the index
+    def remove(self, id: str):
+        if id not in self.norms:
+            return
+        for gram in self.grams.pop(id):
+            posting = self.postings[gram]
+            del posting[id]
+            if len(posting) == 0:
+                del self.postings[gram]
+        del self.norms[id]
+        del self.order[id]
+
+    # Return an index of the same examples that can be updated without changing this
+    # one. Copying the postings costs far less than counting n-grams again
+    def copy(self):
+        index = ExampleIndex()
+        index.postings = {gram: dict(posting) for gram, posting in self.postings.items()}
+        index.grams = dict(self.grams)
+        index.norms = dict(self.norms)
+        index.order = dict(self.order)
+        index.next_order = self.next_order
+        return index
+
+    # Replace the text of example with id
+    def update(self, id: str, text: str):
+        order = self.order.get(id)
+        self.remove(id)
+        self.add(id, text)
+        if order is not None:
+            self.order[id] = order
+
+    # Return the ids of the k examples most similar to text, in the order they were
+    # added. Examples sharing no n-grams with text fill any remaining places
+    def top_k(self, text: str, k: int):
+        num_examples = len(self.norms)
+        scores = {}
+        for gram, count in char_ngrams(text).items():
+            posting = self.postings.get(gram)
+            if posting is None:
+                continue
+            idf = math.log((1 + num_examples) / (1 + len(posting))) + 1
+            weight = count * idf * idf
+            for id, example_count in posting.items():
+                scores[id] = scores.get(id, 0.0) + weight * example_count
+        ranked = sorted(self.norms, key=lambda id: (-scores.get(id, 0.0) / self.norms[id], self.order[id]))
+        return sorted(ranked[:k], key=lambda id: self.order[id])
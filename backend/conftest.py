@@ -0,0 +1,90 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import pytest
+import socket
+import threading
+import time
+
+
+# Run each test in an empty scratch directory with its own data directory, and start
+# with an empty tree cache, so tests never touch the real dialogue trees
+@pytest.fixture(autouse=True)
+def scratch_data(tmp_path, monkeypatch):
+    import models
+    monkeypatch.chdir(tmp_path)
+    os.mkdir('data')
+    models.tree_cache.clear()
+    yield tmp_path
+    models.tree_cache.clear()
+
+
+# Serve canned completions from a local HTTP/1.1 server, counting the TCP
+# connections clients open to it, and return the server and its base URL. Each
+# completion is made of tokens produced token_delay seconds apart, and is sent
+# token by token as Server-Sent Events when the request asks to stream
+def start_stub_llm_server(tokens: list=[' stub'], token_delay: float=0):
+    def chunk(text: str, finish_reason=None):
+        return {'choices': [{'text': text, 'index': 0, 'finish_reason': finish_reason}]}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            super().setup()
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.server.connections += 1
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            self.send_response(200)
+            if request.get('stream'):
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                for token in tokens:
+                    time.sleep(token_delay)
+                    self.write_chunk(f'data: {json.dumps(chunk(token))}\n\n')
+                self.write_chunk('data: [DONE]\n\n')
+                self.write_chunk('')
+            else:
+                time.sleep(token_delay * len(tokens))
+                body = json.dumps(chunk(''.join(tokens), 'stop')).encode('utf-8')
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        def write_chunk(self, text: str):
+            data = text.encode('utf-8')
+            self.wfile.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    server.connections = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/'
+
+
+# Return a function that starts a stub LLM server sending the given tokens and points
+# the Azure client at it, with the completion cache turned off. Servers are shut down
+# after the test
+@pytest.fixture
+def stub_llm(monkeypatch):
+    import helpers
+    import llm
+    servers = []
+
+    def start(tokens: list, token_delay: float=0):
+        server, url = start_stub_llm_server(tokens, token_delay)
+        servers.append(server)
+        monkeypatch.setattr(llm, 'completion_cache', llm.CompletionCache(0, '', 0, 0, 0))
+        monkeypatch.setattr(helpers, 'azure_client', llm.LLMClient('gpt3_davinci', 'key', url, 'azure', '2022-12-01'))
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
@@ -1,9 +1,46 @@
+from classifier import CentroidClassifier, ExampleIndex, LOCAL_CLASSIFIER, LOCAL_CLASSIFIER_THRESHOLD, detection_stats
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from dotenv import load_dotenv
-from flask import Response
+from flask import Response, g, request
 import json
+from llm import azure_client, count_tokens, openai_client, prompt_token_stats
 from models import *
-import openai
 import os
+import re
+from routing import RoutingPlan, branch_counts
+from sessions import Session, session_store
+import time
+
+
+load_dotenv()
+
+# Number of outgoing generation components whose responses are generated in parallel
+# with the detection call that chooses between them, 0 to wait for the detection call
+SPECULATIVE_BRANCHES = int(os.getenv('SPECULATIVE_BRANCHES', 0))
+SPECULATIVE_POOL_SIZE = int(os.getenv('SPECULATIVE_POOL_SIZE', 16))
+
+speculation_pool = ThreadPoolExecutor(SPECULATIVE_POOL_SIZE)
+
+# Number of most similar examples, per class for detection, put in each prompt, 0 to
+# put every example of the component in every prompt
+EXAMPLE_SELECTION_K = int(os.getenv('EXAMPLE_SELECTION_K', 0))
+
+# Maximum number of tokens in a summary of conversation history left out of a
+# generation prompt, and number of messages summarized by each summary call
+HISTORY_SUMMARY_MAX_TOKENS = int(os.getenv('HISTORY_SUMMARY_MAX_TOKENS', 60))
+HISTORY_SUMMARY_BLOCK = int(os.getenv('HISTORY_SUMMARY_BLOCK', 10))
+
+# Number of messages classified by each GPT call of a batch detection, number of GPT
+# calls batch requests run at the same time, and seconds a batch generation item may
+# run before it is reported as timed out
+BATCH_PACK_SIZE = int(os.getenv('BATCH_PACK_SIZE', 10))
+BATCH_POOL_SIZE = int(os.getenv('BATCH_POOL_SIZE', 8))
+BATCH_ITEM_TIMEOUT = float(os.getenv('BATCH_ITEM_TIMEOUT', 30))
+
+batch_pool = ThreadPoolExecutor(BATCH_POOL_SIZE)
+
+# Numbered category line of a packed detection response
+CATEGORY_LINE = re.compile(r'Category ([1-9][0-9]*):(.*)')
 
 
 # Returns a success response with a custom status code and payload
@@ -28,33 +65,100 @@ def failure_response(status: int, error_message: str):
     )
 
 
+# Returns a Server-Sent Events message carrying payload as JSON
+def sse_event(event: str, payload: dict):
+    return f'event: {event}\ndata: {json.dumps(payload)}\n\n'
+
+
+# Return True if the request's If-None-Match header matches the version of the
+# dialogue tree, meaning the client's copy of the resource is still current
+def is_not_modified(dt: type[DialogueTree]):
+    return request.if_none_match.contains_weak(str(dt.version))
+
+
+# Returns an empty 304 response tagged with the dialogue tree's version
+def not_modified_response(dt: type[DialogueTree]):
+    response = Response(status=304)
+    response.set_etag(str(dt.version))
+    return response
+
+
+# Return dialogue tree with id, loading it at most once per request so that
+# validation and the route handler share the same tree object
+def load_dialogue(dt_id: str):
+    if g.get('dt_id') != dt_id:
+        g.dt = DialogueTree.load(dt_id)
+        g.dt_id = dt_id
+    return g.dt
+
+
+# Return a private copy of the request's dialogue tree for the route handler to
+# mutate and save, so other requests never observe a half-applied edit
+def load_dialogue_for_update(dt_id: str):
+    g.dt = load_dialogue(dt_id).copy()
+    return g.dt
+
+
+# Return chat session with id on dialogue tree dt_id, or None if it does not exist or
+# has expired, reading it at most once per request
+def load_session(dt_id: str, s_id: str):
+    if g.get('session_id') != s_id:
+        g.session = session_store.get(s_id)
+        g.session_id = s_id
+    if g.session is None or g.session.dt_id != dt_id:
+        return None
+    return g.session
+
+
+# Return the messages of a session prompt: the session's conversation followed by the
+# request's student message, if it has one
+def session_prompt_messages(session: type[Session], request_data: dict):
+    messages = list(session.messages)
+    if 'message' in request_data.keys():
+        messages.append({'role': 'student', 'message': request_data['message']})
+    return messages
+
+
+# Add the messages past the end of session's conversation to it and move it to
+# component_id. Raises SessionConflict if another request added to it first
+def append_session_messages(session: type[Session], messages: list, component_id: str):
+    session_store.append(session.id, len(session.messages), messages[len(session.messages):], component_id)
+
+
 # Return response from GPT, given input prompt
 def prompt_gpt_openai(prompt: str):
-    load_dotenv()
-    openai.api_key = os.getenv('API_KEY_OPENAI')
-    response = openai.Completion.create(
-        engine='text-davinci-003',
-        prompt=prompt,
-        temperature=0,
-        max_tokens=16
-    )
-    return response['choices'][0]['text']
+    return openai_client.complete(prompt, 16)
 
 
 # Return response from GPT, given input prompt, using Azure subscription
 def prompt_gpt_azure(prompt: str, max_tokens: int):
-    load_dotenv()
-    openai.api_key = os.getenv('API_KEY_AZURE')
-    openai.api_base =  'https://gpt-for-social-media-chatbot.openai.azure.com/'
-    openai.api_type = 'azure'
-    openai.api_version = '2022-12-01'
-    response = openai.Completion.create(
-        engine='gpt3_davinci',
-        prompt=prompt,
-        temperature=0,
-        max_tokens=max_tokens
-    )
-    return response['choices'][0]['text']
+    return azure_client.complete(prompt, max_tokens)
+
+
+# Yield response from GPT in pieces as it is generated, given input prompt, using
+# Azure subscription
+def stream_gpt_azure(prompt: str, max_tokens: int):
+    return azure_client.stream(prompt, max_tokens)
+
+
+# Yield the pieces of a streamed response with leading and trailing whitespace
+# removed, so that the joined pieces equal the stripped full response. Whitespace
+# is held back until it is known not to end the response
+def strip_stream(pieces):
+    started = False
+    pending = ''
+    for piece in pieces:
+        if not started:
+            piece = piece.lstrip()
+            if piece == '':
+                continue
+            started = True
+        stripped = piece.rstrip()
+        if stripped == '':
+            pending += piece
+            continue
+        yield pending + stripped
+        pending = piece[len(stripped):]
 
 
 # Do basic formatting on classification prediction outputs
@@ -62,65 +166,239 @@ def format_detection_response(response: str):
     return response.lower().strip()
 
 
-# Build detection prompt and perform GPT call
-def perform_detection(dc: type[Detection], messages: list):
+# Return the instruction and few-shot examples portion of a detection prompt with the
+# given examples of each class, along with the number of examples in it
+def compile_detection_prompt_prefix(dc: type[Detection], examples: dict):
     # construct instruction portion of prompt
-    classes = dc.get_classes()
-    prompt_classes = ''
-    for cls in classes:
-        prompt_classes += f'{cls}, '
-    prompt_classes = prompt_classes[:prompt_classes.rindex(',')]
-    instruction = f'Classify the user inputs into one of the following categories: {prompt_classes}\n'
+    prompt_classes = ', '.join(dc.get_classes())
+    parts = [f'Classify the user inputs into one of the following categories: {prompt_classes}\n']
 
     # construct few-shot examples portion of prompt
-    examples = dc.get_examples()
     example_num = 0
-    few_shot_examples = ''
     for cls in examples.keys():
         for example in examples[cls]:
             example_num += 1
-            few_shot_examples += f'Input {example_num}: {example}\n'
-            few_shot_examples += f'Category {example_num}: {cls}\n'
-    
-    # construct classification input portion of prompt
+            parts.append(f'Input {example_num}: {example}\nCategory {example_num}: {cls}\n')
+
+    return ''.join(parts), example_num
+
+
+# Return the instruction and few-shot examples portion of the detection prompt along
+# with the number of examples in it. The prefix only depends on the component's classes
+# and examples, so it is compiled once and reused until one of them changes
+def detection_prompt_prefix(dc: type[Detection]):
+    if dc.prompt_prefix is None:
+        dc.prompt_prefix = compile_detection_prompt_prefix(dc, dc.get_examples())
+    return dc.prompt_prefix
+
+
+# Return the detection prompt prefix for classifying message. With EXAMPLE_SELECTION_K
+# set, only the k examples of each class most similar to message are included
+def select_detection_prompt_prefix(dc: type[Detection], message: str):
+    if EXAMPLE_SELECTION_K <= 0 or all(len(cls.examples) <= EXAMPLE_SELECTION_K for cls in dc.classes):
+        return detection_prompt_prefix(dc)
+
+    examples = {}
+    for cls in dc.classes:
+        selected = set(example_index(cls, 'example').top_k(message, EXAMPLE_SELECTION_K))
+        examples[cls.det_class] = [example.example for example in cls.examples if example.id in selected]
+    return compile_detection_prompt_prefix(dc, examples)
+
+
+# Return the similarity index over the text attribute of the examples of a generation
+# component or detection class, building it the first time it is needed. The model
+# keeps it up to date as examples are added, edited and deleted
+def example_index(owner, attribute: str):
+    if owner.example_index is None:
+        owner.example_index = ExampleIndex([(example.id, getattr(example, attribute)) for example in owner.examples])
+    return owner.example_index
+
+
+# Return the local classifier for the detection component, training it from the
+# component's class examples the first time it is needed after they change
+def detection_classifier(dc: type[Detection]):
+    if dc.classifier is None:
+        dc.classifier = CentroidClassifier(dc.get_examples())
+    return dc.classifier
+
+
+# Return the class predicted by the local classifier for message if it is confident
+# enough, None otherwise. Confident predictions are counted in the detection stats
+def perform_local_detection(dc: type[Detection], message: str):
+    start = time.perf_counter()
+    det_class, confidence = detection_classifier(dc).predict(message)
+    if det_class is None or confidence < LOCAL_CLASSIFIER_THRESHOLD:
+        return None
+    detection_stats.record(time.perf_counter() - start, False)
+    return format_detection_response(det_class)
+
+
+# Build detection prompt for the most recent message and perform GPT call
+def perform_gpt_detection(dc: type[Detection], messages: list):
+    start = time.perf_counter()
     message_to_classify = messages[-1]['message']
+    prefix, example_num = select_detection_prompt_prefix(dc, message_to_classify)
+
+    # construct classification input portion of prompt
     new_input = f'Input {example_num+1}: {message_to_classify}\nCategory {example_num+1}: '
 
     # construct full prompt, call GPT, and return predicted class
-    prompt = instruction + few_shot_examples + new_input
+    prompt = prefix + new_input
     predicted_class = format_detection_response(prompt_gpt_azure(prompt, 16))
+    detection_stats.record(time.perf_counter() - start, True)
     return predicted_class
 
 
-# Build generation prompt and perform GPT call
-def perform_generation(gc: type[Generation], messages: list):
+# Classify the most recent message with the local classifier if it is enabled and
+# confident, and with a GPT call otherwise
+def perform_detection(dc: type[Detection], messages: list):
+    if LOCAL_CLASSIFIER:
+        predicted_class = perform_local_detection(dc, messages[-1]['message'])
+        if predicted_class is not None:
+            return predicted_class
+    return perform_gpt_detection(dc, messages)
+
+
+# Build a detection prompt listing several messages after the few-shot examples and
+# perform one GPT call for all of them. Return the predicted class of each message,
+# or None where the response has no category for it
+def perform_packed_detection(dc: type[Detection], messages: list):
+    prefix, example_num = detection_prompt_prefix(dc)
+
+    # construct classification input portion of prompt, asking for the categories
+    # of all inputs in the same numbered format as the examples. Whitespace in each
+    # message is collapsed so every input stays on its own line and no message can
+    # add input or category lines of its own
+    parts = [prefix]
+    for i, message in enumerate(messages):
+        parts.append(f'Input {example_num+i+1}: {" ".join(message.split())}\n')
+    parts.append(f'Category {example_num+1}: ')
+
+    # call GPT and read the category line numbered after each input from the response,
+    # ignoring any line that is not exactly one of them
+    response = f'Category {example_num+1}: ' + prompt_gpt_azure(''.join(parts), 16 * len(messages))
+    predicted_classes = [None] * len(messages)
+    for line in response.split('\n'):
+        match = CATEGORY_LINE.fullmatch(line)
+        if match is not None:
+            i = int(match.group(1)) - example_num - 1
+            if 0 <= i < len(messages) and predicted_classes[i] is None:
+                predicted_classes[i] = format_detection_response(match.group(2))
+    return predicted_classes
+
+
+# Classify every message with the detection component, answering with the local
+# classifier where it is enabled and confident and packing the remaining messages
+# BATCH_PACK_SIZE at a time into GPT calls run concurrently. Return a result per
+# message, in input order, holding either its response or an error message
+def perform_batch_detection(dc: type[Detection], messages: list):
+    results = [None] * len(messages)
+    remaining = []
+    for i, message in enumerate(messages):
+        predicted_class = perform_local_detection(dc, message) if LOCAL_CLASSIFIER else None
+        if predicted_class is not None:
+            results[i] = {'response': predicted_class}
+        else:
+            remaining.append(i)
+
+    packs = [remaining[i:i+BATCH_PACK_SIZE] for i in range(0, len(remaining), BATCH_PACK_SIZE)]
+    futures = [batch_pool.submit(perform_packed_detection, dc, [messages[i] for i in pack]) for pack in packs]
+    for pack, future in zip(packs, futures):
+        try:
+            predicted_classes = future.result()
+        except Exception as e:
+            predicted_classes = [None] * len(pack)
+            error_msg = f'classification failed: {e}'
+        else:
+            error_msg = 'no category returned for message'
+        for i, predicted_class in zip(pack, predicted_classes):
+            if predicted_class:
+                results[i] = {'response': predicted_class}
+            else:
+                results[i] = {'error_message': error_msg}
+    return results
+
+
+# Return the instruction and few-shot examples portion of a generation prompt with
+# the given examples
+def compile_generation_prompt_prefix(examples: list):
     # TODO: Consider making instruction more general. Generation may be in response to student comments on social media, students
     # directly talking to the chatbot, or the output of other generation components (in the case of sequential generation components.)
 
     # construct instruction portion of prompt
-    instruction = f'The student sees a cyberbully on social media and makes a comment in response to the bully.  Teach students to counteract cyberbullies based on the following examples:\n'
+    parts = [f'The student sees a cyberbully on social media and makes a comment in response to the bully.  Teach students to counteract cyberbullies based on the following examples:\n']
 
     # construct few-shot examples portion of prompt
-    examples = gc.get_examples()
     example_num = 0
-    few_shot_examples = ''
     for example in examples:
         example_num += 1
-        few_shot_examples += f'Example {example_num}:\n'
-        few_shot_examples += f'Context: {example.context}\n'
-        few_shot_examples += f'Response: {example.response}\n'
-    
-    # add conversation history
-    conversation_history = ''
-    if len(messages) >= 2:
-        conversation_history = f'Here is the conversation history with the student:\n'
-        for i in range(len(messages) - 1):
-            message = messages[i]['message']
-            role = messages[i]['role']
-            if role == 'student':
-                conversation_history += f'Student: {message}\n'
-            elif role == 'chatbot':
-                conversation_history += f'Chatbot: {message}\n'
+        parts.append(f'Example {example_num}:\nContext: {example.context}\nResponse: {example.response}\n')
+
+    return ''.join(parts)
+
+
+# Return the instruction and few-shot examples portion of the generation prompt along
+# with its number of tokens. The prefix only depends on the component's examples, so
+# it is compiled once and reused until one of them changes
+def generation_prompt_prefix(gc: type[Generation]):
+    if gc.prompt_prefix is None:
+        prefix = compile_generation_prompt_prefix(gc.get_examples())
+        gc.prompt_prefix = (prefix, count_tokens(prefix))
+    return gc.prompt_prefix
+
+
+# Return the generation prompt prefix for answering message and its number of tokens.
+# With EXAMPLE_SELECTION_K set, only the k examples whose context is most similar to
+# message are included
+def select_generation_prompt_prefix(gc: type[Generation], message: str):
+    if EXAMPLE_SELECTION_K <= 0 or len(gc.examples) <= EXAMPLE_SELECTION_K:
+        return generation_prompt_prefix(gc)
+
+    selected = set(example_index(gc, 'context').top_k(message, EXAMPLE_SELECTION_K))
+    prefix = compile_generation_prompt_prefix([example for example in gc.examples if example.id in selected])
+    return prefix, count_tokens(prefix)
+
+
+# Return the conversation history portion of a generation prompt for messages as one
+# line per message
+def conversation_history_lines(messages: list):
+    lines = []
+    for element in messages:
+        message = element['message']
+        role = element['role']
+        if role == 'student':
+            lines.append(f'Student: {message}\n')
+        elif role == 'chatbot':
+            lines.append(f'Chatbot: {message}\n')
+        else:
+            lines.append('')
+    return lines
+
+
+# Return a summary of messages left out of a generation prompt. Messages are
+# summarized HISTORY_SUMMARY_BLOCK at a time, each block together with the summary of
+# the blocks before it. Summaries are GPT completions, so every block but the newest
+# has been summarized on an earlier turn with the same prompt and comes from the
+# completion cache
+def summarize_conversation(messages: list):
+    summary = ''
+    for start in range(0, len(messages), HISTORY_SUMMARY_BLOCK):
+        prompt = 'Summarize the following conversation between a student and a chatbot in one or two sentences:\n'
+        if summary != '':
+            prompt += f'Summary of earlier messages: {summary}\n'
+        prompt += ''.join(conversation_history_lines(messages[start:start+HISTORY_SUMMARY_BLOCK])) + 'Summary:'
+        summary = prompt_gpt_azure(prompt, HISTORY_SUMMARY_MAX_TOKENS).strip()
+    return summary
+
+
+# Build generation prompt for the most recent message. The conversation history is
+# limited by the component's budget to its most recent messages and to the tokens left
+# after the rest of the prompt, with the messages left out optionally summarized. The
+# prompt's token counts are recorded as those of a speculative call if speculative
+# is True
+def generation_prompt(gc: type[Generation], messages: list, speculative: bool=False):
+    prefix, prefix_tokens = select_generation_prompt_prefix(gc, messages[-1]['message'])
+    budget = gc.budget
 
     #TODO: Consider making new_input more general. message_to_answer might be from either the student or chatbot. 
 
@@ -129,65 +407,199 @@ def perform_generation(gc: type[Generation], messages: list):
     message_to_answer = messages[-1]['message']
     new_input += f'Context: {message_to_answer}\Response: '
 
-    # construct full prompt, call GPT, and return generated response
-    prompt = instruction + few_shot_examples + conversation_history + new_input
-    return prompt_gpt_azure(prompt, 100).strip()
-
-
-# Starting at component c in its respective dialogue tree, process the input messages
-# appropriately. Return chatbot responses from generation components as a list
-# and the next component in the tree as an id (or "exit" if leaf node is reached).
-def traverse_dialogue_tree(c: type[Component], messages: list, responses=None, first_detection=True):
-    # base cases:
-    # 1) current component is a generation component and a leaf node
-    #    - do last generation call
-    #    - return responses and 'exit'
-    # 2) current component is a detection component and a leaf node
-    #    - ignore classifier call since there are no generation components to go to
-    #    - return responses and 'exit'
-    #    - with complete tree, should not reach this base case
-    # 3) current component is a detection component and is not the first detection component in API call
-    #    - return responses and c.id
-    if isinstance(c, Generation) and c.is_leaf():
-        response = perform_generation(c, messages)
-        if responses is None:
-            responses = [response]
-        else:
-            responses.append(response)
-        return responses, 'exit'
-    elif isinstance(c, Detection) and c.is_leaf():
-        if responses is None:
-            responses = []
-        return responses, 'exit'
-    elif isinstance(c, Detection) and not first_detection:
-        return responses, c.id
-
-
-    # recursive cases:
-    # 1) current component is detection component
-    #    - classify most recent student message in messages
-    #    - use classification result to go to the correct generation component
-    # 2) current component is a generation component
-    #    - generate response using current component and messages
-    #    - add response to messages and responses
-    #    - go to next component in tree
-    if isinstance(c, Detection):
-        det_class = perform_detection(c, messages)
-        outgoing_gcs = c.get_generation_edges()
-        next_c = None
-        for gc in outgoing_gcs:
-            if gc.gen_class == det_class:
-                next_c = gc
+    # keep the most recent messages of the conversation history allowed by the budget
+    history_header = f'Here is the conversation history with the student:\n'
+    lines = conversation_history_lines(messages[:-1])
+    dropped = 0
+    if budget['max_history_messages'] is not None:
+        dropped = max(len(lines) - budget['max_history_messages'], 0)
+    if budget['max_prompt_tokens'] is not None:
+        available = budget['max_prompt_tokens'] - prefix_tokens - count_tokens(history_header + new_input)
+        if budget['summarize_history']:
+            available -= HISTORY_SUMMARY_MAX_TOKENS + count_tokens('Summary of earlier messages: \n')
+        kept = 0
+        for line in reversed(lines[dropped:]):
+            available -= count_tokens(line)
+            if available < 0:
+                break
+            kept += 1
+        dropped = len(lines) - kept
+
+    # summarized messages are left out in whole blocks, so the summary prompts stay
+    # the same from one turn to the next
+    summary = ''
+    if dropped > 0 and budget['summarize_history']:
+        dropped = min(-(-dropped // HISTORY_SUMMARY_BLOCK) * HISTORY_SUMMARY_BLOCK, len(lines))
+        summary = summarize_conversation(messages[:dropped])
+
+    # add conversation history
+    conversation_history = ''
+    if dropped < len(lines) or summary != '':
+        conversation_history = history_header
+        if summary != '':
+            conversation_history += f'Summary of earlier messages: {summary}\n'
+        conversation_history += ''.join(lines[dropped:])
+
+    # construct full prompt
+    rest = conversation_history + new_input
+    prompt_token_stats.record(prefix_tokens + count_tokens(rest), dropped, summary != '', speculative)
+    return prefix + rest
+
+
+# Build generation prompt and perform GPT call, speculatively if speculative is True
+def perform_generation(gc: type[Generation], messages: list, speculative: bool=False):
+    return prompt_gpt_azure(generation_prompt(gc, messages, speculative), 100).strip()
+
+
+# Build generation prompt and perform streaming GPT call, yielding the response
+# in pieces as it is generated
+def perform_generation_stream(gc: type[Generation], messages: list):
+    return strip_stream(stream_gpt_azure(generation_prompt(gc, messages), 100))
+
+
+# Start generating responses for the outgoing generation components of dc in dialogue
+# tree dt most likely to be chosen, up to SPECULATIVE_BRANCHES of them. Components on a
+# generation cycle are skipped, since a chat taking them fails before using the
+# response. Return the pending responses by generation component id
+def speculate_generations(dt: type[DialogueTree], dc: type[Detection], messages: list):
+    if SPECULATIVE_BRANCHES <= 0:
+        return {}
+    plan = routing_plan(dt)
+    return {gc.id: speculation_pool.submit(perform_generation, gc, list(messages), True)
+            for gc in branch_counts.likely_generation_edges(dt.id, dc, SPECULATIVE_BRANCHES)
+            if not plan.position(gc)[0].cyclic}
+
+
+# Generate a response for every conversation with the generation component, running
+# BATCH_POOL_SIZE GPT calls at a time. Yield a result per conversation as soon as it
+# completes, holding its index and either its response or an error message. A
+# conversation whose call runs longer than BATCH_ITEM_TIMEOUT is reported as timed
+# out and its late response is discarded
+def perform_batch_generation(gc: type[Generation], conversations: list):
+    started = {}
+
+    def generate(i: int):
+        started[i] = time.monotonic()
+        return perform_generation(gc, conversations[i])
+
+    futures = {batch_pool.submit(generate, i): i for i in range(len(conversations))}
+    pending = set(futures)
+    try:
+        while len(pending) > 0:
+            deadlines = [started[futures[f]] + BATCH_ITEM_TIMEOUT for f in pending if futures[f] in started]
+            timeout = max(min(deadlines) - time.monotonic(), 0) if len(deadlines) > 0 else BATCH_ITEM_TIMEOUT
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    yield {'index': futures[future], 'response': future.result()}
+                except Exception as e:
+                    yield {'index': futures[future], 'error_message': f'generation failed: {e}'}
+
+            now = time.monotonic()
+            for future in list(pending):
+                i = futures[future]
+                if i in started and now - started[i] >= BATCH_ITEM_TIMEOUT:
+                    pending.remove(future)
+                    yield {'index': i, 'error_message': 'generation timed out'}
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+# Return the routing plan of dialogue tree, compiling it on first use. The plan is
+# discarded whenever the tree is changed, and a saved tree is never changed again
+def routing_plan(dt: type[DialogueTree]):
+    if dt.routing_plan is None:
+        dt.routing_plan = RoutingPlan(dt)
+    return dt.routing_plan
+
+
+# Starting at component c in dialogue tree dt, process the input messages appropriately.
+# Yield ('response', response) for each chatbot response from a generation component as
+# soon as it is generated, then ('next_id', id) for the next component in the tree (or
+# "exit" if leaf node is reached). Each response is also added to messages
+def walk_dialogue_tree(dt: type[DialogueTree], c: type[Component], messages: list):
+    plan = routing_plan(dt)
+    first_detection = True
+    speculative_response = None
+    while True:
+        # current component is a generation component:
+        # - generate and yield the response of every component on its generation path,
+        #   using the response generated while detection ran if there is one
+        # - go to the component following the path, or exit if there is none
+        if isinstance(c, Generation):
+            path, offset = plan.position(c)
+            if path.cyclic:
+                if speculative_response is not None:
+                    speculative_response.cancel()
+                raise Exception(f'generation components following {c.id} form a cycle')
+            for gc in path.components[offset:]:
+                if speculative_response is not None:
+                    response = speculative_response.result()
+                    speculative_response = None
+                else:
+                    response = perform_generation(gc, messages)
+                yield 'response', response
+                messages.append({'role': 'chatbot', 'message': response})
+            c = path.next
+            if c is None:
+                yield 'next_id', 'exit'
+                return
+            continue
+
+        # stopping cases for a detection component:
+        # 1) it is a leaf node
+        #    - ignore classifier call since there are no generation components to go to
+        #    - yield 'exit'
+        #    - with complete tree, should not reach this case
+        # 2) it is not the first detection component in API call
+        #    - yield c.id
+        if c.is_leaf():
+            yield 'next_id', 'exit'
+            return
+        elif not first_detection:
+            yield 'next_id', c.id
+            return
+
+        # continuing case for a detection component:
+        # - classify most recent student message in messages with the local classifier,
+        #   and if it is not confident with GPT, while speculatively generating
+        #   responses for the likeliest outgoing generation components
+        # - look up the generation component the class is routed to and go to it
+        # - discard speculative responses for the other generation components, and
+        #   generate the chosen one here if its call is still queued behind other chats
+        speculative_responses = {}
+        det_class = perform_local_detection(c, messages[-1]['message']) if LOCAL_CLASSIFIER else None
+        if det_class is None:
+            speculative_responses = speculate_generations(dt, c, messages)
+            try:
+                det_class = perform_gpt_detection(c, messages)
+            except Exception:
+                for future in speculative_responses.values():
+                    future.cancel()
+                raise
+        next_c = plan.route(c, det_class)
         if next_c is not None:
-            return traverse_dialogue_tree(next_c, messages, responses, False)
-        else:
+            speculative_response = speculative_responses.pop(next_c.id, None)
+            if speculative_response is not None and speculative_response.cancel():
+                speculative_response = None
+        for future in speculative_responses.values():
+            future.cancel()
+        if next_c is None:
             raise Exception(f'no edge found from {c.id} to generation component with class {det_class}')
-    else:
-        response = perform_generation(c, messages)
-        if responses is None:
-            responses = [response]
+        branch_counts.record(dt.id, c.id, next_c.id)
+        c = next_c
+        first_detection = False
+
+
+# Starting at component c in dialogue tree dt, process the input messages appropriately.
+# Return chatbot responses from generation components as a list and the next
+# component in the tree as an id (or "exit" if leaf node is reached).
+def traverse_dialogue_tree(dt: type[DialogueTree], c: type[Component], messages: list):
+    responses, next_id = [], None
+    for event, data in walk_dialogue_tree(dt, c, messages):
+        if event == 'response':
+            responses.append(data)
         else:
-            responses.append(response)
-        messages.append({'role': 'chatbot', 'message': response})
-        next_c = c.get_next_component()
-        return traverse_dialogue_tree(next_c, messages, responses, first_detection)
\ No newline at end of file
+            next_id = data
+    return responses, next_id
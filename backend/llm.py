@@ -0,0 +1,349 @@
+from collections import OrderedDict, deque
+from dotenv import load_dotenv
+import hashlib
+import json
+import openai
+import os
+import requests
+import sqlite3
+import threading
+import time
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+load_dotenv()
+
+# Maximum number of completions kept in memory
+COMPLETION_CACHE_MAX_ENTRIES = int(os.getenv('COMPLETION_CACHE_MAX_ENTRIES', 4096))
+
+# SQLite file backing the on-disk completion tier, which is disabled when empty
+COMPLETION_CACHE_PATH = os.getenv('COMPLETION_CACHE_PATH', '')
+
+# Seconds a cached completion stays valid and total bytes kept on disk
+COMPLETION_CACHE_TTL = int(os.getenv('COMPLETION_CACHE_TTL', 7 * 24 * 60 * 60))
+COMPLETION_CACHE_MAX_BYTES = int(os.getenv('COMPLETION_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+
+# Seconds between prunes of expired and least recently used completions on disk. A
+# prune also runs early once this process wrote a sixteenth of the byte bound since
+# the last one, so the disk tier never grows far past it
+COMPLETION_CACHE_PRUNE_INTERVAL = int(os.getenv('COMPLETION_CACHE_PRUNE_INTERVAL', 60))
+
+# Endpoint of the Azure OpenAI resource and the number of keep-alive connections
+# kept open to each API host
+AZURE_API_BASE = os.getenv('AZURE_API_BASE', 'https://gpt-for-social-media-chatbot.openai.azure.com/')
+LLM_POOL_SIZE = int(os.getenv('LLM_POOL_SIZE', 16))
+
+# Number of most recent generation prompts whose token counts are kept for /stats
+PROMPT_STATS_RECENT_CALLS = int(os.getenv('PROMPT_STATS_RECENT_CALLS', 100))
+
+
+# Completions are requested with temperature 0, so the same engine, prompt and
+# max_tokens always produce the same text and can be served from a cache. Entries
+# are kept in a memory LRU and, if a path is given, in a SQLite file shared by
+# every worker process and kept across restarts
+class CompletionCache:
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS completions (
+            key TEXT PRIMARY KEY,
+            completion TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created REAL NOT NULL,
+            used REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS completions_used ON completions (used);
+        CREATE INDEX IF NOT EXISTS completions_created ON completions (created);
+    '''
+
+    def __init__(self, max_entries: int, path: str, ttl: int, max_bytes: int, prune_interval: int):
+        self.max_entries = max_entries
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.prune_interval = prune_interval
+        self.last_prune = 0.0
+        self.bytes_since_prune = 0
+        self.entries = OrderedDict()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        if path != '':
+            directory = os.path.dirname(path)
+            if directory != '' and not os.path.exists(directory):
+                os.mkdir(directory)
+            with self.connection() as conn:
+                conn.executescript(self.SCHEMA)
+
+    # Return the cache key for a completion request
+    @staticmethod
+    def key(engine: str, prompt: str, max_tokens: int):
+        return hashlib.sha256(json.dumps([engine, prompt, max_tokens]).encode('utf-8')).hexdigest()
+
+    # Return this thread's connection to the on-disk tier
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self.local.conn = conn
+        return conn
+
+    # Return cached completion for the request if it has not expired, None otherwise
+    def get(self, engine: str, prompt: str, max_tokens: int):
+        key = self.key(engine, prompt, max_tokens)
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and now - entry[1] < self.ttl:
+                self.entries.move_to_end(key)
+                self.memory_hits += 1
+                return entry[0]
+            self.entries.pop(key, None)
+
+        if self.path != '':
+            with self.connection() as conn:
+                row = conn.execute('SELECT completion, created FROM completions WHERE key = ?', (key,)).fetchone()
+                if row is not None and now - row[1] < self.ttl:
+                    conn.execute('UPDATE completions SET used = ? WHERE key = ?', (now, key))
+                    with self.lock:
+                        self.disk_hits += 1
+                        self._put_memory(key, row[0], row[1])
+                    return row[0]
+                if row is not None:
+                    conn.execute('DELETE FROM completions WHERE key = ?', (key,))
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    # Add completion for the request to both tiers, evicting least recently used
+    # entries from memory right away and pruning the disk tier every prune interval
+    def put(self, engine: str, prompt: str, max_tokens: int, completion: str):
+        key = self.key(engine, prompt, max_tokens)
+        now = time.time()
+        size = len(key) + len(completion.encode('utf-8'))
+        with self.lock:
+            self._put_memory(key, completion, now)
+            self.bytes_since_prune += size
+            prune = self.path != '' and (now - self.last_prune >= self.prune_interval
+                                         or self.bytes_since_prune * 16 >= self.max_bytes)
+            if prune:
+                self.last_prune = now
+                self.bytes_since_prune = 0
+
+        if self.path != '':
+            with self.connection() as conn:
+                conn.execute('INSERT OR REPLACE INTO completions (key, completion, size, created, used) '
+                             'VALUES (?, ?, ?, ?, ?)', (key, completion, size, now, now))
+                if prune:
+                    self.prune(conn, now)
+
+    # Remove expired completions from disk, then least recently used ones until the
+    # disk byte bound is satisfied
+    def prune(self, conn, now: float):
+        conn.execute('DELETE FROM completions WHERE created <= ?', (now - self.ttl,))
+        total_bytes = conn.execute('SELECT COALESCE(SUM(size), 0) FROM completions').fetchone()[0]
+        if total_bytes > self.max_bytes:
+            conn.execute('''
+                DELETE FROM completions WHERE key IN (
+                    SELECT key FROM (
+                        SELECT key, SUM(size) OVER (ORDER BY used DESC) AS kept FROM completions
+                    ) WHERE kept > ?
+                )''', (self.max_bytes,))
+
+    # Remove every completion from both tiers and reset counters
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.memory_hits = 0
+            self.disk_hits = 0
+            self.misses = 0
+        if self.path != '':
+            with self.connection() as conn:
+                conn.execute('DELETE FROM completions')
+
+    # Return hit/miss counters for each tier and current cache usage
+    def stats(self):
+        with self.lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            stats = {'memory_hits': self.memory_hits,
+                     'disk_hits': self.disk_hits,
+                     'misses': self.misses,
+                     'hit_ratio': (self.memory_hits + self.disk_hits) / lookups if lookups > 0 else 0.0,
+                     'memory_hit_ratio': self.memory_hits / lookups if lookups > 0 else 0.0,
+                     'memory_entries': len(self.entries)}
+        if self.path != '':
+            row = self.connection().execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions').fetchone()
+            stats['disk_entries'], stats['disk_bytes'] = row
+        return stats
+
+    def _put_memory(self, key: str, completion: str, created: float):
+        self.entries[key] = (completion, created)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+token_encoding = None
+
+
+# Return the number of tokens in text for the davinci models. Counts are exact when
+# tiktoken is installed and otherwise one token per UTF-8 byte, an upper bound since
+# every byte pair encoding token holds at least one byte, so prompts kept within a
+# token budget by the estimate never exceed it
+def count_tokens(text: str):
+    global token_encoding
+    if tiktoken is not None:
+        if token_encoding is None:
+            token_encoding = tiktoken.get_encoding('p50k_base')
+        return len(token_encoding.encode(text))
+    return len(text.encode('utf-8'))
+
+
+# Prompt token counts of generation calls, and the number of history messages left
+# out of prompts or replaced with a summary to stay within budgets. Every call is
+# recorded on its own, and speculative calls, whose responses may be discarded, are
+# counted apart from the calls chats waited for
+class PromptTokenStats:
+    def __init__(self, recent_calls: int):
+        self.totals = {False: PromptTokenStats.Totals(), True: PromptTokenStats.Totals()}
+        self.recent = deque(maxlen=recent_calls)
+        self.lock = threading.Lock()
+
+    # Token and history trimming counters of one kind of call
+    class Totals:
+        def __init__(self):
+            self.calls = 0
+            self.total_tokens = 0
+            self.max_tokens = 0
+            self.last_tokens = 0
+            self.dropped_messages = 0
+            self.summaries = 0
+
+        def to_json(self):
+            return {'calls': self.calls,
+                    'mean_tokens': self.total_tokens / self.calls if self.calls > 0 else 0.0,
+                    'max_tokens': self.max_tokens,
+                    'last_tokens': self.last_tokens,
+                    'dropped_messages': self.dropped_messages,
+                    'summaries': self.summaries}
+
+    # Record a prompt with tokens tokens that left out dropped history messages, built
+    # for a speculative call if speculative is True
+    def record(self, tokens: int, dropped: int, summarized: bool, speculative: bool=False):
+        with self.lock:
+            totals = self.totals[speculative]
+            totals.calls += 1
+            totals.total_tokens += tokens
+            totals.max_tokens = max(totals.max_tokens, tokens)
+            totals.last_tokens = tokens
+            totals.dropped_messages += dropped
+            totals.summaries += summarized
+            self.recent.append({'tokens': tokens, 'dropped_messages': dropped,
+                                'summarized': summarized, 'speculative': speculative})
+
+    # Remove every recorded prompt
+    def clear(self):
+        with self.lock:
+            self.totals = {False: PromptTokenStats.Totals(), True: PromptTokenStats.Totals()}
+            self.recent.clear()
+
+    # Return prompt token counts and history trimming counters of the calls chats
+    # waited for and of speculative calls, along with the most recent calls, oldest
+    # first
+    def stats(self):
+        with self.lock:
+            return {**self.totals[False].to_json(),
+                    'speculative': self.totals[True].to_json(),
+                    'recent_calls': list(self.recent),
+                    'exact': tiktoken is not None}
+
+
+# Requests session shared by every thread for the lifetime of the process. The openai
+# module closes the session it is given every few minutes and then uses it again,
+# which would drop every pooled connection, so closing it does nothing
+class SharedSession(requests.Session):
+    def close(self):
+        pass
+
+
+# Return a requests session shared by every thread, holding up to pool_size
+# keep-alive connections per API host
+def create_http_session(pool_size: int):
+    session = SharedSession()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=2)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+# Completion client configured once at startup. Credentials are passed with each
+# request rather than written to the openai module globals, so clients for
+# different APIs can be used from any number of threads at the same time
+class LLMClient:
+    def __init__(self, engine: str, api_key: str, api_base: str=None, api_type: str=None, api_version: str=None):
+        self.engine = engine
+        self.api_key = api_key
+        self.api_base = api_base
+        self.api_type = api_type
+        self.api_version = api_version
+
+    # Send a completion request for prompt to the API
+    def create(self, prompt: str, max_tokens: int, stream: bool=False):
+        return openai.Completion.create(
+            engine=self.engine,
+            prompt=prompt,
+            temperature=0,
+            max_tokens=max_tokens,
+            stream=stream,
+            api_key=self.api_key,
+            api_base=self.api_base,
+            api_type=self.api_type,
+            api_version=self.api_version
+        )
+
+    # Return completion for prompt, from the completion cache if it was seen before
+    def complete(self, prompt: str, max_tokens: int):
+        completion = completion_cache.get(self.engine, prompt, max_tokens)
+        if completion is not None:
+            return completion
+
+        response = self.create(prompt, max_tokens)
+        completion = response['choices'][0]['text']
+        completion_cache.put(self.engine, prompt, max_tokens, completion)
+        return completion
+
+    # Yield completion for prompt in pieces as the API generates them. A completion
+    # found in the completion cache is yielded whole, and a completion streamed to
+    # the end is added to it
+    def stream(self, prompt: str, max_tokens: int):
+        completion = completion_cache.get(self.engine, prompt, max_tokens)
+        if completion is not None:
+            yield completion
+            return
+
+        pieces = []
+        for chunk in self.create(prompt, max_tokens, stream=True):
+            if len(chunk['choices']) == 0:
+                continue
+            piece = chunk['choices'][0].get('text', '')
+            pieces.append(piece)
+            yield piece
+        completion_cache.put(self.engine, prompt, max_tokens, ''.join(pieces))
+
+
+prompt_token_stats = PromptTokenStats(PROMPT_STATS_RECENT_CALLS)
+
+completion_cache = CompletionCache(COMPLETION_CACHE_MAX_ENTRIES, COMPLETION_CACHE_PATH,
+                                   COMPLETION_CACHE_TTL, COMPLETION_CACHE_MAX_BYTES, COMPLETION_CACHE_PRUNE_INTERVAL)
+
+http_session = create_http_session(LLM_POOL_SIZE)
+openai.requestssession = http_session
+
+openai_client = LLMClient('text-davinci-003', os.getenv('API_KEY_OPENAI'))
+azure_client = LLMClient('gpt3_davinci', os.getenv('API_KEY_AZURE'), AZURE_API_BASE, 'azure', '2022-12-01')
@@ -1,66 +1,248 @@
+from collections import OrderedDict
 from copy import deepcopy
+import fcntl
 import os
-import pickle
-
+from storage import create_storage, id_num, VersionConflict
+import threading
+
+
+# Maximum number of dialogue trees and total bytes kept in the tree cache
+TREE_CACHE_MAX_ENTRIES = 128
+TREE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# File holding the number of the next dialogue tree id to allocate
+DIALOGUE_ID_COUNTER = 'data/next_dialogue_id'
+
+# Prompt budget of a generation component: the number of most recent messages kept in
+# its prompt, the number of tokens its prompt may use and whether dropped messages are
+# replaced with a summary. None means unbounded
+DEFAULT_GENERATION_BUDGET = {'max_history_messages': None, 'max_prompt_tokens': None, 'summarize_history': False}
+
+
+class TreeCache:
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    # Return cached dialogue tree with id if its stamp matches, None otherwise
+    def get(self, id: str, stamp):
+        with self.lock:
+            entry = self.entries.get(id)
+            if entry is None or entry[0] != stamp:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(id)
+            self.hits += 1
+            return entry[1]
+
+    # Add dialogue tree to cache, evicting least recently used trees until
+    # both the entry and byte bounds are satisfied
+    def put(self, id: str, stamp, dt, size: int):
+        with self.lock:
+            self._remove(id)
+            if size > self.max_bytes:
+                return
+            self.entries[id] = (stamp, dt, size)
+            self.total_bytes += size
+            while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+
+    # Remove dialogue tree with id from cache if present
+    def invalidate(self, id: str):
+        with self.lock:
+            self._remove(id)
+
+    # Remove every dialogue tree from cache and reset counters
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    # Return hit/miss counters and current cache usage
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_ratio': self.hits / lookups if lookups > 0 else 0.0,
+                    'entries': len(self.entries),
+                    'bytes': self.total_bytes}
+
+    def _remove(self, id: str):
+        entry = self.entries.pop(id, None)
+        if entry is not None:
+            self.total_bytes -= entry[2]
+
+
+tree_cache = TreeCache(TREE_CACHE_MAX_ENTRIES, TREE_CACHE_MAX_BYTES)
+storage = create_storage()
 
 class DialogueTree():
-    def __init__(self, name: str):
-        self.id = DialogueTree.generate_dialogue_id()
+    def __init__(self, name: str, id: str=None):
+        self.id = id if id is not None else DialogueTree.generate_dialogue_id()
         self.name = name
-        self.components = []
+        self.components_by_id = {}
+        self.incoming = {}
+        self.next_component_nums = {}
+        self.version = None
+        self.changes = []
+        self.routing_plan = None
+
+    # Components are kept in a dict by id in the order they were added, so looking up
+    # and deleting a component take constant time
+    @property
+    def components(self):
+        return list(self.components_by_id.values())
+
+    # Recorded changes are only meaningful until the next save, and the incoming edge
+    # index and compiled routing plan can be rebuilt from the components, so none of
+    # them are pickled. Components are pickled as a list, as they were before the id
+    # index existed. Pickles saved before the component counters existed get them
+    # computed once from the component ids
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('changes', None)
+        state['components'] = list(state.pop('components_by_id').values())
+        state.pop('incoming', None)
+        state.pop('routing_plan', None)
+        return state
+
+    def __setstate__(self, state: dict):
+        state = dict(state)
+        components = state.pop('components')
+        state.pop('components_by_id', None)
+        self.__dict__.update(state)
+        self.changes = []
+        self.routing_plan = None
+        self.components_by_id = {component.id: component for component in components}
+        self.incoming = {component.id: [] for component in components}
+        for component in components:
+            for neighbor in component.neighbors:
+                self.incoming[neighbor.id].append(component)
+        if 'next_component_nums' not in state:
+            self.next_component_nums = {}
+            for component in components:
+                self.count_component_id(component.id)
+
+    # Copy every component on its own and then link the copies, so copying does not
+    # recurse along edges and long chains of components do not exhaust the stack
+    def __deepcopy__(self, memo: dict):
+        copies = {}
+        for component in self.components:
+            component_memo = {id(neighbor): neighbor for neighbor in component.neighbors if neighbor is not component}
+            copies[id(component)] = deepcopy(component, component_memo)
+        for component in self.components:
+            copies[id(component)].neighbors = [copies[id(neighbor)] for neighbor in component.neighbors]
+        memo.update(copies)
+        return copy_state(self, memo)
 
-    # Return a unique dialogue tree id of the form dt-{number}
+    # Return a unique dialogue tree id of the form dt-{number}. The next number is kept
+    # in a counter file that is incremented under an exclusive lock, so allocation takes
+    # constant time and concurrent workers never receive the same id
     @staticmethod
     def generate_dialogue_id():
         if not os.path.exists('data'):
             os.mkdir('data')
 
-        max_id_num = -1
-        for filename in os.listdir('data'):
-            id_num = int(filename[filename.index('-')+1:filename.index('.')])
-            max_id_num = max(id_num, max_id_num)
-        return f'dt-{max_id_num+1}'
+        fd = os.open(DIALOGUE_ID_COUNTER, os.O_RDWR | os.O_CREAT)
+        with os.fdopen(fd, 'r+') as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            contents = file.read().strip()
+            dialogue_num = int(contents) if contents != '' else storage.next_dialogue_num()
+            file.seek(0)
+            file.truncate()
+            file.write(str(dialogue_num+1))
+            file.flush()
+            os.fsync(file.fileno())
+        return f'dt-{dialogue_num}'
     
-    # Return a unique component id of the form {component_type}-{number}
+    # Return a unique component id of the form {component_type}-{number}. Numbers come
+    # from a per-type counter, so ids are never reused after a component is deleted
     def generate_component_id(self, component_type: str):
-        max_id_num = -1
-        for component in self.components:
-            if component.id.split('-')[0] == component_type:
-                id_num = int(component.id.split('-')[1])
-                max_id_num = max(id_num, max_id_num)
-        return f'{component_type}-{max_id_num+1}'
+        return f'{component_type}-{self.next_component_nums.get(component_type, 0)}'
 
-    # Load dialogue tree from data directory
+    # Advance the counter of a component id's type past the id's number
+    def count_component_id(self, id: str):
+        component_type = id.split('-')[0]
+        self.next_component_nums[component_type] = max(self.next_component_nums.get(component_type, 0), id_num(id)+1)
+
+    # Return True if a dialogue tree with id is stored
+    @staticmethod
+    def exists(id: str):
+        return storage.exists(id)
+
+    # Load dialogue tree from storage, reusing the cached tree if it has not been
+    # saved since it was last read. The returned tree is shared between requests, so
+    # it must be copied before being mutated
     @staticmethod
     def load(id: str):
-        with open(f'data/{id}.pkl', 'rb') as file:
-            dt = pickle.load(file)
+        stamp = storage.stamp(id)
+        dt = tree_cache.get(id, stamp)
+        if dt is not None:
+            return dt
+
+        dt, size = storage.load(id)
+        tree_cache.put(id, dt.version, dt, size)
         return dt
 
-    # Save dialogue tree to data directory
-    def save(self):
-        with open(f'data/{self.id}.pkl', 'wb') as file:
-            pickle.dump(self, file)
+    # Return a private copy of the dialogue tree that can be mutated without affecting
+    # the shared cached tree
+    def copy(self):
+        return deepcopy(self)
 
-    # Delete dialogue tree from data directory
+    # Save dialogue tree to storage, passing along the changes recorded since the
+    # last save, and refresh its cache entry. Raises VersionConflict if the tree was
+    # saved by another request since this copy was loaded. If the save fails for any
+    # reason the cache entry is dropped, so the next load reads what was stored
+    def save(self):
+        try:
+            stamp, size = storage.save(self, self.changes)
+        except Exception:
+            tree_cache.invalidate(self.id)
+            raise
+        self.changes = []
+        tree_cache.put(self.id, stamp, self, size)
+
+    # Delete dialogue tree from storage
     def delete(self):
-        os.remove(f'data/{self.id}.pkl')
+        storage.delete(self.id)
+        tree_cache.invalidate(self.id)
+
+    # Record a mutation so that storage backends can persist only what changed, and
+    # discard the routing plan compiled before it
+    def record_change(self, op: str, args: list, result=None):
+        self.routing_plan = None
+        change = {'op': op, 'args': args}
+        if result is not None:
+            change['result'] = result
+        self.changes.append(change)
 
     # Copy existing component in the dialogue tree and return
     # the copy's id
     def copy_component(self, component_type: str, id: str):
-        component_copy = deepcopy(self.get_component(id))
+        component_copy = self.get_component(id).copy_without_neighbors()
         component_copy.id = self.generate_component_id(component_type)
-        component_copy.neighbors = []
-        self.components.append(component_copy)
+        self.append_component(component_copy)
+        self.record_change('copy_component', [component_type, id], component_copy.id)
         return component_copy.id
 
     # Return component with id if it exists, None otherwise
     def get_component(self, id: str):
-        for component in self.components:
-            if component.id == id:
-                return component
-        return None
+        return self.components_by_id.get(id)
+
+    # Append component to the dialogue tree
+    def append_component(self, component: 'Component'):
+        self.components_by_id[component.id] = component
+        self.incoming[component.id] = []
+        self.count_component_id(component.id)
     
     # Return list of component ids for every component in dialogue tree
     def get_component_ids(self):
@@ -83,34 +265,145 @@ class DialogueTree():
     def add_component(self, component_type: str, name: str):
         id = self.generate_component_id(component_type)
         component = Generation(id, name) if component_type == 'gc' else Detection(id, name)
-        self.components.append(component)
+        self.append_component(component)
+        self.record_change('add_component', [component_type, name], id)
         return id
     
-    # Add directed edge between components
-    def add_edge(self, start_id: str, end_id: str):
+    # Return True if there is a directed edge between components with ids start_id
+    # and end_id
+    def has_edge(self, start_id: str, end_id: str):
         start_component = self.get_component(start_id)
         end_component = self.get_component(end_id)
+        return start_component is not None and end_component in start_component.neighbors
+
+    # Add directed edge between components
+    def add_edge(self, start_id: str, end_id: str):
+        self.append_edge(self.get_component(start_id), self.get_component(end_id))
+        self.record_change('add_edge', [start_id, end_id])
+
+    # Append directed edge to the start component's neighbors and the end component's
+    # incoming edges
+    def append_edge(self, start_component: 'Component', end_component: 'Component'):
         start_component.neighbors.append(end_component)
+        self.incoming[end_component.id].append(start_component)
 
-    # Delete component and any edges connected to it
+    # Delete component and any edges connected to it, visiting only the component's
+    # own incoming and outgoing edges
     def delete_component(self, id: str):
         component = self.get_component(id)
-        for edge in self.get_edges():
-            if component.id == edge['end']:
-                self.delete_edge(edge['start'], edge['end'])
-        self.components.remove(component)
+        for predecessor in self.incoming.pop(id):
+            if predecessor is not component:
+                predecessor.neighbors.remove(component)
+        for neighbor in component.neighbors:
+            if neighbor is not component:
+                self.incoming[neighbor.id].remove(component)
+        component.neighbors = []
+        del self.components_by_id[id]
+        self.record_change('delete_component', [id])
 
     # Delete directed edge between components with ids start_id and end_id
     def delete_edge(self, start_id: str, end_id: str):
         start_component = self.get_component(start_id)
         end_component = self.get_component(end_id)
         start_component.neighbors.remove(end_component)
+        self.incoming[end_id].remove(start_component)
+        self.record_change('delete_edge', [start_id, end_id])
+
+    # Edit dialogue tree name
+    def edit_name(self, name: str):
+        self.name = name
+        self.record_change('edit_name', [name])
+
+    # Edit name of component with id c_id
+    def edit_component_name(self, c_id: str, name: str):
+        self.get_component(c_id).name = name
+        self.record_change('edit_component_name', [c_id, name])
+
+    # Edit class of generation component with id gc_id
+    def edit_generation_class(self, gc_id: str, gen_class: str):
+        self.get_component(gc_id).gen_class = gen_class
+        self.record_change('edit_generation_class', [gc_id, gen_class])
+
+    # Edit prompt budget settings of generation component with id gc_id
+    def edit_generation_budget(self, gc_id: str, budget: dict):
+        self.get_component(gc_id).budget.update(budget)
+        self.record_change('edit_generation_budget', [gc_id, budget])
+
+    # Add example to generation component with id gc_id and return its id
+    def add_generation_example(self, gc_id: str, context: str, response: str):
+        gc = self.get_component(gc_id)
+        ex_id = gc.add_example(context, response)
+        gc.invalidate_compiled()
+        self.record_change('add_generation_example', [gc_id, context, response], ex_id)
+        return ex_id
+
+    # Edit context and/or response of generation component example
+    def edit_generation_example(self, gc_id: str, ex_id: str, context: str or None, response: str or None):
+        gc = self.get_component(gc_id)
+        gc.get_example(ex_id).edit_example(context, response)
+        gc.reindex_example(ex_id)
+        gc.invalidate_compiled()
+        self.record_change('edit_generation_example', [gc_id, ex_id, context, response])
+
+    # Delete example from generation component
+    def delete_generation_example(self, gc_id: str, ex_id: str):
+        gc = self.get_component(gc_id)
+        gc.delete_example(ex_id)
+        gc.invalidate_compiled()
+        self.record_change('delete_generation_example', [gc_id, ex_id])
+
+    # Add class to detection component with id dc_id and return its id
+    def add_detection_class(self, dc_id: str, det_class: str):
+        dc = self.get_component(dc_id)
+        cls_id = dc.add_class(det_class)
+        dc.invalidate_compiled()
+        self.record_change('add_detection_class', [dc_id, det_class], cls_id)
+        return cls_id
+
+    # Edit name of detection class
+    def edit_detection_class_name(self, dc_id: str, cls_id: str, det_class: str):
+        dc = self.get_component(dc_id)
+        dc.get_class(cls_id).det_class = det_class
+        dc.invalidate_compiled()
+        self.record_change('edit_detection_class_name', [dc_id, cls_id, det_class])
+
+    # Delete class from detection component
+    def delete_detection_class(self, dc_id: str, cls_id: str):
+        dc = self.get_component(dc_id)
+        dc.delete_class(cls_id)
+        dc.invalidate_compiled()
+        self.record_change('delete_detection_class', [dc_id, cls_id])
+
+    # Add example to detection class and return its id
+    def add_detection_example(self, dc_id: str, cls_id: str, example: str):
+        dc = self.get_component(dc_id)
+        ex_id = dc.get_class(cls_id).add_example(example)
+        dc.invalidate_compiled()
+        self.record_change('add_detection_example', [dc_id, cls_id, example], ex_id)
+        return ex_id
+
+    # Edit text of detection class example
+    def edit_detection_example(self, dc_id: str, cls_id: str, ex_id: str, example: str):
+        dc = self.get_component(dc_id)
+        cls = dc.get_class(cls_id)
+        cls.get_example(ex_id).example = example
+        cls.reindex_example(ex_id)
+        dc.invalidate_compiled()
+        self.record_change('edit_detection_example', [dc_id, cls_id, ex_id, example])
+
+    # Delete example from detection class
+    def delete_detection_example(self, dc_id: str, cls_id: str, ex_id: str):
+        dc = self.get_component(dc_id)
+        dc.get_class(cls_id).delete_example(ex_id)
+        dc.invalidate_compiled()
+        self.record_change('delete_detection_example', [dc_id, cls_id, ex_id])
 
     # Return a JSON representation for a dialogue tree
     def to_json(self):
         result = {}
         result['id'] = self.id
         result['name'] = self.name
+        result['version'] = self.version
 
         if self.components == []:
             result['components'] = 'not provided'
@@ -125,37 +418,100 @@ class DialogueTree():
         return result
 
 
+# Return a deep copy of obj made from the state it pickles, so the attributes it
+# rebuilds rather than pickles start out reset in the copy, as after unpickling
+def copy_state(obj, memo: dict):
+    copy = obj.__class__.__new__(obj.__class__)
+    memo[id(obj)] = copy
+    copy.__setstate__(deepcopy(obj.__getstate__(), memo))
+    return copy
+
+
 class Component:
     def __init__(self, id: str, name: str):
         self.id = id
         self.name = name
         self.neighbors = []
+        self.prompt_prefix = None
 
     # Return True if component is a leaf in the tree, False otherwise
     def is_leaf(self):
         return self.neighbors == []
 
+    # Discard the compiled prompt prefix after the component's classes or examples change
+    def invalidate_compiled(self):
+        self.prompt_prefix = None
+
+    # Return a deep copy of the component without its outgoing edges. Neighbors are
+    # memoized as themselves so that deepcopy does not copy every component reachable
+    # from this one
+    def copy_without_neighbors(self):
+        memo = {id(neighbor): neighbor for neighbor in self.neighbors if neighbor is not self}
+        component_copy = deepcopy(self, memo)
+        component_copy.neighbors = []
+        return component_copy
+
 
 class Generation(Component):
     def __init__(self, id: str, name: str):
         super().__init__(id, name)
         self.gen_class = ''
+        self.budget = dict(DEFAULT_GENERATION_BUDGET)
         self.examples = []
-
-    # Return a unique example id of the form ex-{number}
+        self.examples_by_id = {}
+        self.next_example_num = 0
+        self.example_index = None
+
+    # The id index, compiled prompt prefix and example similarity index are rebuilt
+    # rather than pickled. Pickles saved before the example counter or prompt budget
+    # existed get the counter computed once from the example ids and the default budget
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('examples_by_id', None)
+        state.pop('prompt_prefix', None)
+        state.pop('example_index', None)
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self.examples_by_id = {example.id: example for example in self.examples}
+        self.prompt_prefix = None
+        self.example_index = None
+        if 'next_example_num' not in state:
+            self.next_example_num = max([id_num(example.id)+1 for example in self.examples], default=0)
+        if 'budget' not in state:
+            self.budget = dict(DEFAULT_GENERATION_BUDGET)
+
+    # Copies share the compiled prompt prefix, which is replaced rather than changed
+    # when the examples change, and get their own copy of the similarity index, so
+    # copying a tree to edit it does not throw away what its prompts were built from
+    def __deepcopy__(self, memo: dict):
+        copy = copy_state(self, memo)
+        copy.prompt_prefix = self.prompt_prefix
+        copy.example_index = self.example_index.copy() if self.example_index is not None else None
+        return copy
+
+    # Return a unique example id of the form ex-{number}. Numbers are never reused
+    # after an example is deleted
     def generate_example_id(self):
-        max_id_num = -1
-        for example in self.examples:
-            id_num = int(example.id.split('-')[1])
-            max_id_num = max(id_num, max_id_num)
-        return f'ex-{max_id_num+1}'
+        return f'ex-{self.next_example_num}'
     
     # Return example with id if it exists, None otherwise
     def get_example(self, id: str):
-        for example in self.examples:
-            if example.id == id:
-                return example
-        return None
+        return self.examples_by_id.get(id)
+
+    # Append example to generation component and its id and similarity indexes
+    def append_example(self, example: 'Generation.GenerationExample'):
+        self.examples.append(example)
+        self.examples_by_id[example.id] = example
+        self.next_example_num = max(self.next_example_num, id_num(example.id)+1)
+        if self.example_index is not None:
+            self.example_index.add(example.id, example.context)
+
+    # Update the similarity index after the context of example with id is edited
+    def reindex_example(self, id: str):
+        if self.example_index is not None:
+            self.example_index.update(id, self.get_example(id).context)
     
     # Return a list of examples to be used in generation prompt
     def get_examples(self):
@@ -170,13 +526,15 @@ class Generation(Component):
     def add_example(self, context: str, response: str):
         id = self.generate_example_id()
         new_example = self.GenerationExample(id, context, response)
-        self.examples.append(new_example)
+        self.append_example(new_example)
         return id
     
     # Delete example with id from examples
     def delete_example(self, id: str):
-        example = self.get_example(id)
+        example = self.examples_by_id.pop(id)
         self.examples.remove(example)
+        if self.example_index is not None:
+            self.example_index.remove(id)
 
     # Return a JSON representation for a generation component
     def to_json(self):
@@ -188,6 +546,8 @@ class Generation(Component):
             result['class'] = self.gen_class
         else: 
             result['class'] = 'not provided'
+
+        result['budget'] = self.budget
             
         if self.examples == []:
             result['examples'] = 'not provided'
@@ -219,21 +579,56 @@ class Detection(Component):
     def __init__(self, id: str, name: str):
         super().__init__(id, name)
         self.classes = []
-
-    # Return a unique class id of the form cls-{number}
+        self.classes_by_id = {}
+        self.next_class_num = 0
+        self.classifier = None
+
+    # The id index, compiled prompt prefix and local classifier are rebuilt rather
+    # than pickled. Pickles saved before the class counter existed get
+    # it computed once from the class ids
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('classes_by_id', None)
+        state.pop('prompt_prefix', None)
+        state.pop('classifier', None)
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self.classes_by_id = {cls.id: cls for cls in self.classes}
+        self.prompt_prefix = None
+        self.classifier = None
+        if 'next_class_num' not in state:
+            self.next_class_num = max([id_num(cls.id)+1 for cls in self.classes], default=0)
+
+    # Copies share the compiled prompt prefix and local classifier, which are replaced
+    # rather than changed when the classes or examples change
+    def __deepcopy__(self, memo: dict):
+        copy = copy_state(self, memo)
+        copy.prompt_prefix = self.prompt_prefix
+        copy.classifier = self.classifier
+        return copy
+
+    # Discard the compiled prompt prefix and local classifier after the component's
+    # classes or examples change
+    def invalidate_compiled(self):
+        super().invalidate_compiled()
+        self.classifier = None
+
+    # Return a unique class id of the form cls-{number}. Numbers are never reused
+    # after a class is deleted
     def generate_class_id(self):
-        max_id_num = -1
-        for cls in self.classes:
-            id_num = int(cls.id.split('-')[1])
-            max_id_num = max(id_num, max_id_num)
-        return f'cls-{max_id_num+1}'
+        return f'cls-{self.next_class_num}'
     
     # Return DetectionClass with id if it exists, None otherwise
     def get_class(self, id: str):
-        for cls in self.classes:
-            if cls.id == id:
-                return cls
-        return None
+        return self.classes_by_id.get(id)
+
+    # Append DetectionClass to detection component and its id index
+    def append_class(self, cls: 'Detection.DetectionClass'):
+        self.classes.append(cls)
+        self.classes_by_id[cls.id] = cls
+        self.next_class_num = max(self.next_class_num, id_num(cls.id)+1)
     
     # Return a list of class names to be used in detection prompt
     def get_classes(self):
@@ -262,12 +657,12 @@ class Detection(Component):
     def add_class(self, det_class: str):
         id = self.generate_class_id()
         new_class = self.DetectionClass(id, det_class)
-        self.classes.append(new_class)
+        self.append_class(new_class)
         return id
     
     # Delete DetectionClass with id from classes
     def delete_class(self, id: str):
-        cls = self.get_class(id)
+        cls = self.classes_by_id.pop(id)
         self.classes.remove(cls)
 
     # Return a JSON representation for a detection component
@@ -292,21 +687,53 @@ class Detection(Component):
             self.id = id
             self.det_class = det_class
             self.examples = []
-
-        # Return a unique example id of the form ex-{number}
+            self.examples_by_id = {}
+            self.next_example_num = 0
+            self.example_index = None
+
+        # The id and similarity indexes are rebuilt from the examples rather than pickled.
+        # Pickles saved before the example counter existed get it computed once from
+        # the example ids
+        def __getstate__(self):
+            state = self.__dict__.copy()
+            state.pop('examples_by_id', None)
+            state.pop('example_index', None)
+            return state
+
+        def __setstate__(self, state: dict):
+            self.__dict__.update(state)
+            self.examples_by_id = {example.id: example for example in self.examples}
+            self.example_index = None
+            if 'next_example_num' not in state:
+                self.next_example_num = max([id_num(example.id)+1 for example in self.examples], default=0)
+
+        # Copies get their own copy of the similarity index
+        def __deepcopy__(self, memo: dict):
+            copy = copy_state(self, memo)
+            copy.example_index = self.example_index.copy() if self.example_index is not None else None
+            return copy
+
+        # Return a unique example id of the form ex-{number}. Numbers are never reused
+        # after an example is deleted
         def generate_example_id(self):
-            max_id_num = -1
-            for example in self.examples:
-                id_num = int(example.id.split('-')[1])
-                max_id_num = max(id_num, max_id_num)
-            return f'ex-{max_id_num+1}'
+            return f'ex-{self.next_example_num}'
         
         # Return DetectionExample with id if it exists, None otherwise
         def get_example(self, id: str):
-            for example in self.examples:
-                if example.id == id:
-                    return example
-            return None
+            return self.examples_by_id.get(id)
+
+        # Append DetectionExample to detection class and its id and similarity indexes
+        def append_example(self, example: 'Detection.DetectionClass.DetectionExample'):
+            self.examples.append(example)
+            self.examples_by_id[example.id] = example
+            self.next_example_num = max(self.next_example_num, id_num(example.id)+1)
+            if self.example_index is not None:
+                self.example_index.add(example.id, example.example)
+
+        # Update the similarity index after example with id is edited
+        def reindex_example(self, id: str):
+            if self.example_index is not None:
+                self.example_index.update(id, self.get_example(id).example)
         
         # Return list of examples in detection class
         def get_examples(self):
@@ -319,13 +746,15 @@ class Detection(Component):
         def add_example(self, example: str):
             id = self.generate_example_id()
             new_example = self.DetectionExample(id, example)
-            self.examples.append(new_example)
+            self.append_example(new_example)
             return id
         
         # Delete example with id from examples
         def delete_example(self, id: str):
-            example = self.get_example(id)
+            example = self.examples_by_id.pop(id)
             self.examples.remove(example)
+            if self.example_index is not None:
+                self.example_index.remove(id)
 
         # Return a JSON representation for a detection class
         def to_json(self):
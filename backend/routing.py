@@ -0,0 +1,94 @@
+from models import Detection, DialogueTree, Generation
+import threading
+
+
+# Generation components that run one after another without a detection call between
+# them. After the last one the conversation continues at next, which is a generation
+# component on another path, a detection component, or None to exit. A path whose
+# components lead back into themselves can never finish and is marked cyclic
+class GenerationPath:
+    def __init__(self):
+        self.components = []
+        self.next = None
+        self.cyclic = False
+
+
+# Execution plan compiled from a dialogue tree. Every generation component is placed
+# on exactly one generation path, and every detection component with outgoing edges
+# has a table from class to the generation component its edges lead to, so a chat
+# turn follows table lookups instead of searching edges. The plan refers to the
+# components of the tree it was compiled from and must not outlive it
+class RoutingPlan:
+    def __init__(self, dt: type[DialogueTree]):
+        self.positions = {}
+        self.routes = {}
+
+        # start paths at generation components that do not follow another one, so
+        # chains are split into as few paths as possible
+        generations = [c for c in dt.components if isinstance(c, Generation)]
+        heads = [gc for gc in generations
+                 if not any(isinstance(c, Generation) and c.get_next_component() is gc for c in dt.incoming[gc.id])]
+        for gc in heads + generations:
+            if gc.id not in self.positions:
+                self.place_path(gc)
+
+        # when several outgoing generation components share a class, the last one wins
+        for dc in dt.components:
+            if isinstance(dc, Detection) and not dc.is_leaf():
+                self.routes[dc.id] = {gc.gen_class: gc for gc in dc.get_generation_edges()}
+
+    # Place gc and the generation components following it that are not yet placed on
+    # a new path
+    def place_path(self, gc: type[Generation]):
+        path = GenerationPath()
+        c = gc
+        while isinstance(c, Generation) and c.id not in self.positions:
+            self.positions[c.id] = (path, len(path.components))
+            path.components.append(c)
+            c = None if c.is_leaf() else c.get_next_component()
+
+        if isinstance(c, Generation):
+            next_path, _ = self.positions[c.id]
+            path.cyclic = next_path is path or next_path.cyclic
+        elif isinstance(c, Detection) and c.is_leaf():
+            c = None
+        path.next = c
+
+    # Return the generation path gc is on and gc's offset in it
+    def position(self, gc: type[Generation]):
+        return self.positions[gc.id]
+
+    # Return the generation component dc routes det_class to, or None if it has none
+    def route(self, dc: type[Detection], det_class: str):
+        return self.routes[dc.id].get(det_class)
+
+
+# How often chats left each detection component for each of its generation
+# components. Counts are kept per process by dialogue tree and component id rather
+# than on the tree, so copying, editing or reloading the tree keeps them
+class BranchCounts:
+    def __init__(self):
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    # Count a chat on dialogue tree dt_id going from detection component dc_id to
+    # generation component gc_id
+    def record(self, dt_id: str, dc_id: str, gc_id: str):
+        with self.lock:
+            counts = self.counts.setdefault((dt_id, dc_id), {})
+            counts[gc_id] = counts.get(gc_id, 0) + 1
+
+    # Return up to k outgoing generation components of dc on dialogue tree dt_id, most
+    # often taken first
+    def likely_generation_edges(self, dt_id: str, dc: type[Detection], k: int):
+        with self.lock:
+            counts = dict(self.counts.get((dt_id, dc.id), {}))
+        return sorted(dc.get_generation_edges(), key=lambda gc: -counts.get(gc.id, 0))[:k]
+
+    # Remove every count
+    def clear(self):
+        with self.lock:
+            self.counts.clear()
+
+
+branch_counts = BranchCounts()
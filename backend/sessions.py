@@ -0,0 +1,224 @@
+from collections import OrderedDict
+from dotenv import load_dotenv
+import os
+import secrets
+import sqlite3
+import threading
+import time
+
+
+load_dotenv()
+
+# Number of worker processes serving the app, which gunicorn also reads as its
+# default worker count
+WEB_CONCURRENCY = int(os.getenv('WEB_CONCURRENCY', 1))
+
+# Session store used by chat sessions: "memory", which is private to each worker
+# process, or "sqlite", which is shared by every worker process. Defaults to memory
+# with a single worker and to sqlite with more
+SESSION_BACKEND = os.getenv('SESSION_BACKEND', '')
+SESSION_SQLITE_PATH = os.getenv('SESSION_SQLITE_PATH', 'data/sessions.db')
+
+# Seconds a session stays alive after its conversation last changed
+SESSION_TTL = int(os.getenv('SESSION_TTL', 60 * 60))
+
+
+# Raised when appending to a session that another request appended to after it was read
+class SessionConflict(Exception):
+    pass
+
+
+# Conversation held on the server for a client chatting with a dialogue tree, along
+# with the component the next student message is sent to ("exit" once the
+# conversation reached a leaf)
+class Session:
+    def __init__(self, id: str, dt_id: str, component_id: str, messages: list, expires: float):
+        self.id = id
+        self.dt_id = dt_id
+        self.component_id = component_id
+        self.messages = messages
+        self.expires = expires
+
+    def to_json(self):
+        return {'id': self.id,
+                'dialogue_id': self.dt_id,
+                'component_id': self.component_id,
+                'messages': self.messages,
+                'expires': self.expires}
+
+
+# Return a new unguessable session id
+def new_session_id():
+    return f'ses-{secrets.token_hex(16)}'
+
+
+# Keeps sessions in a dictionary ordered by expiry time. Every append moves a session
+# to the end, so expired sessions are always at the front and purging them only touches
+# the sessions being removed
+class MemorySessionStore:
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    # Create a session on dialogue tree dt_id starting at component_id and return it
+    def create(self, dt_id: str, component_id: str, messages: list):
+        now = time.time()
+        session = Session(new_session_id(), dt_id, component_id, list(messages), now + self.ttl)
+        with self.lock:
+            self.purge(now)
+            self.sessions[session.id] = session
+        return self.snapshot(session)
+
+    # Return session with id, or None if it does not exist or has expired
+    def get(self, id: str):
+        now = time.time()
+        with self.lock:
+            self.purge(now)
+            session = self.sessions.get(id)
+            if session is None or session.expires <= now:
+                return None
+            return self.snapshot(session)
+
+    # Append messages to session with id and move it to component_id. Raise
+    # SessionConflict unless the session still has length messages
+    def append(self, id: str, length: int, messages: list, component_id: str):
+        now = time.time()
+        with self.lock:
+            session = self.sessions.get(id)
+            if session is None or session.expires <= now:
+                raise SessionConflict(f'session {id} has expired')
+            elif len(session.messages) != length:
+                raise SessionConflict(f'session {id} was modified by another request')
+            session.messages.extend(messages)
+            session.component_id = component_id
+            session.expires = now + self.ttl
+            self.sessions.move_to_end(id)
+
+    # Delete session with id
+    def delete(self, id: str):
+        with self.lock:
+            self.sessions.pop(id, None)
+
+    # Remove sessions that expired by now. Must be called holding the lock
+    def purge(self, now: float):
+        while len(self.sessions) > 0:
+            id, session = next(iter(self.sessions.items()))
+            if session.expires > now:
+                break
+            del self.sessions[id]
+
+    # Return a copy of session that later appends do not change
+    def snapshot(self, session: type[Session]):
+        return Session(session.id, session.dt_id, session.component_id, list(session.messages), session.expires)
+
+
+# Keeps sessions in a SQLite database, with one row per message so that each turn
+# inserts only its new messages
+class SqliteSessionStore:
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS sessions (
+            id TEXT PRIMARY KEY,
+            tree_id TEXT NOT NULL,
+            component_id TEXT NOT NULL,
+            length INTEGER NOT NULL,
+            expires REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires);
+        CREATE TABLE IF NOT EXISTS session_messages (
+            session_id TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            message TEXT NOT NULL,
+            PRIMARY KEY (session_id, position)
+        );
+    '''
+
+    def __init__(self, path: str, ttl: int):
+        self.path = path
+        self.ttl = ttl
+        self.local = threading.local()
+        directory = os.path.dirname(path)
+        if directory != '' and not os.path.exists(directory):
+            os.mkdir(directory)
+        with self.connection() as conn:
+            conn.executescript(self.SCHEMA)
+
+    # Return this thread's connection to the database
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    # Create a session on dialogue tree dt_id starting at component_id and return it
+    def create(self, dt_id: str, component_id: str, messages: list):
+        now = time.time()
+        session = Session(new_session_id(), dt_id, component_id, list(messages), now + self.ttl)
+        with self.connection() as conn:
+            self.purge(conn, now)
+            conn.execute('INSERT INTO sessions (id, tree_id, component_id, length, expires) VALUES (?, ?, ?, ?, ?)',
+                         (session.id, dt_id, component_id, len(messages), session.expires))
+            self.insert_messages(conn, session.id, 0, messages)
+        return session
+
+    # Return session with id, or None if it does not exist or has expired
+    def get(self, id: str):
+        now = time.time()
+        with self.connection() as conn:
+            row = conn.execute('SELECT tree_id, component_id, expires FROM sessions WHERE id = ?', (id,)).fetchone()
+            if row is None or row[2] <= now:
+                return None
+            messages = [{'role': role, 'message': message} for role, message in conn.execute(
+                'SELECT role, message FROM session_messages WHERE session_id = ? ORDER BY position', (id,))]
+        return Session(id, row[0], row[1], messages, row[2])
+
+    # Append messages to session with id and move it to component_id. Raise
+    # SessionConflict unless the session still has length messages
+    def append(self, id: str, length: int, messages: list, component_id: str):
+        now = time.time()
+        with self.connection() as conn:
+            updated = conn.execute('UPDATE sessions SET component_id = ?, length = ?, expires = ? '
+                                   'WHERE id = ? AND length = ? AND expires > ?',
+                                   (component_id, length + len(messages), now + self.ttl, id, length, now)).rowcount
+            if updated == 0:
+                raise SessionConflict(f'session {id} has expired or was modified by another request')
+            self.insert_messages(conn, id, length, messages)
+
+    # Delete session with id
+    def delete(self, id: str):
+        with self.connection() as conn:
+            conn.execute('DELETE FROM sessions WHERE id = ?', (id,))
+            conn.execute('DELETE FROM session_messages WHERE session_id = ?', (id,))
+
+    # Remove sessions that expired by now, along with their messages
+    def purge(self, conn, now: float):
+        conn.execute('DELETE FROM session_messages WHERE session_id IN (SELECT id FROM sessions WHERE expires <= ?)',
+                     (now,))
+        conn.execute('DELETE FROM sessions WHERE expires <= ?', (now,))
+
+    def insert_messages(self, conn, id: str, start: int, messages: list):
+        conn.executemany('INSERT INTO session_messages (session_id, position, role, message) VALUES (?, ?, ?, ?)',
+                         [(id, start + i, message['role'], message['message']) for i, message in enumerate(messages)])
+
+
+# Return the session store selected by SESSION_BACKEND. A memory store is refused
+# with more than one worker, since requests for a session would reach workers that
+# do not have it
+def create_session_store():
+    backend = SESSION_BACKEND or ('sqlite' if WEB_CONCURRENCY > 1 else 'memory')
+    if backend == 'memory':
+        if WEB_CONCURRENCY > 1:
+            raise ValueError(f'memory session backend cannot be shared by {WEB_CONCURRENCY} workers, '
+                             'use SESSION_BACKEND=sqlite')
+        return MemorySessionStore(SESSION_TTL)
+    elif backend == 'sqlite':
+        return SqliteSessionStore(SESSION_SQLITE_PATH, SESSION_TTL)
+    else:
+        raise ValueError(f'unknown session backend {backend}')
+
+
+session_store = create_session_store()
@@ -0,0 +1,674 @@
+from dotenv import load_dotenv
+import fcntl
+import json
+import os
+import pickle
+import sqlite3
+import sys
+import threading
+
+
+load_dotenv()
+
+# Storage backend used by DialogueTree.load/save/delete: "pickle", "sqlite" or "log"
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'pickle')
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'data/dialogues.db')
+
+# Size in bytes at which an operation log is folded into a new snapshot
+LOG_COMPACTION_BYTES = int(os.getenv('LOG_COMPACTION_BYTES', 64 * 1024))
+
+
+# Return the number in an id of the form {prefix}-{number}
+def id_num(id: str):
+    return int(id[id.rindex('-')+1:])
+
+
+# Return the number following the largest dt-{number} id in ids
+def next_dialogue_num(ids: list):
+    max_id_num = -1
+    for id in ids:
+        if id.startswith('dt-') and id[3:].isdigit():
+            max_id_num = max(int(id[3:]), max_id_num)
+    return max_id_num + 1
+
+
+# Raised when saving a dialogue tree that was changed or deleted by another request
+# after it was loaded
+class VersionConflict(Exception):
+    pass
+
+
+# Stores each dialogue tree as a pickle file in the data directory, next to a version
+# file holding its current version. Every save rewrites the whole pickle, so recorded
+# changes are ignored
+class PickleStorage:
+    # Return True if a dialogue tree with id is stored. A single stat keeps the
+    # check constant-time regardless of how many trees are stored
+    def exists(self, id: str):
+        return os.sep not in id and os.path.isfile(f'data/{id}.pkl')
+
+    # Return the version of a dialogue tree, which is incremented by every save.
+    # Trees saved before versions existed are at version 0
+    def stamp(self, id: str):
+        try:
+            with open(f'data/{id}.version') as file:
+                return self.read_version(file)
+        except FileNotFoundError:
+            os.stat(f'data/{id}.pkl')
+            return 0
+
+    # Open the version file of dialogue tree with id and lock it with mode. The version
+    # file is rewritten in place and never replaced, so it doubles as the tree's lock.
+    # Only saves create a missing version file, so reading or deleting a tree that was
+    # deleted in the meantime raises FileNotFoundError instead of leaving an orphan
+    # version file behind
+    def lock_version(self, id: str, mode: int, create: bool=False):
+        if create:
+            file = os.fdopen(os.open(f'data/{id}.version', os.O_RDWR | os.O_CREAT), 'r+')
+        else:
+            file = open(f'data/{id}.version')
+        fcntl.flock(file, mode)
+        return file
+
+    # Return the version in a locked version file
+    def read_version(self, file):
+        file.seek(0)
+        contents = file.read().strip()
+        return int(contents) if contents != '' else 0
+
+    # Overwrite the version in a locked version file. The number is padded to a fixed
+    # width so that a single write replaces it completely
+    def write_version(self, file, version: int):
+        file.seek(0)
+        file.write(f'{version:>20}')
+        file.flush()
+
+    # Raise VersionConflict unless the stored tree is still at the version dt was
+    # loaded from, then return the version dt will be saved as
+    def check_version(self, dt, file):
+        if dt.version is None:
+            if os.path.exists(f'data/{dt.id}.pkl'):
+                raise VersionConflict(f'dialogue tree {dt.id} already exists')
+            return 0
+        elif not os.path.exists(f'data/{dt.id}.pkl'):
+            raise VersionConflict(f'dialogue tree {dt.id} was deleted')
+        elif self.read_version(file) != dt.version:
+            raise VersionConflict(f'dialogue tree {dt.id} was modified by another request')
+        return dt.version + 1
+
+    # Return dialogue tree with id and its size in bytes
+    def load(self, id: str):
+        version = self.stamp(id)
+        dt, size = self.read_snapshot(id)
+        dt.version = version
+        return dt, size
+
+    # Return pickled dialogue tree with id and its size in bytes
+    def read_snapshot(self, id: str):
+        with open(f'data/{id}.pkl', 'rb') as file:
+            dt = pickle.load(file)
+            size = os.fstat(file.fileno()).st_size
+        return dt, size
+
+    # Atomically replace the pickle of a dialogue tree, so a worker dying mid-write
+    # never leaves a torn file behind
+    def write_snapshot(self, dt):
+        with open(f'data/{dt.id}.pkl.tmp', 'wb') as file:
+            pickle.dump(dt, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(f'data/{dt.id}.pkl.tmp', f'data/{dt.id}.pkl')
+
+    # Write dialogue tree if it is still at the version it was loaded from, and return
+    # its new version and size in bytes
+    def save(self, dt, changes: list):
+        with self.lock_version(dt.id, fcntl.LOCK_EX, create=True) as file:
+            version = self.check_version(dt, file)
+            dt.version = version
+            self.write_snapshot(dt)
+            self.write_version(file, version)
+        return version, os.path.getsize(f'data/{dt.id}.pkl')
+
+    # Delete dialogue tree with id. The version file goes first, so deleting a tree
+    # that is already gone does not leave it behind
+    def delete(self, id: str):
+        with self.lock_version(id, fcntl.LOCK_EX, create=True):
+            os.remove(f'data/{id}.version')
+            os.remove(f'data/{id}.pkl')
+
+    # Return the number of the next dialogue tree id, based on stored trees
+    def next_dialogue_num(self):
+        ids = [filename[:-len('.pkl')] for filename in os.listdir('data') if filename.endswith('.pkl')]
+        return next_dialogue_num(ids)
+
+
+# Stores each dialogue tree as a pickled snapshot plus an append-only log of the
+# changes made since the snapshot, so a save only costs as much as the edit. Loads
+# replay the log on top of the snapshot, and a background thread folds the log into
+# a new snapshot once it grows past LOG_COMPACTION_BYTES. Every access to a tree's
+# files happens under an flock on its version file, so readers never see a
+# half-compacted tree. Logged changes carry the version of the save that made them
+# and snapshots carry the version they were taken at, so changes a snapshot already
+# contains are skipped if a compaction dies before emptying the log
+class LogStorage(PickleStorage):
+    def __init__(self, compaction_bytes: int):
+        self.compaction_bytes = compaction_bytes
+        self.compacting = set()
+        self.compacting_lock = threading.Lock()
+
+    # Return dialogue tree with id, with its log replayed, and its size in bytes. Trees
+    # saved before versions existed have no version file and no log
+    def load(self, id: str):
+        try:
+            file = self.lock_version(id, fcntl.LOCK_SH)
+        except FileNotFoundError:
+            return super().load(id)
+        with file:
+            version = self.read_version(file)
+            dt, size = self.replay(id)
+        dt.version = version
+        return dt, size
+
+    # Return snapshot of dialogue tree with id after applying every change in its log
+    # that the snapshot does not contain yet. A trailing line without a newline is a
+    # write torn by a crash and is skipped. Changes logged before versions were logged
+    # are always applied
+    def replay(self, id: str):
+        dt, size = self.read_snapshot(id)
+        snapshot_version = getattr(dt, 'version', None)
+        if os.path.exists(f'data/{id}.log'):
+            with open(f'data/{id}.log') as log:
+                for line in log:
+                    if not line.endswith('\n'):
+                        break
+                    change = json.loads(line)
+                    if snapshot_version is not None and change.get('version', snapshot_version + 1) <= snapshot_version:
+                        continue
+                    getattr(dt, change['op'])(*change['args'])
+                    size += len(line)
+        dt.changes = []
+        return dt, size
+
+    # Append changes to the log of an existing dialogue tree, or write a snapshot for a
+    # new one, and return the tree's new version and size in bytes
+    def save(self, dt, changes: list):
+        with self.lock_version(dt.id, fcntl.LOCK_EX, create=True) as file:
+            version = self.check_version(dt, file)
+            dt.version = version
+            if version == 0:
+                self.write_snapshot(dt)
+                open(f'data/{dt.id}.log', 'w').close()
+                log_size = 0
+            else:
+                with open(f'data/{dt.id}.log', 'a+') as log:
+                    self.repair_log(log)
+                    log.write(''.join(json.dumps({**change, 'version': version}) + '\n' for change in changes))
+                    log.flush()
+                    os.fsync(log.fileno())
+                    log_size = log.tell()
+            self.write_version(file, version)
+        if log_size > self.compaction_bytes:
+            self.schedule_compaction(dt.id)
+        return version, os.path.getsize(f'data/{dt.id}.pkl') + log_size
+
+    # Truncate a log whose last line was torn by a crash back to its last complete line
+    def repair_log(self, log):
+        size = log.seek(0, os.SEEK_END)
+        if size == 0:
+            return
+        log.seek(size - 1)
+        if log.read(1) != '\n':
+            log.seek(0)
+            contents = log.read()
+            log.truncate(contents.rfind('\n') + 1)
+
+    # Delete dialogue tree with id and its log
+    def delete(self, id: str):
+        with self.lock_version(id, fcntl.LOCK_EX, create=True):
+            os.remove(f'data/{id}.version')
+            os.remove(f'data/{id}.pkl')
+            if os.path.exists(f'data/{id}.log'):
+                os.remove(f'data/{id}.log')
+
+    # Start compacting the log of dialogue tree with id in a background thread,
+    # unless a compaction of that tree is already running in this process
+    def schedule_compaction(self, id: str):
+        with self.compacting_lock:
+            if id in self.compacting:
+                return
+            self.compacting.add(id)
+        threading.Thread(target=self.compact, args=(id,), daemon=True).start()
+
+    # Fold the log of dialogue tree with id into a new snapshot and empty the log. The
+    # snapshot is stamped with the current version, so a crash before the log is
+    # emptied leaves a log whose changes are all skipped on replay
+    def compact(self, id: str):
+        try:
+            with self.lock_version(id, fcntl.LOCK_EX) as file:
+                if os.path.exists(f'data/{id}.pkl'):
+                    dt, _ = self.replay(id)
+                    dt.version = self.read_version(file)
+                    self.write_snapshot(dt)
+                    open(f'data/{id}.log', 'w').close()
+        except FileNotFoundError:
+            pass
+        finally:
+            with self.compacting_lock:
+                self.compacting.discard(id)
+
+
+# Stores dialogue trees in normalized SQLite tables. New trees are inserted in full,
+# while saves of existing trees turn each recorded change into targeted row writes
+# inside a single transaction
+class SqliteStorage:
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS trees (
+            id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            version INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS components (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            tree_id TEXT NOT NULL,
+            id TEXT NOT NULL,
+            type TEXT NOT NULL,
+            name TEXT NOT NULL,
+            gen_class TEXT NOT NULL,
+            budget TEXT,
+            UNIQUE (tree_id, id)
+        );
+        CREATE TABLE IF NOT EXISTS edges (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            tree_id TEXT NOT NULL,
+            start_id TEXT NOT NULL,
+            end_id TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS edges_tree ON edges (tree_id, start_id, end_id);
+        CREATE TABLE IF NOT EXISTS classes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            tree_id TEXT NOT NULL,
+            component_id TEXT NOT NULL,
+            id TEXT NOT NULL,
+            det_class TEXT NOT NULL,
+            UNIQUE (tree_id, component_id, id)
+        );
+        CREATE TABLE IF NOT EXISTS generation_examples (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            tree_id TEXT NOT NULL,
+            component_id TEXT NOT NULL,
+            id TEXT NOT NULL,
+            context TEXT NOT NULL,
+            response TEXT NOT NULL,
+            UNIQUE (tree_id, component_id, id)
+        );
+        CREATE TABLE IF NOT EXISTS detection_examples (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            tree_id TEXT NOT NULL,
+            component_id TEXT NOT NULL,
+            class_id TEXT NOT NULL,
+            id TEXT NOT NULL,
+            example TEXT NOT NULL,
+            UNIQUE (tree_id, component_id, class_id, id)
+        );
+        CREATE TABLE IF NOT EXISTS counters (
+            tree_id TEXT NOT NULL,
+            scope TEXT NOT NULL,
+            next_num INTEGER NOT NULL,
+            PRIMARY KEY (tree_id, scope)
+        );
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+        directory = os.path.dirname(path)
+        if directory != '' and not os.path.exists(directory):
+            os.mkdir(directory)
+        with self.connection() as conn:
+            conn.executescript(self.SCHEMA)
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(components)')]
+            if 'budget' not in columns:
+                conn.execute('ALTER TABLE components ADD COLUMN budget TEXT')
+
+    # Return this thread's connection to the database, since SQLite connections
+    # cannot be shared between threads
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self.local.conn = conn
+        return conn
+
+    # Return True if a dialogue tree with id is stored
+    def exists(self, id: str):
+        row = self.connection().execute('SELECT 1 FROM trees WHERE id = ?', (id,)).fetchone()
+        return row is not None
+
+    # Return the version of a dialogue tree, which is incremented by every save
+    def stamp(self, id: str):
+        row = self.connection().execute('SELECT version FROM trees WHERE id = ?', (id,)).fetchone()
+        if row is None:
+            raise FileNotFoundError(f'dialogue tree {id} does not exist')
+        return row[0]
+
+    # Return dialogue tree with id and an estimate of its size in bytes. The SELECTs
+    # run in one read transaction, since sqlite3 only opens transactions before writes
+    # and a save committing between them would otherwise mix rows of two versions
+    def load(self, id: str):
+        from models import DialogueTree, Generation, Detection
+
+        conn = self.connection()
+        with conn:
+            conn.execute('BEGIN')
+            row = conn.execute('SELECT name, version FROM trees WHERE id = ?', (id,)).fetchone()
+            if row is None:
+                raise FileNotFoundError(f'dialogue tree {id} does not exist')
+            name, version = row
+            dt = DialogueTree(name, id)
+            dt.version = version
+            size = len(name)
+
+            components = {}
+            rows = conn.execute('SELECT id, type, name, gen_class, budget FROM components WHERE tree_id = ? '
+                                'ORDER BY seq', (id,))
+            for c_id, c_type, c_name, gen_class, budget in rows:
+                if c_type == 'gc':
+                    component = Generation(c_id, c_name)
+                    component.gen_class = gen_class
+                    if budget is not None:
+                        component.budget.update(json.loads(budget))
+                else:
+                    component = Detection(c_id, c_name)
+                components[c_id] = component
+                dt.append_component(component)
+                size += len(c_name) + len(gen_class)
+
+            rows = conn.execute('SELECT start_id, end_id FROM edges WHERE tree_id = ? ORDER BY seq', (id,))
+            for start_id, end_id in rows:
+                dt.append_edge(components[start_id], components[end_id])
+
+            classes = {}
+            rows = conn.execute('SELECT component_id, id, det_class FROM classes WHERE tree_id = ? ORDER BY seq', (id,))
+            for component_id, cls_id, det_class in rows:
+                cls = Detection.DetectionClass(cls_id, det_class)
+                classes[(component_id, cls_id)] = cls
+                components[component_id].append_class(cls)
+                size += len(det_class)
+
+            rows = conn.execute('SELECT component_id, id, context, response FROM generation_examples '
+                                'WHERE tree_id = ? ORDER BY seq', (id,))
+            for component_id, ex_id, context, response in rows:
+                example = Generation.GenerationExample(ex_id, context, response)
+                components[component_id].append_example(example)
+                size += len(context) + len(response)
+
+            rows = conn.execute('SELECT component_id, class_id, id, example FROM detection_examples '
+                                'WHERE tree_id = ? ORDER BY seq', (id,))
+            for component_id, cls_id, ex_id, text in rows:
+                example = Detection.DetectionClass.DetectionExample(ex_id, text)
+                classes[(component_id, cls_id)].append_example(example)
+                size += len(text)
+
+            # appending already advanced every id counter past the largest stored id,
+            # stored counters also account for deleted ids
+            rows = conn.execute('SELECT scope, next_num FROM counters WHERE tree_id = ?', (id,))
+            for scope, next_num in rows:
+                owner = scope.split(':')
+                if owner[0] == 'components':
+                    dt.next_component_nums[owner[1]] = max(dt.next_component_nums.get(owner[1], 0), next_num)
+                elif owner[0] == 'classes' and owner[1] in components:
+                    components[owner[1]].next_class_num = max(components[owner[1]].next_class_num, next_num)
+                elif owner[0] == 'examples' and len(owner) == 2 and owner[1] in components:
+                    components[owner[1]].next_example_num = max(components[owner[1]].next_example_num, next_num)
+                elif owner[0] == 'examples' and (owner[1], owner[2]) in classes:
+                    cls = classes[(owner[1], owner[2])]
+                    cls.next_example_num = max(cls.next_example_num, next_num)
+        return dt, size
+
+    # Write dialogue tree if it is still at the version it was loaded from, and return
+    # its new version and estimated size in bytes. New trees are inserted in full,
+    # existing trees only get rows touched by changes
+    def save(self, dt, changes: list):
+        conn = self.connection()
+        with conn:
+            if dt.version is None:
+                version = 0
+                conn.execute('INSERT INTO trees (id, name, version) VALUES (?, ?, ?)', (dt.id, dt.name, version))
+                for component in dt.components:
+                    self.insert_component(conn, dt.id, component)
+                for component_type, next_num in dt.next_component_nums.items():
+                    self.write_counter(conn, dt.id, f'components:{component_type}', next_num)
+                for edge in dt.get_edges():
+                    self.apply_add_edge(conn, dt, edge['start'], edge['end'])
+            else:
+                version = dt.version + 1
+                cursor = conn.execute('UPDATE trees SET version = ? WHERE id = ? AND version = ?',
+                                      (version, dt.id, dt.version))
+                if cursor.rowcount == 0:
+                    raise VersionConflict(f'dialogue tree {dt.id} was modified or deleted by another request')
+                for change in changes:
+                    apply = getattr(self, f'apply_{change["op"]}')
+                    apply(conn, dt, *change['args'], *([change['result']] if 'result' in change else []))
+        dt.version = version
+        return version, self.estimate_size(dt)
+
+    # Delete dialogue tree with id and all of its rows
+    def delete(self, id: str):
+        conn = self.connection()
+        with conn:
+            for table in ['detection_examples', 'generation_examples', 'classes', 'edges', 'components', 'counters']:
+                conn.execute(f'DELETE FROM {table} WHERE tree_id = ?', (id,))
+            conn.execute('DELETE FROM trees WHERE id = ?', (id,))
+
+    # Return the number of the next dialogue tree id, based on stored trees
+    def next_dialogue_num(self):
+        ids = [row[0] for row in self.connection().execute('SELECT id FROM trees')]
+        return next_dialogue_num(ids)
+
+    # Return approximate in-memory size of a dialogue tree's text in bytes
+    @staticmethod
+    def estimate_size(dt):
+        size = len(dt.name)
+        for component in dt.components:
+            size += len(component.name)
+            if hasattr(component, 'examples'):
+                size += len(component.gen_class)
+                for example in component.examples:
+                    size += len(example.context) + len(example.response)
+            else:
+                for cls in component.classes:
+                    size += len(cls.det_class)
+                    for example in cls.examples:
+                        size += len(example.example)
+        return size
+
+    # Store next id number of scope, never moving a counter backwards. Scopes are
+    # components:{type}, classes:{dc_id}, examples:{gc_id} and examples:{dc_id}:{cls_id}
+    def write_counter(self, conn, dt_id: str, scope: str, next_num: int):
+        conn.execute('INSERT INTO counters (tree_id, scope, next_num) VALUES (?, ?, ?) '
+                     'ON CONFLICT (tree_id, scope) DO UPDATE SET next_num = MAX(next_num, excluded.next_num)',
+                     (dt_id, scope, next_num))
+
+    # Delete counters of scope and every scope nested under it
+    def delete_counters(self, conn, dt_id: str, scope: str):
+        conn.execute("DELETE FROM counters WHERE tree_id = ? AND (scope = ? OR scope LIKE ? || ':%')",
+                     (dt_id, scope, scope))
+
+    # Insert component along with its classes, examples and id counters
+    def insert_component(self, conn, dt_id: str, component):
+        if hasattr(component, 'examples'):
+            conn.execute('INSERT INTO components (tree_id, id, type, name, gen_class, budget) '
+                         'VALUES (?, ?, ?, ?, ?, ?)',
+                         (dt_id, component.id, 'gc', component.name, component.gen_class, json.dumps(component.budget)))
+            for example in component.examples:
+                self.insert_generation_example(conn, dt_id, component.id, example)
+            self.write_counter(conn, dt_id, f'examples:{component.id}', component.next_example_num)
+        else:
+            conn.execute('INSERT INTO components (tree_id, id, type, name, gen_class) VALUES (?, ?, ?, ?, ?)',
+                         (dt_id, component.id, 'dc', component.name, ''))
+            for cls in component.classes:
+                self.insert_detection_class(conn, dt_id, component.id, cls)
+            self.write_counter(conn, dt_id, f'classes:{component.id}', component.next_class_num)
+
+    def insert_generation_example(self, conn, dt_id: str, gc_id: str, example):
+        conn.execute('INSERT INTO generation_examples (tree_id, component_id, id, context, response) '
+                     'VALUES (?, ?, ?, ?, ?)', (dt_id, gc_id, example.id, example.context, example.response))
+
+    def insert_detection_class(self, conn, dt_id: str, dc_id: str, cls):
+        conn.execute('INSERT INTO classes (tree_id, component_id, id, det_class) VALUES (?, ?, ?, ?)',
+                     (dt_id, dc_id, cls.id, cls.det_class))
+        for example in cls.examples:
+            self.insert_detection_example(conn, dt_id, dc_id, cls.id, example)
+        self.write_counter(conn, dt_id, f'examples:{dc_id}:{cls.id}', cls.next_example_num)
+
+    def insert_detection_example(self, conn, dt_id: str, dc_id: str, cls_id: str, example):
+        conn.execute('INSERT INTO detection_examples (tree_id, component_id, class_id, id, example) '
+                     'VALUES (?, ?, ?, ?, ?)', (dt_id, dc_id, cls_id, example.id, example.example))
+
+    # Each apply_{op} method below performs the row writes for one change recorded by
+    # a DialogueTree mutation method, receiving the method's arguments and result
+
+    def apply_edit_name(self, conn, dt, name: str):
+        conn.execute('UPDATE trees SET name = ? WHERE id = ?', (name, dt.id))
+
+    def apply_add_component(self, conn, dt, component_type: str, name: str, id: str):
+        conn.execute('INSERT INTO components (tree_id, id, type, name, gen_class) VALUES (?, ?, ?, ?, ?)',
+                     (dt.id, id, component_type, name, ''))
+        self.write_counter(conn, dt.id, f'components:{component_type}', id_num(id)+1)
+
+    # The copy is made from the rows of the original as they are at this point of the
+    # save, since later changes in the same save may edit or delete either component
+    def apply_copy_component(self, conn, dt, component_type: str, id: str, copy_id: str):
+        conn.execute('INSERT INTO components (tree_id, id, type, name, gen_class, budget) '
+                     'SELECT tree_id, ?, type, name, gen_class, budget FROM components WHERE tree_id = ? AND id = ?',
+                     (copy_id, dt.id, id))
+        conn.execute('INSERT INTO generation_examples (tree_id, component_id, id, context, response) '
+                     'SELECT tree_id, ?, id, context, response FROM generation_examples '
+                     'WHERE tree_id = ? AND component_id = ? ORDER BY seq', (copy_id, dt.id, id))
+        conn.execute('INSERT INTO classes (tree_id, component_id, id, det_class) '
+                     'SELECT tree_id, ?, id, det_class FROM classes WHERE tree_id = ? AND component_id = ? ORDER BY seq',
+                     (copy_id, dt.id, id))
+        conn.execute('INSERT INTO detection_examples (tree_id, component_id, class_id, id, example) '
+                     'SELECT tree_id, ?, class_id, id, example FROM detection_examples '
+                     'WHERE tree_id = ? AND component_id = ? ORDER BY seq', (copy_id, dt.id, id))
+        rows = conn.execute("SELECT scope, next_num FROM counters WHERE tree_id = ? AND "
+                            "(scope IN (?, ?) OR scope LIKE ? || ':%')",
+                            (dt.id, f'examples:{id}', f'classes:{id}', f'examples:{id}')).fetchall()
+        for scope, next_num in rows:
+            owner = scope.split(':')
+            self.write_counter(conn, dt.id, ':'.join([owner[0], copy_id] + owner[2:]), next_num)
+        self.write_counter(conn, dt.id, f'components:{component_type}', id_num(copy_id)+1)
+
+    def apply_delete_component(self, conn, dt, id: str):
+        conn.execute('DELETE FROM edges WHERE tree_id = ? AND (start_id = ? OR end_id = ?)', (dt.id, id, id))
+        for table in ['detection_examples', 'generation_examples', 'classes']:
+            conn.execute(f'DELETE FROM {table} WHERE tree_id = ? AND component_id = ?', (dt.id, id))
+        conn.execute('DELETE FROM components WHERE tree_id = ? AND id = ?', (dt.id, id))
+        self.delete_counters(conn, dt.id, f'examples:{id}')
+        self.delete_counters(conn, dt.id, f'classes:{id}')
+
+    def apply_add_edge(self, conn, dt, start_id: str, end_id: str):
+        conn.execute('INSERT INTO edges (tree_id, start_id, end_id) VALUES (?, ?, ?)', (dt.id, start_id, end_id))
+
+    def apply_delete_edge(self, conn, dt, start_id: str, end_id: str):
+        conn.execute('DELETE FROM edges WHERE seq = (SELECT seq FROM edges WHERE tree_id = ? AND start_id = ? '
+                     'AND end_id = ? ORDER BY seq LIMIT 1)', (dt.id, start_id, end_id))
+
+    def apply_edit_component_name(self, conn, dt, c_id: str, name: str):
+        conn.execute('UPDATE components SET name = ? WHERE tree_id = ? AND id = ?', (name, dt.id, c_id))
+
+    def apply_edit_generation_class(self, conn, dt, gc_id: str, gen_class: str):
+        conn.execute('UPDATE components SET gen_class = ? WHERE tree_id = ? AND id = ?', (gen_class, dt.id, gc_id))
+
+    # The edit is merged into the stored budget rather than writing the component's
+    # budget, which may have been edited again later in the same save
+    def apply_edit_generation_budget(self, conn, dt, gc_id: str, budget: dict):
+        from models import DEFAULT_GENERATION_BUDGET
+
+        row = conn.execute('SELECT budget FROM components WHERE tree_id = ? AND id = ?', (dt.id, gc_id)).fetchone()
+        stored = dict(DEFAULT_GENERATION_BUDGET)
+        if row[0] is not None:
+            stored.update(json.loads(row[0]))
+        stored.update(budget)
+        conn.execute('UPDATE components SET budget = ? WHERE tree_id = ? AND id = ?',
+                     (json.dumps(stored), dt.id, gc_id))
+
+    def apply_add_generation_example(self, conn, dt, gc_id: str, context: str, response: str, ex_id: str):
+        conn.execute('INSERT INTO generation_examples (tree_id, component_id, id, context, response) '
+                     'VALUES (?, ?, ?, ?, ?)', (dt.id, gc_id, ex_id, context, response))
+        self.write_counter(conn, dt.id, f'examples:{gc_id}', id_num(ex_id)+1)
+
+    def apply_edit_generation_example(self, conn, dt, gc_id: str, ex_id: str, context: str or None,
+                                      response: str or None):
+        if context is not None:
+            conn.execute('UPDATE generation_examples SET context = ? WHERE tree_id = ? AND component_id = ? '
+                         'AND id = ?', (context, dt.id, gc_id, ex_id))
+        if response is not None:
+            conn.execute('UPDATE generation_examples SET response = ? WHERE tree_id = ? AND component_id = ? '
+                         'AND id = ?', (response, dt.id, gc_id, ex_id))
+
+    def apply_delete_generation_example(self, conn, dt, gc_id: str, ex_id: str):
+        conn.execute('DELETE FROM generation_examples WHERE tree_id = ? AND component_id = ? AND id = ?',
+                     (dt.id, gc_id, ex_id))
+
+    def apply_add_detection_class(self, conn, dt, dc_id: str, det_class: str, cls_id: str):
+        conn.execute('INSERT INTO classes (tree_id, component_id, id, det_class) VALUES (?, ?, ?, ?)',
+                     (dt.id, dc_id, cls_id, det_class))
+        self.write_counter(conn, dt.id, f'classes:{dc_id}', id_num(cls_id)+1)
+
+    def apply_edit_detection_class_name(self, conn, dt, dc_id: str, cls_id: str, det_class: str):
+        conn.execute('UPDATE classes SET det_class = ? WHERE tree_id = ? AND component_id = ? AND id = ?',
+                     (det_class, dt.id, dc_id, cls_id))
+
+    def apply_delete_detection_class(self, conn, dt, dc_id: str, cls_id: str):
+        conn.execute('DELETE FROM detection_examples WHERE tree_id = ? AND component_id = ? AND class_id = ?',
+                     (dt.id, dc_id, cls_id))
+        conn.execute('DELETE FROM classes WHERE tree_id = ? AND component_id = ? AND id = ?', (dt.id, dc_id, cls_id))
+        self.delete_counters(conn, dt.id, f'examples:{dc_id}:{cls_id}')
+
+    def apply_add_detection_example(self, conn, dt, dc_id: str, cls_id: str, example: str, ex_id: str):
+        conn.execute('INSERT INTO detection_examples (tree_id, component_id, class_id, id, example) '
+                     'VALUES (?, ?, ?, ?, ?)', (dt.id, dc_id, cls_id, ex_id, example))
+        self.write_counter(conn, dt.id, f'examples:{dc_id}:{cls_id}', id_num(ex_id)+1)
+
+    def apply_edit_detection_example(self, conn, dt, dc_id: str, cls_id: str, ex_id: str, example: str):
+        conn.execute('UPDATE detection_examples SET example = ? WHERE tree_id = ? AND component_id = ? '
+                     'AND class_id = ? AND id = ?', (example, dt.id, dc_id, cls_id, ex_id))
+
+    def apply_delete_detection_example(self, conn, dt, dc_id: str, cls_id: str, ex_id: str):
+        conn.execute('DELETE FROM detection_examples WHERE tree_id = ? AND component_id = ? AND class_id = ? '
+                     'AND id = ?', (dt.id, dc_id, cls_id, ex_id))
+
+
+# Return the storage backend selected by STORAGE_BACKEND
+def create_storage():
+    if STORAGE_BACKEND == 'pickle':
+        return PickleStorage()
+    elif STORAGE_BACKEND == 'sqlite':
+        return SqliteStorage(SQLITE_PATH)
+    elif STORAGE_BACKEND == 'log':
+        return LogStorage(LOG_COMPACTION_BYTES)
+    else:
+        raise ValueError(f'unknown storage backend {STORAGE_BACKEND}')
+
+
+# Copy every pickled dialogue tree in the data directory into the SQLite database
+def migrate_pickles_to_sqlite():
+    source = PickleStorage()
+    destination = SqliteStorage(SQLITE_PATH)
+    for filename in sorted(os.listdir('data')):
+        if filename.endswith('.pkl'):
+            id = filename[:-len('.pkl')]
+            if not destination.exists(id):
+                dt, _ = source.load(id)
+                dt.version = None
+                destination.save(dt, [])
+                print(f'migrated {id}')
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['migrate']:
+        migrate_pickles_to_sqlite()
+    else:
+        print('usage: python storage.py migrate')
@@ -0,0 +1,80 @@
+from analysis import analyze_dialogue_tree, find_strongly_connected_components
+from app import app
+from models import *
+
+
+# Return a dialogue tree whose detection component routes class a to a generation
+# component that leads back to the detection component, so every component has an
+# incoming edge
+def cyclic_tree():
+    dt = DialogueTree('tree', 'dt-1')
+    dc_id = dt.add_component('dc', 'dc')
+    gc_id = dt.add_component('gc', 'gc')
+    dt.add_detection_class(dc_id, 'a')
+    dt.edit_generation_class(gc_id, 'a')
+    dt.add_edge(dc_id, gc_id)
+    dt.add_edge(gc_id, dc_id)
+    return dt, dc_id, gc_id
+
+
+# Components on a cycle that no edge leads into are reachable, since a chat can start
+# on the cycle, and turns start there
+def test_cyclic_tree_is_reachable():
+    dt, dc_id, gc_id = cyclic_tree()
+    analysis = analyze_dialogue_tree(dt)
+    assert analysis['unreachable_components'] == []
+    assert [(path['start'], path['components'], path['next_id']) for path in analysis['paths']] == \
+        [(dc_id, [dc_id, gc_id], dc_id)]
+
+
+# Components only reachable from the cycle are reachable, and components only
+# leading into the cycle become the entries instead
+def test_entries_lead_into_cycle():
+    dt, dc_id, gc_id = cyclic_tree()
+    end_id = dt.add_component('gc', 'end')
+    dt.edit_generation_class(end_id, 'b')
+    dt.add_detection_class(dc_id, 'b')
+    dt.add_edge(dc_id, end_id)
+    assert analyze_dialogue_tree(dt)['unreachable_components'] == []
+
+    entry_id = dt.add_component('gc', 'entry')
+    dt.add_edge(entry_id, gc_id)
+    analysis = analyze_dialogue_tree(dt)
+    assert analysis['unreachable_components'] == []
+    assert analysis['paths'][0]['start'] == entry_id
+    assert {path['start'] for path in analysis['paths']} == {entry_id, dc_id}
+
+
+# A given start component is the only entry, so the components it cannot reach are
+# reported even when other components lead to them
+def test_start_component_decides_reachability():
+    dt, dc_id, gc_id = cyclic_tree()
+    other_id = dt.add_component('dc', 'other')
+    dt.add_detection_class(other_id, 'a')
+    dt.add_edge(other_id, gc_id)
+    assert analyze_dialogue_tree(dt)['unreachable_components'] == []
+    assert analyze_dialogue_tree(dt, dt.get_component(gc_id))['unreachable_components'] == [other_id]
+
+
+# Strongly connected components are found without recursion on long chains
+def test_long_chain_strongly_connected_components():
+    dt = DialogueTree('tree', 'dt-1')
+    ids = [dt.add_component('gc', 'gc') for _ in range(3000)]
+    for start, end in zip(ids, ids[1:]):
+        dt.add_edge(start, end)
+    dt.add_edge(ids[-1], ids[0])
+    assert [[c.id for c in scc] for scc in find_strongly_connected_components(dt)] == [ids]
+
+
+# The start query parameter must name a component of the tree
+def test_analysis_start_parameter():
+    client = app.test_client()
+    dt_id = client.post('/dialogue', json={'name': 'tree'}).get_json()['data']['id']
+    gc_id = client.post(f'/dialogue/{dt_id}/generation', json={'name': 'gc'}).get_json()['data']['id']
+    dc_id = client.post(f'/dialogue/{dt_id}/detection', json={'name': 'dc'}).get_json()['data']['id']
+
+    response = client.get(f'/dialogue/{dt_id}/analysis?start={gc_id}')
+    assert response.status_code == 200
+    assert response.get_json()['data']['unreachable_components'] == [dc_id]
+    assert client.get(f'/dialogue/{dt_id}/analysis').get_json()['data']['unreachable_components'] == []
+    assert client.get(f'/dialogue/{dt_id}/analysis?start=gc-9').status_code == 404
@@ -0,0 +1,237 @@
+from classifier import detection_stats
+from concurrent.futures import wait
+import helpers
+from models import *
+import pickle
+import pytest
+import threading
+import time
+
+
+# Answer detection prompts with the last student message, so it becomes the detected
+# class, and generation prompts with a fixed response
+def fake_gpt(prompt: str, max_tokens: int):
+    if max_tokens == 16:
+        return ' ' + prompt.rsplit('\n', 2)[-2].rsplit(': ', 1)[1]
+    return ' response'
+
+
+@pytest.fixture(autouse=True)
+def stub_gpt(monkeypatch):
+    monkeypatch.setattr(helpers, 'prompt_gpt_azure', fake_gpt)
+    helpers.branch_counts.clear()
+    yield
+    helpers.branch_counts.clear()
+
+
+# Return a saved dialogue tree with a detection component routing classes a, b and c
+# to a generation component each, and the detection component's id. Each class has
+# examples made of a word of its own, so the local classifier can tell them apart
+def branching_tree():
+    dt = DialogueTree('tree')
+    dc_id = dt.add_component('dc', 'dc')
+    for det_class, word in [('class a', 'apple'), ('class b', 'banana'), ('class c', 'cherry')]:
+        cls_id = dt.add_detection_class(dc_id, det_class)
+        dt.add_detection_example(dc_id, cls_id, f'{word} {word}')
+        gc_id = dt.add_component('gc', det_class)
+        dt.edit_generation_class(gc_id, det_class)
+        dt.add_edge(dc_id, gc_id)
+    dt.save()
+    return dt, dc_id
+
+
+# Branch counts are kept outside the tree, so copies, edits and reloads of the tree
+# still speculate on the branch chats usually take
+def test_branch_counts_survive_copy_and_reload():
+    dt, dc_id = branching_tree()
+    for message in ['class c', 'class c', 'class b']:
+        helpers.traverse_dialogue_tree(dt, dt.get_component(dc_id), [{'role': 'student', 'message': message}])
+
+    copy = DialogueTree.load(dt.id).copy()
+    copy.edit_name('edited')
+    copy.save()
+    for tree in [copy, DialogueTree.load(dt.id), pickle.loads(pickle.dumps(copy))]:
+        likely = helpers.branch_counts.likely_generation_edges(dt.id, tree.get_component(dc_id), 2)
+        assert [gc.gen_class for gc in likely] == ['class c', 'class b']
+
+
+# A chosen branch still queued behind other chats' calls is generated by the chat
+# itself rather than waiting for a speculation worker
+def test_queued_chosen_branch_runs_inline(monkeypatch):
+    monkeypatch.setattr(helpers, 'SPECULATIVE_BRANCHES', 3)
+    dt, dc_id = branching_tree()
+    release = threading.Event()
+    busy = [helpers.speculation_pool.submit(release.wait, 2) for _ in range(helpers.SPECULATIVE_POOL_SIZE)]
+    try:
+        start = time.perf_counter()
+        responses, next_id = helpers.traverse_dialogue_tree(dt, dt.get_component(dc_id),
+                                                            [{'role': 'student', 'message': 'class b'}])
+        assert time.perf_counter() - start < 1
+        assert responses == ['response']
+        assert next_id == 'exit'
+    finally:
+        release.set()
+        for future in busy:
+            future.result()
+
+
+# Prompt token counts are recorded per call, with speculative calls counted apart
+# from the calls chats wait for
+def test_speculative_prompt_tokens_counted_apart(monkeypatch):
+    monkeypatch.setattr(helpers, 'SPECULATIVE_BRANCHES', 3)
+    speculated = []
+    speculate_generations = helpers.speculate_generations
+
+    def record_speculation(dt: type[DialogueTree], dc: type[Detection], messages: list):
+        responses = speculate_generations(dt, dc, messages)
+        speculated.extend(responses.values())
+        return responses
+    monkeypatch.setattr(helpers, 'speculate_generations', record_speculation)
+
+    # detection calls wait for every speculative call to finish, so the chosen
+    # branch's response is always the speculative one
+    def slow_detection_gpt(prompt: str, max_tokens: int):
+        if max_tokens == 16:
+            wait(speculated, timeout=2)
+        return fake_gpt(prompt, max_tokens)
+    monkeypatch.setattr(helpers, 'prompt_gpt_azure', slow_detection_gpt)
+    dt, dc_id = branching_tree()
+
+    messages = [{'role': 'student', 'message': 'class b'}]
+    tokens = helpers.count_tokens(helpers.generation_prompt(dt.get_component(dc_id).get_generation_edges()[1], messages))
+    helpers.prompt_token_stats.clear()
+    assert helpers.traverse_dialogue_tree(dt, dt.get_component(dc_id), list(messages)) == (['response'], 'exit')
+    monkeypatch.setattr(helpers, 'SPECULATIVE_BRANCHES', 0)
+    assert helpers.traverse_dialogue_tree(dt, dt.get_component(dc_id), list(messages)) == (['response'], 'exit')
+
+    stats = helpers.prompt_token_stats.stats()
+    assert stats['calls'] == 1 and stats['last_tokens'] == tokens
+    assert stats['speculative']['calls'] == 3
+    assert [call['speculative'] for call in stats['recent_calls']] == [True, True, True, False]
+
+
+# Branches on a generation cycle are not speculated, since the chat fails on the cycle
+# before it could use the response, so a chat ending in a cycle error leaves no LLM
+# call behind for it
+def test_no_speculation_into_cycles(monkeypatch):
+    monkeypatch.setattr(helpers, 'SPECULATIVE_BRANCHES', 3)
+    speculated = []
+    speculate_generations = helpers.speculate_generations
+
+    def record_speculation(dt: type[DialogueTree], dc: type[Detection], messages: list):
+        responses = speculate_generations(dt, dc, messages)
+        speculated.extend(responses)
+        return responses
+    monkeypatch.setattr(helpers, 'speculate_generations', record_speculation)
+    dt, dc_id = branching_tree()
+    cyclic_id, other_id = [gc.id for gc in dt.get_component(dc_id).get_generation_edges()][:2]
+    dt.add_edge(cyclic_id, cyclic_id)
+
+    with pytest.raises(Exception, match='cycle'):
+        helpers.traverse_dialogue_tree(dt, dt.get_component(dc_id), [{'role': 'student', 'message': 'class a'}])
+    assert cyclic_id not in speculated and other_id in speculated
+
+
+# Speculative generation only starts once the local classifier is not confident and
+# the detection falls back to GPT
+def test_speculation_waits_for_local_classifier(monkeypatch):
+    monkeypatch.setattr(helpers, 'SPECULATIVE_BRANCHES', 3)
+    monkeypatch.setattr(helpers, 'LOCAL_CLASSIFIER', True)
+    speculated = []
+    speculate_generations = helpers.speculate_generations
+
+    def count_speculation(dt: type[DialogueTree], dc: type[Detection], messages: list):
+        speculated.append(dc.id)
+        return speculate_generations(dt, dc, messages)
+    monkeypatch.setattr(helpers, 'speculate_generations', count_speculation)
+    dt, dc_id = branching_tree()
+
+    monkeypatch.setattr(helpers, 'LOCAL_CLASSIFIER_THRESHOLD', 0.0)
+    responses, _ = helpers.traverse_dialogue_tree(dt, dt.get_component(dc_id), [{'role': 'student', 'message': 'banana'}])
+    assert responses == ['response']
+    assert speculated == []
+
+    monkeypatch.setattr(helpers, 'LOCAL_CLASSIFIER_THRESHOLD', 2.0)
+    responses, _ = helpers.traverse_dialogue_tree(dt, dt.get_component(dc_id), [{'role': 'student', 'message': 'class b'}])
+    assert responses == ['response']
+    assert speculated == [dc_id]
+
+
+# Batch detections answered by the local classifier are counted like single ones
+def test_batch_detection_records_local_answers(monkeypatch):
+    monkeypatch.setattr(helpers, 'LOCAL_CLASSIFIER', True)
+    monkeypatch.setattr(helpers, 'LOCAL_CLASSIFIER_THRESHOLD', 0.0)
+    dt, dc_id = branching_tree()
+    detection_stats.clear()
+    results = helpers.perform_batch_detection(dt.get_component(dc_id), ['apple', 'cherry'])
+    assert results == [{'response': 'class a'}, {'response': 'class c'}]
+    assert detection_stats.stats()['local'] == 2
+    detection_stats.clear()
+
+
+# Messages left out of the window are summarized in whole blocks, each with the
+# summary before it, so each turn adds at most one summary prompt not seen before
+def test_history_summary_prompts_repeat_across_turns(monkeypatch):
+    monkeypatch.setattr(helpers, 'HISTORY_SUMMARY_BLOCK', 4)
+    summary_prompts = []
+
+    # summaries are completions with temperature 0, so the same prompt always gets
+    # the same summary
+    def summarizing_gpt(prompt: str, max_tokens: int):
+        summary_prompts.append(prompt)
+        return f' summary of {len(prompt)} characters'
+    monkeypatch.setattr(helpers, 'prompt_gpt_azure', summarizing_gpt)
+    dt = DialogueTree('tree')
+    gc_id = dt.add_component('gc', 'gc')
+    dt.edit_generation_budget(gc_id, {'max_history_messages': 3, 'summarize_history': True})
+    gc = dt.get_component(gc_id)
+
+    messages = []
+    seen = 0
+    for turn in range(20):
+        messages.append({'role': 'student', 'message': f'student {turn}'})
+        prompt = helpers.generation_prompt(gc, messages)
+        assert len(set(summary_prompts)) - seen <= 1
+        seen = len(set(summary_prompts))
+        history = prompt.split('Context: ')[0].split('Summary of earlier messages: ')[-1].split('\n')[1:-2]
+        assert len(history) <= 3
+        messages.append({'role': 'chatbot', 'message': f'chatbot {turn}'})
+    assert seen == -(-(2 * 19 - 3) // 4)
+
+
+# Prompt prefixes are compiled once per component and reused by later prompts and by
+# copies of the tree. Only edits to a component's own examples or classes recompile
+# its prefix, and prompts built from a reused prefix match freshly compiled ones
+def test_prompt_prefixes_compiled_once(monkeypatch):
+    compiled = []
+    compile_generation = helpers.compile_generation_prompt_prefix
+    compile_detection = helpers.compile_detection_prompt_prefix
+    monkeypatch.setattr(helpers, 'compile_generation_prompt_prefix',
+                        lambda examples: compiled.append('gc') or compile_generation(examples))
+    monkeypatch.setattr(helpers, 'compile_detection_prompt_prefix',
+                        lambda dc, examples: compiled.append(dc.id) or compile_detection(dc, examples))
+    dt, dc_id = branching_tree()
+    gc_id = dt.get_component(dc_id).get_generation_edges()[0].id
+    dt.add_generation_example(gc_id, 'context', 'response')
+    messages = [{'role': 'student', 'message': 'hello'}]
+
+    def prompts(dt: type[DialogueTree]):
+        return helpers.generation_prompt(dt.get_component(gc_id), messages), \
+            helpers.detection_prompt_prefix(dt.get_component(dc_id))
+
+    first = prompts(dt)
+    assert prompts(dt) == first and prompts(dt.copy()) == first
+    assert compiled == ['gc', dc_id]
+
+    dt.edit_component_name(gc_id, 'renamed')
+    dt.add_generation_example(dt.add_component('gc', 'other'), 'context', 'response')
+    dt.add_detection_class(dt.add_component('dc', 'other'), 'a')
+    assert prompts(dt) == first and compiled == ['gc', dc_id]
+
+    for edit in [lambda: dt.edit_generation_example(gc_id, 'ex-0', 'edited', None),
+                 lambda: dt.add_detection_example(dc_id, 'cls-0', 'apple pie')]:
+        compiled.clear()
+        edit()
+        edited = prompts(dt)
+        assert len(compiled) == 1
+        assert edited == prompts(pickle.loads(pickle.dumps(dt)))
@@ -0,0 +1,62 @@
+import llm
+from llm import CompletionCache, count_tokens, create_http_session
+import time
+
+
+# Return the number of completions and their total size on the disk tier of cache
+def disk_usage(cache: type[CompletionCache]):
+    return cache.connection().execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions').fetchone()
+
+
+# Puts between prunes leave the disk tier alone, and the next prune removes expired
+# completions and then the least recently used ones past the byte bound
+def test_completion_cache_prunes_on_interval(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    cache = CompletionCache(0, 'data/completions.db', 100, 16 * 1000, 60)
+    size = 64 + len('completion')
+
+    cache.put('engine', 'expired', 16, 'completion')
+    now[0] += 50
+    for i in range(10):
+        cache.put('engine', f'prompt {i}', 16, 'completion')
+    assert disk_usage(cache) == (11, 11 * size)
+
+    now[0] += 60
+    cache.put('engine', 'prompt 10', 16, 'completion')
+    assert disk_usage(cache) == (11, 11 * size)
+    assert cache.get('engine', 'expired', 16) is None
+    assert cache.get('engine', 'prompt 0', 16) == 'completion'
+
+
+# Writing a sixteenth of the byte bound since the last prune prunes early, so the disk
+# tier stays near its bound however short the interval
+def test_completion_cache_prunes_after_bytes_written():
+    size = 64 + len('completion')
+    cache = CompletionCache(0, 'data/completions.db', 3600, 16 * size * 4, 3600)
+    for i in range(200):
+        cache.put('engine', f'prompt {i}', 16, 'completion')
+        assert disk_usage(cache)[1] <= 16 * size * 4 + 4 * size
+    assert cache.get('engine', 'prompt 199', 16) == 'completion'
+    assert cache.get('engine', 'prompt 0', 16) is None
+
+
+# The openai module closes its session every few minutes, which must not drop the
+# connections pooled for every thread
+def test_shared_session_keeps_pools_when_closed():
+    session = create_http_session(4)
+    adapter = session.get_adapter('https://example.com')
+    adapter.poolmanager.connection_from_url('https://example.com')
+    session.close()
+    assert len(adapter.poolmanager.pools) == 1
+
+
+# Without tiktoken, text counts one token per UTF-8 byte, which byte pair encoding
+# never exceeds, whatever the script or spelling of the text
+def test_token_estimate_is_an_upper_bound(monkeypatch):
+    monkeypatch.setattr(llm, 'tiktoken', None)
+    assert count_tokens('hello world') == 11
+    assert count_tokens('xqzjv kwpfb') == 11
+    assert count_tokens('你好世界') == 12
+    assert count_tokens('great 😀😀') == 6 + 8
+    assert count_tokens('déjà vu') == 9
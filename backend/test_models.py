@@ -0,0 +1,222 @@
+import models
+from models import *
+import multiprocessing
+import os
+import pickle
+import pytest
+import random
+from test_storage import random_edit
+
+
+# A save that fails after the tree was cached must not leave the unsaved edit visible
+def test_failed_save_drops_cache_entry(monkeypatch):
+    dt = DialogueTree('tree')
+    dt.save()
+    DialogueTree.load(dt.id)
+
+    copy = DialogueTree.load(dt.id).copy()
+    copy.edit_name('unsaved')
+
+    def fail(dt, changes):
+        raise OSError('disk full')
+    with monkeypatch.context() as patch:
+        patch.setattr(models.storage, 'save', fail)
+        with pytest.raises(OSError):
+            copy.save()
+
+    assert dt.id not in models.tree_cache.entries
+    assert DialogueTree.load(dt.id).name == 'tree'
+
+
+# Every save bumps the version, so a same-size rewrite is never mistaken for a cache hit
+def test_same_size_save_is_not_a_cache_hit():
+    dt = DialogueTree('aaaa')
+    dt.save()
+    copy = DialogueTree.load(dt.id).copy()
+    copy.edit_name('bbbb')
+    copy.save()
+    models.tree_cache.clear()
+    assert DialogueTree.load(dt.id).name == 'bbbb'
+    copy = DialogueTree.load(dt.id).copy()
+    copy.edit_name('cccc')
+    copy.save()
+    assert DialogueTree.load(dt.id).name == 'cccc'
+
+
+# Return the incoming edges of every component of dt, recomputed from the outgoing
+# edges, as sorted lists of start component ids
+def incoming_from_neighbors(dt: type[DialogueTree]):
+    incoming = {c.id: [] for c in dt.components}
+    for c in dt.components:
+        for neighbor in c.neighbors:
+            incoming[neighbor.id].append(c.id)
+    return {id: sorted(starts) for id, starts in incoming.items()}
+
+
+# Return the incoming edge index of dt as sorted lists of start component ids
+def incoming_index(dt: type[DialogueTree]):
+    return {id: sorted(c.id for c in starts) for id, starts in dt.incoming.items()}
+
+
+# The incoming edge index is updated in place by every mutation and rebuilt when a
+# tree is unpickled or copied, so it must always agree with the outgoing edges
+def test_incoming_index_matches_edges():
+    for seed in range(50):
+        rnd = random.Random(seed)
+        dt = DialogueTree('tree', f'dt-{seed}')
+        for step in range(200):
+            op, args = random_edit(dt, rnd)
+            getattr(dt, op)(*args)
+            assert incoming_index(dt) == incoming_from_neighbors(dt), (seed, step, op)
+            for c in dt.components:
+                assert all(start is dt.get_component(start.id) for start in dt.incoming[c.id])
+            if step % 50 == 0:
+                dt = rnd.choice([dt.copy(), pickle.loads(pickle.dumps(dt))])
+                assert incoming_index(dt) == incoming_from_neighbors(dt), (seed, step)
+
+
+# Components stay in the order they were added through deletes, copies and pickling,
+# and pickles store them as a list, as pickles written before the id index did
+def test_component_order_survives_deletes_and_pickles():
+    dt = DialogueTree('tree', 'dt-1')
+    ids = [dt.add_component(component_type, 'c') for component_type in ['gc', 'dc', 'gc', 'dc', 'gc']]
+    dt.delete_component(ids[1])
+    dt.delete_component(ids[4])
+    expected = [ids[0], ids[2], ids[3]]
+    assert dt.get_component_ids() == expected
+
+    state = dt.__getstate__()
+    assert [c.id for c in state['components']] == expected and 'components_by_id' not in state
+    for loaded in [dt.copy(), pickle.loads(pickle.dumps(dt))]:
+        assert loaded.get_component_ids() == expected
+        assert loaded.get_component(ids[2]) is loaded.components[1]
+
+
+# Return count dialogue tree ids allocated one after another
+def allocate_dialogue_ids(count: int):
+    return [DialogueTree.generate_dialogue_id() for _ in range(count)]
+
+
+# Workers allocating ids at the same time never receive the same id, and no number
+# is skipped
+def test_dialogue_ids_are_unique_across_processes():
+    with multiprocessing.get_context('fork').Pool(4) as pool:
+        ids = [id for ids in pool.map(allocate_dialogue_ids, [50] * 8) for id in ids]
+    assert sorted(ids) == sorted(f'dt-{num}' for num in range(400))
+
+
+# The first allocation continues after the largest stored tree id, and later ones
+# only read the counter instead of listing the stored trees
+def test_dialogue_ids_continue_after_stored_trees(monkeypatch):
+    DialogueTree('tree', 'dt-41').save()
+    assert DialogueTree.generate_dialogue_id() == 'dt-42'
+
+    def listdir(path):
+        raise AssertionError('stored trees listed')
+    monkeypatch.setattr(os, 'listdir', listdir)
+    assert allocate_dialogue_ids(3) == ['dt-43', 'dt-44', 'dt-45']
+
+
+# Return every id index of dt that disagrees with the lists it indexes, as a list of
+# the indexes' owners
+def stale_indexes(dt: type[DialogueTree]):
+    same = lambda index, items: list(index) == [item.id for item in items] and \
+        all(index[item.id] is item for item in items)
+    stale = [] if same(dt.components_by_id, dt.components) else [dt.id]
+    for c in dt.components:
+        if isinstance(c, Generation):
+            stale += [] if same(c.examples_by_id, c.examples) else [c.id]
+        else:
+            stale += [] if same(c.classes_by_id, c.classes) else [c.id]
+            stale += [cls.id for cls in c.classes if not same(cls.examples_by_id, cls.examples)]
+    return stale
+
+
+# Component, class and example lookups go through id indexes, which every mutation
+# keeps in step with the ordered lists, and copies and unpickled trees rebuild
+def test_id_indexes_match_lists():
+    for seed in range(30):
+        rnd = random.Random(seed)
+        dt = DialogueTree('tree', f'dt-{seed}')
+        for step in range(200):
+            op, args = random_edit(dt, rnd)
+            getattr(dt, op)(*args)
+            assert stale_indexes(dt) == [], (seed, step, op)
+            if step % 50 == 0:
+                dt = rnd.choice([dt.copy(), pickle.loads(pickle.dumps(dt))])
+                assert stale_indexes(dt) == [], (seed, step)
+        for c in dt.components:
+            assert dt.get_component(c.id) is c
+            for item in (c.examples if isinstance(c, Generation) else c.classes):
+                assert (c.get_example if isinstance(c, Generation) else c.get_class)(item.id) is item
+
+
+# Return a pickle of dt without the id counters, like pickles written before the
+# counters existed. Id indexes are never pickled
+def legacy_pickle(dt: type[DialogueTree]):
+    dt = dt.copy()
+    del dt.next_component_nums
+    for c in dt.components:
+        if isinstance(c, Generation):
+            del c.next_example_num
+        else:
+            del c.next_class_num
+            for cls in c.classes:
+                del cls.next_example_num
+    return pickle.dumps(dt)
+
+
+# Trees pickled before the id indexes existed get them built when they are loaded
+def test_legacy_pickle_lookups():
+    dt = DialogueTree('tree', 'dt-1')
+    gc_id = dt.add_component('gc', 'gc')
+    dc_id = dt.add_component('dc', 'dc')
+    ex_id = dt.add_generation_example(gc_id, 'context', 'response')
+    cls_id = dt.add_detection_class(dc_id, 'a')
+    cls_ex_id = dt.add_detection_example(dc_id, cls_id, 'example')
+
+    loaded = pickle.loads(legacy_pickle(dt))
+    assert stale_indexes(loaded) == []
+    assert loaded.get_component(gc_id).get_example(ex_id).context == 'context'
+    assert loaded.get_component(dc_id).get_class(cls_id).get_example(cls_ex_id).example == 'example'
+
+
+# Ids come from counters, so an id freed by a delete is never handed out again
+def test_deleted_ids_are_not_reused():
+    dt = DialogueTree('tree', 'dt-1')
+    gc_id = dt.add_component('gc', 'gc')
+    dt.delete_component(dt.add_component('gc', 'gc'))
+    assert dt.add_component('gc', 'gc') == 'gc-2'
+    dc_id = dt.add_component('dc', 'dc')
+    dt.delete_component(dt.copy_component('dc', dc_id))
+    assert dt.add_component('dc', 'dc') == 'dc-2'
+
+    dt.delete_generation_example(gc_id, dt.add_generation_example(gc_id, 'context', 'response'))
+    assert dt.add_generation_example(gc_id, 'context', 'response') == 'ex-1'
+    dt.delete_detection_class(dc_id, dt.add_detection_class(dc_id, 'a'))
+    cls_id = dt.add_detection_class(dc_id, 'b')
+    assert cls_id == 'cls-1'
+    dt.delete_detection_example(dc_id, cls_id, dt.add_detection_example(dc_id, cls_id, 'example'))
+    assert dt.add_detection_example(dc_id, cls_id, 'example') == 'ex-1'
+
+    loaded = pickle.loads(pickle.dumps(dt))
+    assert loaded.add_component('gc', 'gc') == 'gc-3'
+    assert loaded.add_generation_example(gc_id, 'context', 'response') == 'ex-2'
+
+
+# Trees pickled before the counters existed get them computed once from their ids
+def test_legacy_pickle_counters():
+    dt = DialogueTree('tree', 'dt-1')
+    gc_id = dt.add_component('gc', 'gc')
+    dc_id = dt.add_component('dc', 'dc')
+    dt.add_component('gc', 'gc')
+    dt.add_generation_example(gc_id, 'context', 'response')
+    cls_id = dt.add_detection_class(dc_id, 'a')
+    dt.add_detection_example(dc_id, cls_id, 'example')
+
+    loaded = pickle.loads(legacy_pickle(dt))
+    assert loaded.add_component('gc', 'gc') == 'gc-2'
+    assert loaded.add_component('dc', 'dc') == 'dc-1'
+    assert loaded.add_generation_example(gc_id, 'context', 'response') == 'ex-1'
+    assert loaded.add_detection_class(dc_id, 'b') == 'cls-1'
+    assert loaded.add_detection_example(dc_id, cls_id, 'example') == 'ex-1'
@@ -0,0 +1,102 @@
+import helpers
+from models import *
+import random
+import zlib
+
+
+# Raised by the stub generation call once a walk has made too many calls, which only
+# happens on a cycle of generation components
+class TooManyCalls(Exception):
+    pass
+
+
+# Walk the dialogue tree from component c the way chats did before routing plans,
+# scanning the outgoing edges of every component visited, and return the responses
+# and the next component id
+def reference_walk(c: type[Component], messages: list):
+    responses = []
+    first_detection = True
+    while True:
+        if isinstance(c, Generation):
+            response = helpers.perform_generation(c, messages)
+            responses.append(response)
+            if c.is_leaf():
+                return responses, 'exit'
+            messages.append({'role': 'chatbot', 'message': response})
+            c = c.get_next_component()
+        elif c.is_leaf():
+            return responses, 'exit'
+        elif not first_detection:
+            return responses, c.id
+        else:
+            det_class = helpers.perform_gpt_detection(c, messages)
+            next_c = None
+            for gc in c.get_generation_edges():
+                if gc.gen_class == det_class:
+                    next_c = gc
+            if next_c is None:
+                raise Exception(f'no edge found from {c.id} to generation component with class {det_class}')
+            c = next_c
+            first_detection = False
+
+
+# Replace GPT calls with stubs that log each call: generation responds with the
+# component id and conversation length, and detection picks a class from a hash of
+# the same, so both walks see the same answers
+def stub_calls(monkeypatch, log: list):
+    def generate(gc: type[Generation], messages: list):
+        log.append(('generation', gc.id, len(messages)))
+        if len(log) > 100:
+            raise TooManyCalls()
+        return f'{gc.id}:{len(messages)}'
+
+    def detect(dc: type[Detection], messages: list):
+        log.append(('detection', dc.id, len(messages)))
+        return ['a', 'b', 'c', 'unmatched'][zlib.crc32(f'{dc.id}{len(messages)}'.encode()) % 4]
+
+    monkeypatch.setattr(helpers, 'perform_generation', generate)
+    monkeypatch.setattr(helpers, 'perform_gpt_detection', detect)
+
+
+# Return the outcome of walk: its result, the error message it raised, or a note
+# that it ran into a cycle of generation components
+def outcome(walk):
+    try:
+        return 'ok', walk()
+    except TooManyCalls:
+        return 'cycle', None
+    except Exception as e:
+        return 'error', e.args[0]
+
+
+# Chats routed by the compiled plan make the same GPT calls, give the same responses
+# and stop at the same component as walks that scan edges, on random trees with
+# shared classes, self loops, ignored edges and cycles. Where the edge scan loops
+# forever the plan raises a cycle error after the same calls
+def test_plan_routing_matches_tree_walk(monkeypatch):
+    for seed in range(1000):
+        rnd = random.Random(seed)
+        dt = DialogueTree('tree', f'dt-{seed}')
+        ids = [dt.add_component(rnd.choice(['gc', 'dc']), 'c') for _ in range(rnd.randint(1, 9))]
+        for id in ids:
+            if id.startswith('gc'):
+                dt.edit_generation_class(id, rnd.choice('abc'))
+        for _ in range(rnd.randint(0, 14)):
+            start, end = rnd.choice(ids), rnd.choice(ids)
+            if not dt.has_edge(start, end):
+                dt.add_edge(start, end)
+
+        for id in ids:
+            c = dt.get_component(id)
+            reference_log, plan_log = [], []
+            stub_calls(monkeypatch, reference_log)
+            expected = outcome(lambda: reference_walk(c, [{'role': 'student', 'message': 'hi'}]))
+            stub_calls(monkeypatch, plan_log)
+            actual = outcome(lambda: helpers.traverse_dialogue_tree(dt, c, [{'role': 'student', 'message': 'hi'}]))
+
+            if expected[0] == 'cycle':
+                assert actual[0] == 'error' and 'cycle' in actual[1], (seed, id)
+                assert plan_log == reference_log[:len(plan_log)], (seed, id)
+            else:
+                assert actual == expected, (seed, id)
+                assert plan_log == reference_log, (seed, id)
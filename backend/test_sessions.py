@@ -0,0 +1,22 @@
+import pytest
+import sessions
+
+
+# Without SESSION_BACKEND, a single worker keeps sessions in memory and several
+# workers share them through SQLite
+@pytest.mark.parametrize('workers, store', [(1, sessions.MemorySessionStore), (4, sessions.SqliteSessionStore)])
+def test_default_session_backend_follows_workers(monkeypatch, workers: int, store: type):
+    monkeypatch.setattr(sessions, 'SESSION_BACKEND', '')
+    monkeypatch.setattr(sessions, 'WEB_CONCURRENCY', workers)
+    assert isinstance(sessions.create_session_store(), store)
+
+
+# A memory store chosen explicitly is refused when several workers would each have
+# their own
+def test_memory_session_backend_refused_with_several_workers(monkeypatch):
+    monkeypatch.setattr(sessions, 'SESSION_BACKEND', 'memory')
+    monkeypatch.setattr(sessions, 'WEB_CONCURRENCY', 4)
+    with pytest.raises(ValueError):
+        sessions.create_session_store()
+    monkeypatch.setattr(sessions, 'SESSION_BACKEND', 'sqlite')
+    assert isinstance(sessions.create_session_store(), sessions.SqliteSessionStore)
@@ -0,0 +1,268 @@
+from models import *
+import os
+from storage import LogStorage, PickleStorage, SqliteStorage
+import pytest
+import random
+import threading
+import time
+
+
+WORDS = ['yes', 'no', 'maybe', 'Hello there', 'déjà vu', '你好', 'line\nbreak', '"quoted"', '']
+
+
+# Return a random mutation of dt as an operation name and its arguments. Every
+# mutation is valid for dt, so it can be applied to any tree with the same contents
+def random_edit(dt: type[DialogueTree], rnd: random.Random):
+    text = lambda: rnd.choice(WORDS)
+    components = dt.components
+    gcs = [c for c in components if isinstance(c, Generation)]
+    dcs = [c for c in components if isinstance(c, Detection)]
+    gc_examples = [(gc, ex) for gc in gcs for ex in gc.examples]
+    dc_classes = [(dc, cls) for dc in dcs for cls in dc.classes]
+    dc_examples = [(dc, cls, ex) for dc, cls in dc_classes for ex in cls.examples]
+    edges = [(c, neighbor) for c in components for neighbor in c.neighbors]
+
+    choices = [lambda: ('add_component', [rnd.choice(['gc', 'dc']), text()]),
+               lambda: ('edit_name', [text()])]
+    if len(components) > 0:
+        choices += [lambda: ('copy_component', [rnd.choice(['gc', 'dc']), rnd.choice(components).id]),
+                    lambda: ('delete_component', [rnd.choice(components).id]),
+                    lambda: ('edit_component_name', [rnd.choice(components).id, text()])]
+        pairs = [(start, end) for start in components for end in components if end not in start.neighbors]
+        if len(pairs) > 0:
+            choices.append(lambda: ('add_edge', [c.id for c in rnd.choice(pairs)]))
+    if len(edges) > 0:
+        choices.append(lambda: ('delete_edge', [c.id for c in rnd.choice(edges)]))
+    if len(gcs) > 0:
+        choices += [lambda: ('edit_generation_class', [rnd.choice(gcs).id, text()]),
+                    lambda: ('edit_generation_budget', [rnd.choice(gcs).id, {'max_history_messages': rnd.randrange(8)}]),
+                    lambda: ('add_generation_example', [rnd.choice(gcs).id, text(), text()])]
+    if len(gc_examples) > 0:
+        choices += [lambda: ('edit_generation_example', [*(x.id for x in rnd.choice(gc_examples)),
+                                                         rnd.choice([None, text()]), rnd.choice([None, text()])]),
+                    lambda: ('delete_generation_example', [x.id for x in rnd.choice(gc_examples)])]
+    if len(dcs) > 0:
+        choices.append(lambda: ('add_detection_class', [rnd.choice(dcs).id, text()]))
+    if len(dc_classes) > 0:
+        choices += [lambda: ('edit_detection_class_name', [*(x.id for x in rnd.choice(dc_classes)), text()]),
+                    lambda: ('delete_detection_class', [x.id for x in rnd.choice(dc_classes)]),
+                    lambda: ('add_detection_example', [*(x.id for x in rnd.choice(dc_classes)), text()])]
+    if len(dc_examples) > 0:
+        choices += [lambda: ('edit_detection_example', [*(x.id for x in rnd.choice(dc_examples)), text()]),
+                    lambda: ('delete_detection_example', [x.id for x in rnd.choice(dc_examples)])]
+    return rnd.choice(choices)()
+
+
+# Return everything about dt that a client can observe apart from its version, plus
+# the id counters that decide the ids of later additions
+def snapshot(dt: type[DialogueTree]):
+    tree = dt.to_json()
+    del tree['version']
+    components = []
+    for c in dt.components:
+        if isinstance(c, Generation):
+            components.append([c.to_json(), c.next_example_num])
+        else:
+            classes = [[cls.to_json(), cls.next_example_num] for cls in c.classes]
+            components.append([c.to_json(), classes, c.next_class_num])
+    return [tree, components, dict(dt.next_component_nums)]
+
+
+# Apply the same random edits to a tree kept in memory and to a copy of it in every
+# storage backend, saving and reloading the stored copies along the way, and check
+# that every backend loads the same tree as the one kept in memory
+def check_backends_match(backends: dict, seed: int, steps: int):
+    rnd = random.Random(seed)
+    expected = DialogueTree('tree', f'dt-{seed}')
+    trees = {name: DialogueTree('tree', f'dt-{seed}') for name in backends}
+    for name, storage in backends.items():
+        storage.save(trees[name], [])
+
+    for step in range(steps):
+        op, args = random_edit(expected, rnd)
+        result = getattr(expected, op)(*args)
+        for name, dt in trees.items():
+            assert getattr(dt, op)(*args) == result, (name, step, op)
+
+        if rnd.random() < 0.3:
+            for name, storage in backends.items():
+                storage.save(trees[name], trees[name].changes)
+                trees[name].changes = []
+        if rnd.random() < 0.1:
+            for name, storage in backends.items():
+                if len(trees[name].changes) == 0:
+                    trees[name], _ = storage.load(expected.id)
+                    assert snapshot(trees[name]) == snapshot(expected), (name, step)
+
+    for name, storage in backends.items():
+        storage.save(trees[name], trees[name].changes)
+        loaded, _ = storage.load(expected.id)
+        assert loaded.version == trees[name].version
+        assert snapshot(loaded) == snapshot(expected), name
+
+
+# SQLite saves turn recorded changes into row writes, while pickles rewrite the whole
+# tree, so random edit sequences must leave both with the same tree
+def test_sqlite_matches_pickle():
+    backends = {'pickle': PickleStorage(), 'sqlite': SqliteStorage('data/dialogues.db')}
+    for seed in range(20):
+        check_backends_match(backends, seed, 150)
+
+
+# Loads replay logged changes on top of the snapshot with the tree's own mutation
+# methods, so random edit sequences must leave the log backend with the same tree as
+# the one kept in memory, which is what the pickle backend writes. Both backends keep
+# their files in the data directory, so the log backend is checked on its own, and
+# compacted snapshots must match the replayed logs they replace
+def test_log_replay_matches_pickle():
+    storage = LogStorage(512)
+    for seed in range(20):
+        check_backends_match({'log': storage}, seed, 150)
+    while len(storage.compacting) > 0:
+        time.sleep(0.01)
+    for seed in range(20):
+        replayed, _ = storage.load(f'dt-{seed}')
+        storage.compact(f'dt-{seed}')
+        assert os.path.getsize(f'data/dt-{seed}.log') == 0
+        assert snapshot(PickleStorage().read_snapshot(f'dt-{seed}')[0]) == snapshot(replayed)
+
+
+# Reading or compacting a tree deleted after its version was read must not recreate
+# its version file
+def test_log_read_after_delete_leaves_no_version_file():
+    storage = LogStorage(512)
+    dt = DialogueTree('tree', 'dt-1')
+    storage.save(dt, [])
+    storage.stamp(dt.id)
+    storage.delete(dt.id)
+
+    with pytest.raises(FileNotFoundError):
+        storage.load(dt.id)
+    storage.compact(dt.id)
+    assert os.listdir('data') == []
+
+
+# Trees saved before versions existed have neither a version file nor a log
+def test_log_loads_tree_without_version_file():
+    storage = LogStorage(512)
+    dt = DialogueTree('tree', 'dt-1')
+    PickleStorage().write_snapshot(dt)
+    assert storage.load(dt.id)[0].version == 0
+    assert os.listdir('data') == ['dt-1.pkl']
+    storage.delete(dt.id)
+    assert os.listdir('data') == []
+
+
+# Forwards statements to a connection and runs after() once the components of a tree
+# have been selected, in the middle of a load
+class InterleavingConnection:
+    def __init__(self, conn, after):
+        self.conn = conn
+        self.after = after
+
+    def execute(self, sql: str, *args):
+        cursor = self.conn.execute(sql, *args)
+        if 'FROM components' in sql:
+            self.after()
+        return cursor
+
+    def __enter__(self):
+        return self.conn.__enter__()
+
+    def __exit__(self, *args):
+        return self.conn.__exit__(*args)
+
+
+# A save committing while a tree is loaded must not leave the load with rows of both
+# versions, so the load returns the tree as it was when the load started
+def test_sqlite_load_is_one_read(monkeypatch):
+    storage = SqliteStorage('data/dialogues.db')
+    dt = DialogueTree('tree', 'dt-1')
+    gc_id = dt.add_component('gc', 'gc')
+    dc_id = dt.add_component('dc', 'dc')
+    dt.add_edge(dc_id, gc_id)
+    storage.save(dt, [])
+    before = snapshot(dt)
+
+    def write():
+        dt, _ = storage.load('dt-1')
+        dt.delete_component(gc_id)
+        dt.add_edge(dc_id, dt.add_component('gc', 'new'))
+        storage.save(dt, dt.changes)
+
+    def interleave():
+        thread = threading.Thread(target=write)
+        thread.start()
+        thread.join()
+
+    connection = storage.connection
+    main = threading.current_thread()
+    monkeypatch.setattr(storage, 'connection', lambda: InterleavingConnection(connection(), interleave)
+                        if threading.current_thread() is main else connection())
+    loaded, _ = storage.load('dt-1')
+    assert loaded.version == 0
+    assert snapshot(loaded) == before
+    monkeypatch.setattr(storage, 'connection', connection)
+    assert storage.load('dt-1')[0].version == 1
+
+
+# Raised in place of a worker dying in the middle of a compaction
+class Crash(Exception):
+    pass
+
+
+# A compaction dying after writing the new snapshot but before emptying the log must
+# not replay the log on top of the snapshot that already contains it
+def test_log_compaction_crash_keeps_tree_loadable(monkeypatch):
+    storage = LogStorage(1 << 20)
+    dt = DialogueTree('tree', 'dt-1')
+    storage.save(dt, [])
+    for version in range(3):
+        gc_id = dt.add_component('gc', 'gc')
+        dt.add_generation_example(gc_id, 'context', 'response')
+        dt.delete_component(gc_id)
+        dt.edit_name(f'tree {version}')
+        storage.save(dt, dt.changes)
+        dt.changes = []
+    expected = snapshot(dt)
+
+    write_snapshot = storage.write_snapshot
+
+    def crash(dt):
+        write_snapshot(dt)
+        raise Crash()
+
+    monkeypatch.setattr(storage, 'write_snapshot', crash)
+    with pytest.raises(Crash):
+        storage.compact(dt.id)
+    monkeypatch.setattr(storage, 'write_snapshot', write_snapshot)
+    assert os.path.getsize(f'data/{dt.id}.log') > 0
+
+    loaded, _ = storage.load(dt.id)
+    assert loaded.version == 3
+    assert snapshot(loaded) == expected
+    dt.edit_name('after crash')
+    storage.save(dt, dt.changes)
+    storage.compact(dt.id)
+    assert storage.load(dt.id)[0].name == 'after crash'
+    assert os.path.getsize(f'data/{dt.id}.log') == 0
+
+
+# Existence checks look up one tree instead of listing every stored tree, and ids
+# naming paths outside the data directory never exist
+@pytest.mark.parametrize('backend', ['pickle', 'sqlite', 'log'])
+def test_exists_checks_one_tree(backend, monkeypatch):
+    storage = {'pickle': PickleStorage, 'sqlite': lambda: SqliteStorage('data/dialogues.db'),
+               'log': lambda: LogStorage(512)}[backend]()
+    dt = DialogueTree('tree', 'dt-1')
+    storage.save(dt, [])
+    open('dt-2.pkl', 'wb').close()
+
+    def listdir(path):
+        raise AssertionError('stored trees listed')
+    monkeypatch.setattr(os, 'listdir', listdir)
+    assert storage.exists('dt-1')
+    assert not storage.exists('dt-0')
+    assert not storage.exists('../dt-2')
+    storage.delete('dt-1')
+    assert not storage.exists('dt-1')
@@ -1,25 +1,29 @@
+from helpers import load_dialogue, load_session
 from models import *
-import os
 
 
 def validate_dialogue_exists(id: str):
-    return f'{id}.pkl' in os.listdir('data')
+    return DialogueTree.exists(id)
 
 
 def validate_component_exists(dt_id: str, c_id: str):
-    return DialogueTree.load(dt_id).get_component(c_id) is not None
+    return load_dialogue(dt_id).get_component(c_id) is not None
 
 
 def validate_generation_example_exists(dt_id: str, gc_id: str, ex_id: str):
-    return DialogueTree.load(dt_id).get_component(gc_id).get_example(ex_id) is not None
+    return load_dialogue(dt_id).get_component(gc_id).get_example(ex_id) is not None
 
 
 def validate_detection_class_exists(dt_id: str, dc_id: str, cls_id: str):
-    return DialogueTree.load(dt_id).get_component(dc_id).get_class(cls_id) is not None
+    return load_dialogue(dt_id).get_component(dc_id).get_class(cls_id) is not None
 
 
 def validate_detection_class_example_exists(dt_id: str, dc_id: str, cls_id: str, ex_id: str):
-    return DialogueTree.load(dt_id).get_component(dc_id).get_class(cls_id).get_example(ex_id) is not None
+    return load_dialogue(dt_id).get_component(dc_id).get_class(cls_id).get_example(ex_id) is not None
+
+
+def validate_session_exists(dt_id: str, s_id: str):
+    return type(s_id) == str and load_session(dt_id, s_id) is not None
 
 
 def validate_create_dialogue(request_data: dict):
@@ -44,6 +48,17 @@ def validate_get_dialogue(dt_id: str):
     return error_msg, status_code
 
 
+def validate_get_dialogue_analysis(dt_id: str, start_id: str):
+    error_msg, status_code = None, None
+    if not validate_dialogue_exists(dt_id):
+        error_msg = 'provided dialogue tree does not exist'
+        status_code = 404
+    elif start_id is not None and not validate_component_exists(dt_id, start_id):
+        error_msg = 'provided start component does not exist'
+        status_code = 404
+    return error_msg, status_code
+
+
 def validate_edit_dialogue_name(dt_id: str, request_data: dict):
     error_msg, status_code = None, None
     if not validate_dialogue_exists(dt_id):
@@ -116,7 +131,7 @@ def validate_delete_dialogue_edge(dt_id: str, request_data: dict):
     elif not validate_component_exists(dt_id, request_data['end']):
         error_msg = 'provided end component does not exist'
         status_code = 404
-    elif {'start': request_data['start'], 'end': request_data['end']} not in DialogueTree.load(dt_id).get_edges():
+    elif not load_dialogue(dt_id).has_edge(request_data['start'], request_data['end']):
         error_msg = 'provided edge does not exist'
         status_code = 404
     return error_msg, status_code
@@ -201,6 +216,37 @@ def validate_edit_generation_class(dt_id: str, gc_id: str, request_data: dict):
     return error_msg, status_code
 
 
+def validate_edit_generation_budget(dt_id: str, gc_id: str, request_data: dict):
+    error_msg, status_code = None, None
+    if not validate_dialogue_exists(dt_id):
+        error_msg = 'provided dialogue tree does not exist'
+        status_code = 404
+    elif not validate_component_exists(dt_id, gc_id):
+        error_msg = 'provided generation component does not exist'
+        status_code = 404
+    elif request_data is None:
+        error_msg = 'request body not provided'
+        status_code = 400
+    elif len(request_data.keys() & DEFAULT_GENERATION_BUDGET.keys()) == 0:
+        error_msg = 'max_history_messages, max_prompt_tokens or summarize_history not provided'
+        status_code = 400
+    elif len(request_data.keys() - DEFAULT_GENERATION_BUDGET.keys()) > 0:
+        error_msg = 'unknown budget setting provided'
+        status_code = 400
+    elif request_data.get('max_history_messages') is not None and (type(request_data['max_history_messages']) != int
+                                                                   or request_data['max_history_messages'] < 0):
+        error_msg = 'max_history_messages is not a non-negative integer or null'
+        status_code = 400
+    elif request_data.get('max_prompt_tokens') is not None and (type(request_data['max_prompt_tokens']) != int
+                                                                or request_data['max_prompt_tokens'] <= 0):
+        error_msg = 'max_prompt_tokens is not a positive integer or null'
+        status_code = 400
+    elif 'summarize_history' in request_data.keys() and type(request_data['summarize_history']) != bool:
+        error_msg = 'summarize_history is not a boolean'
+        status_code = 400
+    return error_msg, status_code
+
+
 def validate_add_generation_example(dt_id: str, gc_id: str, request_data: dict):
     error_msg, status_code = None, None
     if not validate_dialogue_exists(dt_id):
@@ -496,6 +542,8 @@ def validate_prompt_generation_component(dt_id: str, gc_id: str, request_data: d
     elif request_data is None:
         error_msg = 'request body not provided'
         status_code = 400
+    elif 'session' in request_data.keys():
+        return validate_session_prompt(dt_id, request_data, False)
     elif 'messages' not in request_data.keys():
         error_msg = 'messages not provided'
         status_code = 400
@@ -526,6 +574,55 @@ def validate_prompt_generation_component(dt_id: str, gc_id: str, request_data: d
     return error_msg, status_code
 
 
+def validate_prompt_generation_component_batch(dt_id: str, gc_id: str, request_data: dict):
+    error_msg, status_code = None, None
+    if not validate_dialogue_exists(dt_id):
+        error_msg = 'provided dialogue tree does not exist'
+        status_code = 404
+    elif not validate_component_exists(dt_id, gc_id):
+        error_msg = 'provided generation component does not exist'
+        status_code = 404
+    elif request_data is None:
+        error_msg = 'request body not provided'
+        status_code = 400
+    elif 'conversations' not in request_data.keys():
+        error_msg = 'conversations not provided'
+        status_code = 400
+    elif type(request_data['conversations']) != list:
+        error_msg = 'conversations is not a list'
+        status_code = 400
+
+    if error_msg is not None:
+        return error_msg, status_code
+
+    for messages in request_data['conversations']:
+        if type(messages) != list:
+            error_msg = 'conversations list does not contain all lists'
+            status_code = 400
+            continue
+        if len(messages) == 0:
+            error_msg = 'conversation has no messages'
+            status_code = 400
+        for element in messages:
+            if type(element) != dict:
+                error_msg = 'messages list does not contain all dictionaries'
+                status_code = 400
+            elif 'role' not in element.keys():
+                error_msg = 'role not provided'
+                status_code = 400
+            elif element['role'] != 'student' and element['role'] != 'chatbot':
+                error_msg = 'role must be "chatbot" or "student"'
+                status_code = 400
+            elif 'message' not in element.keys():
+                error_msg = 'message not provided'
+                status_code = 400
+            elif type(element['message']) != str:
+                error_msg = 'message must be a string'
+                status_code = 400
+
+    return error_msg, status_code
+
+
 def validate_prompt_detection_component(dt_id: str, dc_id: str, request_data: dict):
     error_msg, status_code = None, None
     if not validate_dialogue_exists(dt_id):
@@ -537,6 +634,8 @@ def validate_prompt_detection_component(dt_id: str, dc_id: str, request_data: di
     elif request_data is None:
         error_msg = 'request body not provided'
         status_code = 400
+    elif 'session' in request_data.keys():
+        return validate_session_prompt(dt_id, request_data, True)
     elif 'messages' not in request_data.keys():
         error_msg = 'messages not provided'
         status_code = 400
@@ -567,6 +666,52 @@ def validate_prompt_detection_component(dt_id: str, dc_id: str, request_data: di
     return error_msg, status_code
 
 
+def validate_prompt_detection_component_batch(dt_id: str, dc_id: str, request_data: dict):
+    error_msg, status_code = None, None
+    if not validate_dialogue_exists(dt_id):
+        error_msg = 'provided dialogue tree does not exist'
+        status_code = 404
+    elif not validate_component_exists(dt_id, dc_id):
+        error_msg = 'provided detection component does not exist'
+        status_code = 404
+    elif request_data is None:
+        error_msg = 'request body not provided'
+        status_code = 400
+    elif 'messages' not in request_data.keys():
+        error_msg = 'messages not provided'
+        status_code = 400
+    elif type(request_data['messages']) != list:
+        error_msg = 'messages is not a list'
+        status_code = 400
+
+    if error_msg is not None:
+        return error_msg, status_code
+
+    for element in request_data['messages']:
+        if type(element) != str:
+            error_msg = 'messages list does not contain all strings'
+            status_code = 400
+
+    return error_msg, status_code
+
+
+def validate_session_prompt(dt_id: str, request_data: dict, message_required: bool):
+    error_msg, status_code = None, None
+    if not validate_session_exists(dt_id, request_data['session']):
+        error_msg = 'provided session does not exist'
+        status_code = 404
+    elif message_required and 'message' not in request_data.keys():
+        error_msg = 'message not provided'
+        status_code = 400
+    elif 'message' in request_data.keys() and type(request_data['message']) != str:
+        error_msg = 'message must be a string'
+        status_code = 400
+    elif 'message' not in request_data.keys() and load_session(dt_id, request_data['session']).messages == []:
+        error_msg = 'session has no messages'
+        status_code = 400
+    return error_msg, status_code
+
+
 def validate_chat(dt_id: str, c_id: str, request_data: dict):
     error_msg, status_code = None, None
     if not validate_dialogue_exists(dt_id):
@@ -605,4 +750,82 @@ def validate_chat(dt_id: str, c_id: str, request_data: dict):
             error_msg = 'message must be a string'
             status_code = 400
     
-    return error_msg, status_code
\ No newline at end of file
+    return error_msg, status_code
+
+
+def validate_create_session(dt_id: str, request_data: dict):
+    error_msg, status_code = None, None
+    if not validate_dialogue_exists(dt_id):
+        error_msg = 'provided dialogue tree does not exist'
+        status_code = 404
+    elif request_data is None:
+        error_msg = 'request body not provided'
+        status_code = 400
+    elif 'start' not in request_data.keys():
+        error_msg = 'start not provided'
+        status_code = 400
+    elif type(request_data['start']) != str or not validate_component_exists(dt_id, request_data['start']):
+        error_msg = 'provided start component does not exist'
+        status_code = 404
+    elif 'messages' in request_data.keys() and type(request_data['messages']) != list:
+        error_msg = 'messages is not a list'
+        status_code = 400
+
+    if error_msg is not None:
+        return error_msg, status_code
+
+    for element in request_data.get('messages', []):
+        if type(element) != dict:
+            error_msg = 'messages list does not contain all dictionaries'
+            status_code = 400
+        elif 'role' not in element.keys():
+            error_msg = 'role not provided'
+            status_code = 400
+        elif element['role'] != 'student' and element['role'] != 'chatbot':
+            error_msg = 'role must be "chatbot" or "student"'
+            status_code = 400
+        elif 'message' not in element.keys():
+            error_msg = 'message not provided'
+            status_code = 400
+        elif type(element['message']) != str:
+            error_msg = 'message must be a string'
+            status_code = 400
+
+    return error_msg, status_code
+
+
+def validate_get_session(dt_id: str, s_id: str):
+    error_msg, status_code = None, None
+    if not validate_dialogue_exists(dt_id):
+        error_msg = 'provided dialogue tree does not exist'
+        status_code = 404
+    elif not validate_session_exists(dt_id, s_id):
+        error_msg = 'provided session does not exist'
+        status_code = 404
+    return error_msg, status_code
+
+
+def validate_session_chat(dt_id: str, s_id: str, request_data: dict):
+    error_msg, status_code = None, None
+    if not validate_dialogue_exists(dt_id):
+        error_msg = 'provided dialogue tree does not exist'
+        status_code = 404
+    elif not validate_session_exists(dt_id, s_id):
+        error_msg = 'provided session does not exist'
+        status_code = 404
+    elif load_session(dt_id, s_id).component_id == 'exit':
+        error_msg = 'session has reached the end of the dialogue tree'
+        status_code = 400
+    elif not validate_component_exists(dt_id, load_session(dt_id, s_id).component_id):
+        error_msg = 'session component no longer exists'
+        status_code = 404
+    elif request_data is None:
+        error_msg = 'request body not provided'
+        status_code = 400
+    elif 'message' not in request_data.keys():
+        error_msg = 'message not provided'
+        status_code = 400
+    elif type(request_data['message']) != str:
+        error_msg = 'message must be a string'
+        status_code = 400
+    return error_msg, status_code